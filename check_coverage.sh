@@ -1,2 +1,2 @@
-coverage run --source='sjfnw' --omit='sjfnw/wsgi.py,sjfnw/mail.py,*/tests.py,*__init__.py,*commands/*' manage.py test grants fund
+coverage run --source='sjfnw' --omit='sjfnw/wsgi.py,*/tests.py,*__init__.py,*commands/*' manage.py test sjfnw grants fund
 coverage html -d ~/Projects/coverage
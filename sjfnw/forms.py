@@ -1,6 +1,9 @@
 ﻿from django import forms
 from django.core import validators
 from django.core.exceptions import ValidationError
+from django.forms.util import flatatt
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
 import re
 
 class PhoneNumberField(forms.Field):
@@ -79,3 +82,37 @@ class GaeLogsForm(forms.Form):
   start = forms.SplitDateTimeField()
   end = forms.SplitDateTimeField()
   version_ids = forms.MultipleChoiceField(choices = [('1', '1'), ('devel', 'devel')])
+
+class AutocompleteInput(forms.TextInput):
+  """ Foreign key input that lets staff search for the object by name instead
+  of choosing from a select of every row. The id goes in a hidden input;
+  matches are fetched as the user types (see static/js/autocomplete.js).
+
+  Args:
+    url: search endpoint. Called with ?q=<text> and returns a json list of
+      {"id": .., "label": ..}
+    labels: dict of id -> label for the values already set, so they can be
+      shown without a query per row
+  """
+
+  class Media:
+    js = ('/static/js/autocomplete.js',)
+
+  def __init__(self, url, labels=None, attrs=None):
+    super(AutocompleteInput, self).__init__(attrs)
+    self.url = url
+    self.labels = labels or {}
+
+  def render(self, name, value, attrs=None):
+    final_attrs = self.build_attrs(attrs, type='hidden', name=name)
+    label = u''
+    if value not in validators.EMPTY_VALUES:
+      final_attrs['value'] = value
+      try:
+        label = self.labels.get(int(value), u'')
+      except (ValueError, TypeError):
+        pass
+    return mark_safe(
+        u'<input%s /><input type="text" class="autocomplete" data-url="%s" '
+        u'value="%s" placeholder="Type to search" autocomplete="off" />' % (
+            flatatt(final_attrs), escape(self.url), escape(label)))
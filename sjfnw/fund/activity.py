@@ -0,0 +1,81 @@
+""" Coalesced tracking of Membership.last_activity
+
+  Views call touch() on every interactive POST. Only the first touch per
+  membership per day is recorded - appended to that day's list in the cache -
+  and flush() (cron) writes the recorded memberships with one UPDATE. So
+  last_activity is still the date of the latest activity, written once a day
+  at most, and a touch costs no db queries.
+"""
+
+from django.core.cache import cache
+from django.utils import timezone
+
+from sjfnw.fund.models import Membership, membership_cache
+
+import datetime, logging
+
+logger = logging.getLogger('sjfnw')
+
+TIMEOUT = 60 * 60 * 24 * 3 # keep lists around until they've been flushed
+
+def _key(date, suffix):
+  return 'fund-activity-%s-%s' % (date.isoformat(), suffix)
+
+def today():
+  return timezone.localtime(timezone.now()).date()
+
+def touch(membership):
+  """ Record activity on a membership today """
+  date = today()
+  if membership.last_activity == date:
+    return
+  if not cache.add(_key(date, membership.pk), True, TIMEOUT):
+    return # already recorded today
+  count_key = _key(date, 'count')
+  if cache.add(count_key, 1, TIMEOUT):
+    index = 1
+  else:
+    index = cache.incr(count_key)
+  cache.set(_key(date, 'ship-%d' % index), membership.pk, TIMEOUT)
+
+def flush(date=None):
+  """ Write last_activity for memberships touched on date (default: today)
+      since the last flush. Returns the number of memberships updated """
+  date = date or today()
+  count = cache.get(_key(date, 'count')) or 0
+  flushed_key, missing_key = _key(date, 'flushed'), _key(date, 'missing')
+  start = cache.get(flushed_key) or 0
+  if count <= start:
+    return 0
+  keys = [_key(date, 'ship-%d' % i) for i in range(start + 1, count + 1)]
+  found = cache.get_many(keys)
+
+  # touch() sets its entry just after taking the index, so an entry may not
+  # be set yet - stop before it rather than flush past it. If it's still
+  # missing next flush it was lost (evicted), and is skipped
+  done = start
+  for index, key in enumerate(keys, start + 1):
+    if key not in found:
+      if cache.get(missing_key) != index:
+        cache.set(missing_key, index, TIMEOUT)
+        break
+      logger.warning('Activity entry %d for %s was lost', index, date)
+    done = index
+  ship_ids = set(found[key] for key in keys[:done - start] if key in found)
+
+  updated = 0
+  if ship_ids:
+    ships = Membership.objects.filter(pk__in=ship_ids)
+    member_ids = list(ships.values_list('member_id', flat=True))
+    updated = ships.update(last_activity=date)
+    # update() skips the signals that refresh cached memberships
+    membership_cache.invalidate(*member_ids)
+  cache.set(flushed_key, done, TIMEOUT)
+  logger.info('Recorded activity on %s for %d memberships', date, updated)
+  return updated
+
+def flush_recent():
+  """ Flush yesterday's touches (in case the last flush was before midnight)
+      and today's """
+  date = today()
+  return flush(date - datetime.timedelta(days=1)) + flush(date)
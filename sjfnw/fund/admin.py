@@ -1,19 +1,27 @@
 from django.contrib import admin, messages
 from django.contrib.admin import SimpleListFilter
+from django.contrib.admin.views.main import ChangeList
 from django.http import HttpResponse
 from django.forms import ValidationError
 from django.utils import timezone
+from django.utils.html import escape
 from django.utils.safestring import mark_safe
 
 from sjfnw.admin import advanced_admin
+from sjfnw.forms import AutocompleteInput
 from sjfnw.fund.models import *
-from sjfnw.fund import forms, utils, modelforms
+from sjfnw.fund import blocks, bulk, exports, forms, utils, modelforms
 from sjfnw.grants.models import ProjectApp, GrantApplication
 
-import datetime, unicodecsv, logging, json
+import datetime, logging, json, re
 
 logger = logging.getLogger('sjfnw')
 
+def gp_from_path(request):
+  """ Id of the giving project being edited, from the admin change page url """
+  match = re.search(r'/givingproject/(\d+)/', request.path)
+  return int(match.group(1)) if match else None
+
 # display methods
 def step_membership(obj): #Step list_display
   return obj.donor.membership
@@ -40,6 +48,17 @@ ship_progress.short_description = 'Estimated, promised, received, rec. by year'
 ship_progress.allow_tags = True
 
 
+# Changelists
+class MembershipChangeList(ChangeList):
+  """ Annotates progress totals & overdue step counts so the list columns
+      don't run queries for each row """
+
+  def get_query_set(self, request):
+    qs = super(MembershipChangeList, self).get_query_set(request)
+    return (qs.select_related('member', 'giving_project')
+              .with_progress().with_overdue_count())
+
+
 # Filters
 class PromisedBooleanFilter(SimpleListFilter): #donors & steps
   title = 'promised'
@@ -114,26 +133,15 @@ class MembershipInline(admin.TabularInline): #GP
   fields = ('member', 'giving_project', 'approved', 'leader',)
 
   def formfield_for_foreignkey(self, db_field, request, **kwargs):
-
-    # cache member choices to reduce queries
     if db_field.name == 'member':
-
-      cached_choices = getattr(request, 'cached_members', None)
-      if cached_choices:
-        logger.debug('Using cached choices for membership inline')
-        formfield = super(ProjectAppInline, self).formfield_for_foreignkey(db_field, request, **kwargs)
-        formfield.choices = cached_choices
-
-      else:
-        members = Member.objects.all()
-        formfield = super(MembershipInline, self).formfield_for_foreignkey(db_field, request, **kwargs)
-        formfield.choices = [(member.pk, unicode(member)) for member in members]
-        request.cached_members = formfield.choices
-
-      return formfield
-
-    else: # different field
-      return super(MembershipInline, self).formfield_for_foreignkey(db_field, request, **kwargs)
+      # names of current members, so rows don't each look theirs up
+      ships = Membership.objects.filter(giving_project_id=gp_from_path(request))
+      labels = dict((pk, first + u' ' + last) for pk, first, last in
+                    ships.values_list('member_id', 'member__first_name',
+                                      'member__last_name'))
+      kwargs['widget'] = AutocompleteInput('/admin/fund/autocomplete/members',
+                                           labels=labels)
+    return super(MembershipInline, self).formfield_for_foreignkey(db_field, request, **kwargs)
 
 class ProjectResourcesInline(admin.TabularInline): #GP
   model = ProjectResource
@@ -157,42 +165,20 @@ class ProjectAppInline(admin.TabularInline):
   verbose_name_plural = 'Grant applications'
   raw_id_fields = ('giving_project',)
 
-  #def get_queryset(self, request):
-  #  qs = super(ProjectAppInline, self).get_queryset(request)
-  #  return qs.select_related('application')
-
   def formfield_for_foreignkey(self, db_field, request, **kwargs):
-
-    # cache application choices to reduce queries
     if db_field.name == 'application':
-
-      cached_choices = getattr(request, 'cached_projectapps', None)
-      if cached_choices:
-        logger.debug('Using cached choices for projectapp inline')
-        formfield = super(ProjectAppInline, self).formfield_for_foreignkey(db_field, request, **kwargs)
-        formfield.choices = cached_choices
-
-      else:
-        apps = GrantApplication.objects.select_related('grant_cycle', 'organization')
-        try:
-          gp_id = int(request.path.split('/')[-2])
-        except:
-          logger.info('Could not parse gp id, not limiting app choices')
-        else:
-          gp = GivingProject.objects.get(pk=gp_id)
-          year = gp.fundraising_deadline - datetime.timedelta(weeks=52)
-          apps = apps.filter(submission_time__gte=year)
-        finally:
-          formfield = super(ProjectAppInline, self).formfield_for_foreignkey(db_field, request, **kwargs)
-          # create choices from queryset (doing manually results in less queries)
-          formfield.choices = [('', '---------')] + [(app.pk, unicode(app)) for app in apps]
-          request.cached_projectapps = formfield.choices
-          logger.debug('Cached app choices for projectapp inline')
-
-      return formfield
-
-    else: #other field
-      return super(ProjectAppInline, self).formfield_for_foreignkey(db_field, request, **kwargs)
+      gp_id = gp_from_path(request)
+      url = '/admin/fund/autocomplete/applications'
+      if gp_id:
+        url += '?gp=%d' % gp_id
+      # names of current applications, so rows don't each look theirs up
+      papps = ProjectApp.objects.filter(giving_project_id=gp_id)
+      labels = dict((pk, u'%s - %s' % (org, cycle)) for pk, org, cycle in
+                    papps.values_list('application_id',
+                                      'application__organization__name',
+                                      'application__grant_cycle__title'))
+      kwargs['widget'] = AutocompleteInput(url, labels=labels)
+    return super(ProjectAppInline, self).formfield_for_foreignkey(db_field, request, **kwargs)
 
 
 class SurveyI(admin.TabularInline):
@@ -201,46 +187,81 @@ class SurveyI(admin.TabularInline):
   extra = 1
   verbose_name = 'Survey'
   verbose_name_plural = 'Surveys'
+  readonly_fields = ('results',)
+
+  def results(self, obj):
+    if not obj.pk:
+      return ''
+    return mark_safe('<a href="/admin/fund/gpsurvey/%d/results">View results</a>'
+                     % obj.pk)
 
 # ModelAdmin
 class GivingProjectA(admin.ModelAdmin):
   list_display = ('title', gp_year, 'estimated')
   list_filter = (GPYearFilter,)
-  readonly_fields = ('estimated',)
+  readonly_fields = ('estimated', 'block_cache')
   fields = (('title', 'public'),
             ('fundraising_training', 'fundraising_deadline'),
-            'fund_goal', 'site_visits', 'calendar', 'suggested_steps', 'pre_approved')
+            'fund_goal', 'site_visits', 'calendar', 'suggested_steps',
+            'pre_approved_emails', 'block_cache')
   form = modelforms.GivingProjectAdminForm
   inlines = [SurveyI, ProjectResourcesInline, MembershipInline, ProjectAppInline]
 
+  def queryset(self, request):
+    # totals for the estimated column come from one grouped query
+    return super(GivingProjectA, self).queryset(request).with_progress()
+
+  def save_model(self, request, obj, form, change):
+    obj.save()
+    added, removed = PreApprovedEmail.replace(
+        obj.pk, form.cleaned_data['pre_approved_emails'])
+    if added or removed:
+      self.message_user(request, 'Pre-approved emails: %d added, %d removed.'
+                        % (added, removed))
+
+  def block_cache(self, obj):
+    if not obj.pk:
+      return ''
+    return '%(hits)d hits, %(misses)d misses' % blocks.stats(obj.pk)
+  block_cache.short_description = 'News/grants cache'
+
 class MemberAdvanced(admin.ModelAdmin): #advanced only
   list_display = ('first_name', 'last_name', 'email')
   search_fields = ['first_name', 'last_name', 'email']
 
 class MembershipA(admin.ModelAdmin):
 
-  #list_select_related = True
   actions = ['approve']
   list_display = ('member', 'giving_project', ship_progress, 'overdue_steps',
                   'last_activity', 'approved', 'leader')
   list_filter = ('approved', 'leader', 'giving_project') #add overdue steps
   search_fields = ['member__first_name', 'member__last_name']
-  readonly_list = (ship_progress, 'overdue_steps',)
 
   fields = (('member', 'giving_project', 'approved'),
       ('leader', 'last_activity', 'emailed'),
       (ship_progress),
-      'notifications'
   )
   readonly_fields = ('last_activity', 'emailed', ship_progress)
   inlines = [DonorInline]
 
+  def get_changelist(self, request, **kwargs):
+    return MembershipChangeList
+
+  def overdue_steps(self, obj):
+    if hasattr(obj, 'overdue_count'):
+      return obj.overdue_count
+    return obj.overdue_steps()
+  overdue_steps.short_description = 'Overdue steps'
+
   def approve(self, request, queryset): #Membership action
     logger.info('Approval button pressed; looking through queryset')
+    member_ids = []
     for memship in queryset:
+      member_ids.append(memship.member_id)
       if memship.approved == False:
         utils.NotifyApproval(memship)
     queryset.update(approved=True)
+    membership_cache.invalidate(*member_ids) # update() skips signals
     logger.info('Approval queryset updated')
 
 
@@ -267,31 +288,29 @@ class DonorA(admin.ModelAdmin):
   def export_donors(self, request, queryset):
     logger.info('Export donors called by ' + request.user.email)
 
-    response = HttpResponse(mimetype='text/csv')
+    # admin actions can only return an HttpResponse - StreamingHttpResponse
+    # isn't one in django 1.5, and would be dropped for a redirect
+    response = HttpResponse(''.join(exports.donor_csv(queryset)),
+                            mimetype='text/csv')
     response['Content-Disposition'] = 'attachment; filename=prospects.csv'
-    writer = unicodecsv.writer(response)
-
-    writer.writerow(['First name', 'Last name', 'Phone', 'Email', 'Member',
-                     'Giving Project', 'Amount to ask', 'Asked', 'Promised',
-                     'Received - TOTAL', 'Received - Year', 'Received - Amount',
-                     'Received - Year', 'Received - Amount',
-                     'Received - Year', 'Received - Amount', 'Notes',
-                     'Likelihood of joining a GP', 'Reasons for donating'])
-    count = 0
-    for donor in queryset:
-      year = donor.membership.giving_project.fundraising_deadline.year
-      fields = [donor.firstname, donor.lastname, donor.phone, donor.email,
-                donor.membership.member, donor.membership.giving_project,
-                donor.amount, donor.asked, donor.promised, donor.received(),
-                year, donor.received_this, year+1, donor.received_next, year+2,
-                donor.received_afternext, donor.notes,
-                donor.get_likely_to_join_display(),
-                donor.promise_reason_display()]
-      writer.writerow(fields)
-      count += 1
-    logger.info(str(count) + ' donors exported')
     return response
 
+  def changelist_view(self, request, extra_context=None):
+    """ Collect donors saved through list_editable and write them together """
+    if request.method == 'POST' and '_save' in request.POST:
+      request.pending_donors = []
+      response = super(DonorA, self).changelist_view(request, extra_context)
+      bulk.update_changed(Donor, request.pending_donors)
+      return response
+    return super(DonorA, self).changelist_view(request, extra_context)
+
+  def save_model(self, request, obj, form, change):
+    pending = getattr(request, 'pending_donors', None)
+    if change and pending is not None:
+      pending.append(obj)
+    else:
+      obj.save()
+
 
 class NewsA(admin.ModelAdmin):
   list_display = ('summary', 'date', 'membership')
@@ -322,46 +341,20 @@ class SurveyResponseA(admin.ModelAdmin):
   actions = ['export_responses']
 
   def display_responses(self, obj):
-    if obj and obj.responses:
-      resp_list = json.loads(obj.responses)
+    if obj and obj.pk:
       disp = '<table><tr><th>Question</th><th>Answer</th></tr>'
-      for i in range(0, len(resp_list), 2):
-        disp += ('<tr><td>' + unicode(resp_list[i]) + '</td><td>' +
-                 unicode(resp_list[i+1]) + '</td></tr>')
+      for answer in obj.answers.all():
+        disp += ('<tr><td>' + escape(answer.question) + '</td><td>' +
+                 escape(answer.answer) + '</td></tr>')
       disp += '</table>'
       return mark_safe(disp)
   display_responses.short_description = 'Responses'
 
   def export_responses(self, request, queryset):
-
     logger.info('Export survey responses called by ' + request.user.email)
-    response = HttpResponse(mimetype='text/csv')
+    response = HttpResponse(''.join(exports.survey_response_csv(queryset)),
+                            mimetype='text/csv')
     response['Content-Disposition'] = 'attachment; filename=survey_responses %s.csv' % (timezone.now().strftime('%Y-%m-%d'),)
-    writer = unicodecsv.writer(response)
-
-    header = ['Date', 'Survey ID', 'Giving Project', 'Survey'] #base
-    questions = 0
-    response_rows = []
-    for sr in queryset:
-      fields = [sr.date, sr.gp_survey_id,
-                sr.gp_survey.giving_project.title,
-                sr.gp_survey.survey.title]
-      logger.info(isinstance(sr.responses, str))
-      qa = json.loads(sr.responses)
-      for i in range(0, len(qa), 2):
-        fields.append(qa[i])
-        fields.append(qa[i+1])
-        questions = max(questions, (i+2)/2)
-      response_rows.append(fields)
-
-    logger.info('Max %d questions' % questions)
-    for i in range(0, questions):
-      header.append('Question')
-      header.append('Answer')
-    writer.writerow(header)
-    for row in response_rows:
-      writer.writerow(row)
-
     return response
 
 admin.site.register(GivingProject, GivingProjectA)
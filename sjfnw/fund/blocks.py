@@ -0,0 +1,34 @@
+""" Shared cache for the news & grants blocks shown to project members
+
+  Every member of a giving project sees the same news and grants lists, so
+  they're stored once per project, keyed by giving project id.
+"""
+
+from sjfnw.utils import VersionedCache
+
+import logging
+
+logger = logging.getLogger('sjfnw')
+
+_cache = VersionedCache('fund-blocks', 60 * 60 * 6)
+
+def get_or_fill(gp_id, fill):
+  """ Returns cached blocks for the giving project, calling fill() to
+      generate and store them on a miss """
+  version, blocks = _cache.get(gp_id)
+  if blocks is None:
+    _cache.count(gp_id, 'misses')
+    blocks = fill()
+    _cache.set(gp_id, version, blocks)
+  else:
+    _cache.count(gp_id, 'hits')
+  return blocks
+
+def invalidate(*gp_ids):
+  """ Discard cached blocks for the given giving projects """
+  _cache.invalidate(*gp_ids)
+  logger.debug('Invalidated blocks for giving projects %s', gp_ids)
+
+def stats(gp_id):
+  """ Cache hits and misses for the giving project's blocks """
+  return _cache.stats(gp_id)
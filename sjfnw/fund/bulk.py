@@ -0,0 +1,53 @@
+""" Bulk persistence for rows edited through formsets
+
+  create() and update_changed() write many instances in a few queries. The
+  QuerySet methods they use skip save() and the model signals, so they send
+  bulk_created / bulk_updated instead; handlers that keep derived data
+  current (e.g. MembershipProgress) can then apply the whole batch at once.
+"""
+
+from django.dispatch import Signal
+
+import logging
+
+logger = logging.getLogger('sjfnw')
+
+bulk_created = Signal(providing_args=['instances'])
+bulk_updated = Signal(providing_args=['instances'])
+
+def create(model, instances):
+  """ Insert new instances with bulk_create """
+  if instances:
+    model.objects.bulk_create(instances)
+    bulk_created.send(sender=model, instances=instances)
+    logger.info('Bulk created %d %s', len(instances), model.__name__)
+  return instances
+
+def update_changed(model, instances):
+  """ Save the changed fields of instances of a model using
+  ChangeTrackingMixin. Instances with the same changed values are written
+  with one UPDATE.
+
+  Returns:
+    list of instances that had changes
+  """
+  groups = {}
+  changed = []
+  for obj in instances:
+    fields = [model._meta.get_field(name) for name in sorted(obj.changed_fields)
+              if name != model._meta.pk.name]
+    if not fields:
+      continue
+    key = tuple((field.name, getattr(obj, field.attname)) for field in fields)
+    groups.setdefault(key, []).append(obj.pk)
+    changed.append(obj)
+
+  for values, pks in groups.iteritems():
+    model.objects.filter(pk__in=pks).update(**dict(values))
+  for obj in changed:
+    obj._snapshot_fields()
+  if changed:
+    bulk_updated.send(sender=model, instances=changed)
+    logger.info('Bulk updated %d %s in %d queries', len(changed),
+                model.__name__, len(groups))
+  return changed
@@ -0,0 +1,129 @@
+""" Finding and merging duplicate contacts
+
+  Contacts are clustered by blocking keys rather than compared pairwise: each
+  contact produces a few normalized keys and contacts sharing any key end up
+  in the same cluster, so a list is deduped in one pass.
+
+  Contacts are dicts with (at least) firstname, lastname, phone, email and
+  notes - e.g. rows from Donor.objects.values()
+"""
+
+from sjfnw.fund.models import Donor
+
+import re
+
+NOTES_LENGTH = 253
+MIN_PHONE_DIGITS = 7
+
+def phone_key(phone):
+  """ Digits of a phone number, or '' if too short to identify anyone """
+  digits = re.sub(r'\D', '', phone or '')
+  return digits if len(digits) >= MIN_PHONE_DIGITS else ''
+
+def email_key(email):
+  return (email or '').strip().lower()
+
+def contact_keys(contact):
+  """ Blocking keys for a contact. Two contacts are duplicates if they have
+      the same first name and the same last name, phone or email """
+  first = Donor.name_key(contact['firstname'], u'')
+  keys = []
+  if contact['lastname'].strip():
+    keys.append(('name', Donor.name_key(contact['firstname'], contact['lastname'])))
+  email = email_key(contact['email'])
+  if email:
+    keys.append(('email', first, email))
+  phone = phone_key(contact['phone'])
+  if phone:
+    keys.append(('phone', first, phone))
+  return keys
+
+def cluster(contacts, keys=contact_keys):
+  """ Group contacts that share a blocking key (directly or through another
+      contact in the group)
+
+  Args:
+    contacts: iterable of contacts
+    keys: function returning a list of blocking keys for a contact
+
+  Returns:
+    list of clusters (lists of contacts). Clusters are ordered by their first
+    contact and keep the input order within them
+  """
+  clusters = [] # cluster index -> [(position, contact)]; None once merged
+  parent = [] # cluster index -> index it was merged into
+  by_key = {}
+
+  def find(i):
+    while parent[i] != i:
+      parent[i] = parent[parent[i]]
+      i = parent[i]
+    return i
+
+  for position, contact in enumerate(contacts):
+    blocking = keys(contact)
+    found = set(find(by_key[key]) for key in blocking if key in by_key)
+    if found:
+      target = min(found)
+      for other in found - set([target]):
+        clusters[target].extend(clusters[other])
+        clusters[other] = None
+        parent[other] = target
+      clusters[target].append((position, contact))
+    else:
+      target = len(clusters)
+      clusters.append([(position, contact)])
+      parent.append(target)
+    for key in blocking:
+      by_key[key] = target
+
+  return [[contact for position, contact in sorted(group, key=lambda p: p[0])]
+          for group in clusters if group]
+
+def merge(group):
+  """ Combine a cluster into one contact. The first contact's fields win;
+      blanks are filled in order and notes are joined """
+  merged = {'firstname': group[0]['firstname'], 'lastname': u'', 'phone': u'',
+            'email': u'', 'notes': u''}
+  for contact in group:
+    for field in ('lastname', 'phone', 'email'):
+      merged[field] = merged[field] or contact[field]
+    if contact['notes'] and contact['notes'] not in merged['notes']:
+      merged['notes'] = u' '.join(filter(None, [merged['notes'], contact['notes']]))
+  merged['notes'] = merged['notes'][:NOTES_LENGTH]
+  return merged
+
+def dedupe(contacts):
+  """ Merged contacts sorted by name """
+  merged = [merge(group) for group in cluster(contacts)]
+  merged.sort(key=lambda c: (c['firstname'].lower(), c['lastname'].lower()))
+  return merged
+
+def duplicate_keys(donor):
+  """ Blocking key for duplicate donors within a membership. Donors without
+      a last name aren't matched """
+  if not donor['lastname'].strip():
+    return []
+  return [(donor['membership_id'],
+           Donor.name_key(donor['firstname'], donor['lastname']))]
+
+def find_duplicates(donors):
+  """ Find donors entered more than once in a membership
+
+  Args:
+    donors: rows with pk, membership_id, firstname, lastname, talked and
+      has_open_step (see DonorQuerySet.with_open_step), ordered so the donor
+      to keep comes first - e.g. by membership, -talked, pk
+
+  Returns:
+    (remove, kept) - lists of duplicate rows that can be deleted and ones that
+    have been talked to or have an open step, so need a human to decide
+  """
+  remove, kept = [], []
+  for group in cluster(donors, keys=duplicate_keys):
+    for donor in group[1:]:
+      if donor['talked'] or donor['has_open_step']:
+        kept.append(donor)
+      else:
+        remove.append(donor)
+  return remove, kept
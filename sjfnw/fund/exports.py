@@ -0,0 +1,116 @@
+""" CSV exports generated a row at a time
+
+  Rows come from values_list projections with the joins done in the query,
+  so exports don't load model instances or their related objects.
+"""
+
+from django.db.models import Max
+
+from sjfnw.fund.models import Donor, SurveyAnswer
+
+import heapq, itertools, json, logging, unicodecsv
+
+logger = logging.getLogger('sjfnw')
+
+class _RowBuffer(object):
+  """ File-like object that keeps what the csv writer writes until taken """
+  def __init__(self):
+    self.data = []
+
+  def write(self, data):
+    self.data.append(data)
+
+  def take(self):
+    data, self.data = ''.join(self.data), []
+    return data
+
+def stream_csv(header, rows):
+  """ Generator of utf-8 encoded csv lines for a header and iterable of rows """
+  buf = _RowBuffer()
+  writer = unicodecsv.writer(buf)
+  writer.writerow(header)
+  yield buf.take()
+  for row in rows:
+    writer.writerow(row)
+    yield buf.take()
+
+DONOR_HEADER = ['First name', 'Last name', 'Phone', 'Email', 'Member',
+                'Giving Project', 'Amount to ask', 'Asked', 'Promised',
+                'Received - TOTAL', 'Received - Year', 'Received - Amount',
+                'Received - Year', 'Received - Amount',
+                'Received - Year', 'Received - Amount', 'Notes',
+                'Likelihood of joining a GP', 'Reasons for donating']
+
+DONOR_COLUMNS = ('firstname', 'lastname', 'phone', 'email',
+                 'membership__member__first_name', 'membership__member__last_name',
+                 'membership__giving_project__title',
+                 'membership__giving_project__fundraising_deadline',
+                 'amount', 'asked', 'promised', 'received_this', 'received_next',
+                 'received_afternext', 'notes', 'likely_to_join', 'promise_reason')
+
+def donor_rows(queryset):
+  """ Export rows for a Donor queryset, read with a single joined query """
+  likely_to_join = dict(Donor.LIKELY_TO_JOIN_CHOICES)
+  count = 0
+  for (first, last, phone, email, member_first, member_last, gp_title,
+       deadline, amount, asked, promised, received_this, received_next,
+       received_afternext, notes, likely, reasons) in (
+           queryset.values_list(*DONOR_COLUMNS).iterator()):
+    year = deadline.year
+    count += 1
+    yield [first, last, phone, email, member_first + u' ' + member_last,
+           gp_title + u' ' + unicode(year), amount, asked, promised,
+           received_this + received_next + received_afternext,
+           year, received_this, year + 1, received_next, year + 2,
+           received_afternext, notes, likely_to_join.get(likely, likely),
+           u', '.join(json.loads(reasons))]
+  logger.info(str(count) + ' donors exported')
+
+def donor_csv(queryset):
+  """ Generator of csv lines for a Donor queryset """
+  return stream_csv(DONOR_HEADER, donor_rows(queryset))
+
+SURVEY_COLUMNS = ('response', 'response__date', 'response__gp_survey',
+                  'response__gp_survey__giving_project__title',
+                  'response__gp_survey__survey__title', 'question', 'answer')
+
+LEGACY_SURVEY_COLUMNS = ('pk', 'date', 'gp_survey',
+                         'gp_survey__giving_project__title',
+                         'gp_survey__survey__title', 'responses')
+
+def survey_response_csv(queryset):
+  """ Generator of csv lines for a SurveyResponse queryset: one row per
+      response with its questions & answers, read from one joined query.
+      Responses without SurveyAnswers (not yet converted by
+      rebuild_survey_answers) are read from their json """
+  answers = SurveyAnswer.objects.filter(response__in=queryset)
+  last = answers.aggregate(last=Max('question_index'))['last']
+  pairs = 0 if last is None else last + 1
+
+  legacy = []
+  for (response_id, date, gp_survey_id, gp_title, survey_title,
+       responses) in (queryset.filter(answers__isnull=True).order_by('pk')
+                      .values_list(*LEGACY_SURVEY_COLUMNS)):
+    row = [date, gp_survey_id, gp_title, survey_title] + json.loads(responses)
+    legacy.append((response_id, row))
+    pairs = max(pairs, (len(row) - 4) // 2)
+  if legacy:
+    logger.warning('Exporting %d survey responses without SurveyAnswers',
+                   len(legacy))
+
+  header = ['Date', 'Survey ID', 'Giving Project', 'Survey']
+  header += ['Question', 'Answer'] * pairs
+
+  rows = answers.order_by('response', 'question_index').values_list(*SURVEY_COLUMNS)
+  def answered_rows():
+    for response_id, group in itertools.groupby(rows.iterator(), lambda row: row[0]):
+      row = None
+      for (response_id, date, gp_survey_id, gp_title, survey_title,
+           question, answer) in group:
+        row = row or [date, gp_survey_id, gp_title, survey_title]
+        row += [question, answer]
+      yield response_id, row
+
+  # both are ordered by response id
+  merged = heapq.merge(answered_rows(), iter(legacy))
+  return stream_csv(header, (row for response_id, row in merged))
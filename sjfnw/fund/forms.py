@@ -69,8 +69,7 @@ class MassDonor(MassDonorPre):
 
 
 class DonorEstimates(forms.Form):
-  donor = forms.ModelChoiceField(queryset=models.Donor.objects.all(),
-                                 widget=forms.HiddenInput())
+  donor = forms.IntegerField(widget=forms.HiddenInput()) # donor id
   amount = IntegerCommaField(label='*Estimated donation ($)',
                              widget=forms.TextInput(attrs={'class':'tq'}))
   likelihood = forms.IntegerField(label='*Estimated likelihood (%)',
@@ -86,8 +85,7 @@ class MassStep(forms.Form):
   description = forms.CharField(
       max_length=255, required=False,
       widget=forms.TextInput(attrs={'onfocus':'showSuggestions(this.id)'}))
-  donor = forms.ModelChoiceField(queryset=models.Donor.objects.all(),
-                                 widget=forms.HiddenInput())
+  donor = forms.IntegerField(widget=forms.HiddenInput()) # donor id
 
   def clean(self): #date/desc pair validation
     cleaned_data = super(MassStep, self).clean()
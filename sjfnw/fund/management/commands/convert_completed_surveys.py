@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from sjfnw.fund.models import GPSurvey, Membership, SurveyCompletion, survey_cache
+
+import json
+
+class Command(BaseCommand):
+
+  help = ('Creates SurveyCompletions from the json lists in '
+          'Membership.completed_surveys. Safe to run more than once.')
+
+  def handle(self, *args, **options):
+    existing = set(SurveyCompletion.objects.values_list('membership_id', 'gp_survey_id'))
+    gp_surveys = set(GPSurvey.objects.values_list('pk', flat=True))
+    completions = []
+    ships = (Membership.objects.exclude(completed_surveys='[]')
+                               .values_list('pk', 'completed_surveys'))
+    for ship_id, completed in ships:
+      for gp_survey_id in json.loads(completed):
+        if gp_survey_id in gp_surveys and (ship_id, gp_survey_id) not in existing:
+          completions.append(SurveyCompletion(membership_id=ship_id,
+                                              gp_survey_id=gp_survey_id))
+          existing.add((ship_id, gp_survey_id))
+    SurveyCompletion.objects.bulk_create(completions)
+    # bulk_create skips the signals that clear cached pending surveys
+    survey_cache.invalidate(*[completion.membership_id for completion in completions])
+    self.stdout.write('Created ' + str(len(completions)) + ' survey completions.\n')
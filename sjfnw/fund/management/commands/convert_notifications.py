@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from sjfnw.fund.models import Membership, Notification
+
+import json
+
+class Command(BaseCommand):
+
+  help = ('Moves html left in Membership.notifications into Notifications and '
+          'clears the field.')
+
+  def handle(self, *args, **options):
+    ships = Membership.objects.exclude(notifications='')
+    notifications = [Notification(membership_id=ship_id, kind=Notification.HTML,
+                                  payload=json.dumps({'html': html}))
+                     for ship_id, html in ships.values_list('pk', 'notifications')]
+    Notification.objects.bulk_create(notifications)
+    ships.update(notifications='')
+    self.stdout.write('Converted ' + str(len(notifications)) + ' notifications.\n')
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from sjfnw.fund.models import GivingProject, PreApprovedEmail
+
+class Command(BaseCommand):
+
+  help = ('Moves emails in GivingProject.pre_approved into PreApprovedEmail '
+          'and clears the field. Entries that aren\'t emails are listed.')
+
+  def handle(self, *args, **options):
+    projects = GivingProject.objects.exclude(pre_approved='')
+    total = 0
+    for gp_id, pre_approved in projects.values_list('pk', 'pre_approved'):
+      emails, invalid = PreApprovedEmail.parse(pre_approved)
+      existing = set(PreApprovedEmail.objects.filter(giving_project_id=gp_id)
+                     .values_list('email', flat=True))
+      PreApprovedEmail.objects.bulk_create(
+          [PreApprovedEmail(giving_project_id=gp_id, email=email)
+           for email in emails if email not in existing])
+      total += len(emails)
+      if invalid:
+        self.stdout.write('Project ' + str(gp_id) + ' - skipped invalid: ' +
+                          ', '.join(invalid) + '\n')
+    projects.update(pre_approved='')
+    self.stdout.write('Converted ' + str(total) + ' pre-approved emails.\n')
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from sjfnw.fund.exports import donor_csv
+from sjfnw.fund.models import Donor
+
+from optparse import make_option
+
+class Command(BaseCommand):
+
+  args = '[giving project id ...]'
+  help = ('Writes donors as CSV (same columns as the admin export), streaming '
+          'rows so large exports use constant memory. Limit to specific giving '
+          'projects by passing their ids.')
+  option_list = BaseCommand.option_list + (
+      make_option('--output', dest='output', default=None,
+                  help='File to write to instead of stdout'),
+  )
+
+  def handle(self, *args, **options):
+    donors = Donor.objects.order_by('membership__giving_project', 'membership', 'pk')
+    if args:
+      donors = donors.filter(membership__giving_project_id__in=args)
+    out = open(options['output'], 'wb') if options['output'] else self.stdout
+    try:
+      for line in donor_csv(donors):
+        out.write(line)
+    finally:
+      if options['output']:
+        out.close()
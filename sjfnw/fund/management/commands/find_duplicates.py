@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from sjfnw.fund.views import find_duplicates_chunk
+
+from optparse import make_option
+
+class Command(BaseCommand):
+
+  help = ('Deletes duplicate donors (same membership and name) in chunks of '
+          'memberships. Use --dry-run to report them without deleting and '
+          '--after to resume after a membership id.')
+  option_list = BaseCommand.option_list + (
+      make_option('--dry-run', action='store_true', dest='dry_run',
+                  default=False, help='Report duplicates without deleting'),
+      make_option('--after', type='int', dest='after', default=0,
+                  help='Start after this membership id'),
+  )
+
+  def handle(self, *args, **options):
+    report = find_duplicates_chunk(after=options['after'],
+                                   dry_run=options['dry_run'])
+    self.stdout.write('%s %d duplicate donors in %d memberships. %d more '
+                      'matched but were talked to or have a step. Last '
+                      'membership checked: %d\n' % (
+        'Found' if report['dry_run'] else 'Deleted', report['deleted'],
+        len(report['ships']), report['kept'], report['after']))
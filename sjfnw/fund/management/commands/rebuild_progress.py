@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from sjfnw.fund.models import Membership, MembershipProgress
+
+class Command(BaseCommand):
+
+  args = '[giving project id ...]'
+  help = ('Recalculates MembershipProgress totals from donors. Limit to '
+          'specific giving projects by passing their ids.')
+
+  def handle(self, *args, **options):
+    ships = Membership.objects.all()
+    if args:
+      ships = ships.filter(giving_project_id__in=args)
+    count = 0
+    for ship_id in ships.values_list('pk', flat=True):
+      MembershipProgress.rebuild(ship_id)
+      count += 1
+    self.stdout.write('Rebuilt progress for ' + str(count) + ' memberships.\n')
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from sjfnw.fund.models import GPSurvey, SurveyAnswerCount
+
+class Command(BaseCommand):
+
+  args = '[gp survey id ...]'
+  help = ('Rewrites SurveyAnswers from survey responses and recalculates '
+          'SurveyAnswerCounts. Limit to specific GP surveys by passing their ids.')
+
+  def handle(self, *args, **options):
+    gp_surveys = GPSurvey.objects.select_related('survey')
+    if args:
+      gp_surveys = gp_surveys.filter(pk__in=args)
+    count = 0
+    for gp_survey in gp_surveys:
+      for response in gp_survey.surveyresponse_set.all():
+        response.gp_survey = gp_survey
+        response.write_answers()
+        count += 1
+      SurveyAnswerCount.rebuild(gp_survey)
+    self.stdout.write('Rebuilt answers for ' + str(count) + ' responses.\n')
@@ -1,33 +1,39 @@
-﻿from django.core.management.base import BaseCommand
+﻿from django.core.management.base import BaseCommand, CommandError
 from django.utils import timezone
-from sjfnw.fund.models import Step, Membership
+from sjfnw.fund.models import Step, StoryTally, day_range
 import datetime
 
 class Command(BaseCommand):
 
-  help = 'Runs update story for missed days 6-13 to 6-14 (edit file to change the dates)'
+  args = 'start_date [end_date]'
+  help = ('Rebuilds step tallies and news stories for each day from start_date '
+          'to end_date (default today), inclusive. Dates are YYYY-MM-DD.')
 
   def handle(self, *args, **options):
-    self.stdout.write('Beginning.\n')
-    start = datetime.datetime.strptime('2013-06-13 03:04:01',
-                                       '%Y-%m-%d %H:%M:%S')
-    start = timezone.make_aware(start, timezone.get_current_timezone())
-    end = datetime.datetime.strptime('2013-06-14 05:06:01',
-                                     '%Y-%m-%d %H:%M:%S')
-    end = timezone.make_aware(end, timezone.get_current_timezone())
-    # Get all memberships who completed a step within this range
-    ships = (Step.objects.filter(completed__range=(start, end))
-                        .values_list('donor__membership', flat=True)
-                        .distinct())
+    if not 1 <= len(args) <= 2:
+      raise CommandError('Usage: update_stories ' + self.args)
+    try:
+      start = datetime.datetime.strptime(args[0], '%Y-%m-%d').date()
+      if len(args) > 1:
+        end = datetime.datetime.strptime(args[1], '%Y-%m-%d').date()
+      else:
+        end = timezone.localtime(timezone.now()).date()
+    except ValueError:
+      raise CommandError('Dates must be in YYYY-MM-DD format')
 
-    for ship_id in ships:
-      try:
-        ship = Membership.objects.get(id = ship_id)
-      except:
-        self.stderr.write('Trying to update story for non-existent member ' + unicode(ship_id))
-      self.stdout.write('creating stories for ' + unicode(ship_id) + '\n')
-      for i in range(0, 6):
-        ship.update_story(start + datetime.timedelta(days=i))
-
-    self.stdout.write('Script complete.\n')
+    count = 0
+    day = start
+    while day <= end:
+      # memberships that completed a step that day
+      day_start, day_end = day_range(day)
+      ships = (Step.objects.filter(completed__gte=day_start, completed__lt=day_end)
+                           .values_list('donor__membership', flat=True)
+                           .distinct())
+      for ship_id in ships:
+        tally = StoryTally.rebuild(ship_id, day)
+        if tally:
+          tally.write_story()
+          count += 1
+      day += datetime.timedelta(days=1)
 
+    self.stdout.write('Updated ' + str(count) + ' stories.\n')
@@ -14,7 +14,9 @@ class MembershipMiddleware(object):
     if member had no membership for that proj (approved or not)
       -> first membership in query, 0 if no memberships exist
     if current is not approved, but 1+ other memberships are
-      -> first approved membership in query
+      -> request.membership is the first approved membership in query, but
+         current is left alone - registered reads it right after
+         registration to check pre-approval
 
   resulting request vars
     .membership_status
@@ -24,6 +26,10 @@ class MembershipMiddleware(object):
       3 = approved :) (current was, or current was changed -> is now)
     .member - present in 1-3
     .membership - present in 2-3
+
+  The result is cached per member (see models.membership_cache) and the
+  member id kept in the session, so most requests resolve without queries.
+  The cache version is bumped when memberships or the member change.
   """
 
   def process_view(self, request, view_func, view_args, view_kwargs):
@@ -33,46 +39,69 @@ class MembershipMiddleware(object):
         request.membership_status = 0
         request.membership = None
 
+        member_id = request.session.get('fund_member_id')
+        if member_id:
+          version, entry = models.membership_cache.get(member_id)
+          if entry and entry['username'] == request.user.username:
+            request.membership_status = entry['status']
+            request.membership = entry['membership']
+            return None
+
         try:
           member = models.Member.objects.get(email=request.user.username) #q3
           #logger.info(member)
         except models.Member.DoesNotExist: #no member object
           logger.warning('Custom middleware: No member object with email of '+request.user.username)
+          request.session.pop('fund_member_id', None)
           return None
 
-        try: # get current membership
-          membership = models.Membership.objects.select_related().get(member = member, pk=member.current) #q4
-          request.membership_status = 3
-          request.membership = membership
-          logger.info(membership)
-        except models.Membership.DoesNotExist: #current is wrong
-          all = member.membership_set.all()
-          if all: #if 1+ memberships, update current & set ship var
-            logger.warning('Custom middleware: Current was wrong even though memberships exist')
-            request.membership_status = 3
-            request.membership = all[0] ###
-            membership = all[0]
-            member.current = membership.pk
-            member.save()
-          else: #no memberships
-            logger.info('%s (no memberships)')
-            member.current = 0
-            member.save()
-            request.membership_status = 1
-            return None
-
-        #membership exists, status is 3
-        if membership.approved == False: #current not approved
-          logger.warning('Current membership not approved')
-          ships = member.membership_set.filter(approved=True)
-          if ships: #switch default to their first approved gp
-            request.membership_status = 3
-            request.membership = ships[0]
-            member.current = membership.pk
-            member.save()
-          else: #no approved GPs
-            request.membership_status = 2
+        # read before resolving so a concurrent change leaves this stale
+        version = models.membership_cache.version(member.pk)
+        self.resolve(request, member)
+        models.membership_cache.set(member.pk, version, {
+          'username': request.user.username,
+          'status': request.membership_status,
+          'membership': request.membership
+        })
+        if member_id != member.pk:
+          request.session['fund_member_id'] = member.pk
       else:
         request.membership_status = -1 #not logged in
     return None
 
+  def resolve(self, request, member):
+    """ Sets membership vars for a member, fixing member.current if needed """
+    memberships = member.membership_set.select_related('giving_project')
+    try: # get current membership
+      membership = memberships.get(pk=member.current) #q4
+      membership.member = member
+      request.membership_status = 3
+      request.membership = membership
+      logger.info(membership)
+    except models.Membership.DoesNotExist: #current is wrong
+      all = memberships.all()
+      if all: #if 1+ memberships, update current & set ship var
+        logger.warning('Custom middleware: Current was wrong even though memberships exist')
+        membership = all[0]
+        membership.member = member
+        request.membership_status = 3
+        request.membership = membership
+        member.current = membership.pk
+        member.save()
+      else: #no memberships
+        logger.info('%s (no memberships)')
+        member.current = 0
+        member.save()
+        request.membership_status = 1
+        return
+
+    #membership exists, status is 3
+    if membership.approved == False: #current not approved
+      logger.warning('Current membership not approved')
+      ships = memberships.filter(approved=True)
+      if ships: #use their first approved gp for this request
+        ships[0].member = member
+        request.membership_status = 3
+        request.membership = ships[0]
+      else: #no approved GPs
+        request.membership_status = 2
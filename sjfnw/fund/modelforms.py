@@ -1,9 +1,10 @@
 from django.db import models
-from django.forms import ModelForm, widgets, ValidationError
+from django.forms import CharField, ModelForm, widgets, ValidationError
 from django.utils import timezone
 
 from sjfnw.forms import IntegerCommaField
-from sjfnw.fund.models import Donor, Step, Survey, GPSurvey, GivingProject, SurveyResponse
+from sjfnw.fund.models import (Donor, Step, Survey, GPSurvey, GivingProject,
+    PreApprovedEmail, SurveyResponse)
 
 import json
 
@@ -226,7 +227,30 @@ class GivingProjectAdminForm(ModelForm):
                                 'the group. If 0, it will not be displayed to '
                                 'members and they won\'t see a group progress '
                                 'chart for money raised.'))
+  pre_approved_emails = CharField(
+      label='Pre-approved emails', required=False,
+      widget=widgets.Textarea(attrs={'rows': 6}),
+      help_text=('Anyone who registers for this project using one of these '
+                 'emails will have their membership approved automatically. '
+                 'Paste emails separated by commas, spaces or new lines; '
+                 'they\'re saved one per line.'))
 
   class Meta:
     model = GivingProject
+    exclude = ('pre_approved',)
+
+  def __init__(self, *args, **kwargs):
+    super(GivingProjectAdminForm, self).__init__(*args, **kwargs)
+    if self.instance.pk:
+      self.initial['pre_approved_emails'] = '\n'.join(
+          self.instance.pre_approved_emails.values_list('email', flat=True))
+
+  def clean_pre_approved_emails(self):
+    """ Parse into a list of emails, rejecting the whole list if any entry
+        isn't an email so nothing is dropped silently """
+    emails, invalid = PreApprovedEmail.parse(
+        self.cleaned_data.get('pre_approved_emails'))
+    if invalid:
+      raise ValidationError('Not valid emails: ' + ', '.join(invalid))
+    return emails
 
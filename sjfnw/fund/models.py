@@ -1,14 +1,35 @@
 ﻿from django.contrib.humanize.templatetags.humanize import intcomma
-from django.core.validators import MaxValueValidator
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.core.validators import MaxValueValidator, validate_email
+from django.db import models, transaction
 from django.utils import timezone
 
+from sjfnw.fund import blocks, bulk
 from sjfnw.fund.utils import NotifyApproval
+from sjfnw.utils import ChangeTrackingMixin, VersionedCache
 
-import datetime, json, logging
+import datetime, json, logging, re
 
 logger = logging.getLogger('sjfnw')
 
+class GivingProjectQuerySet(models.query.QuerySet):
+
+  def with_progress(self):
+    """ Annotate each project with the sum of its memberships' progress
+        totals, as progress_<field> for each MembershipProgress.TOTAL_FIELDS.
+        Done in a single grouped query. """
+    return self.annotate(**dict(
+        ('progress_' + field, models.Sum('membership__progress__' + field))
+        for field in MembershipProgress.TOTAL_FIELDS))
+
+class GivingProjectManager(models.Manager):
+
+  def get_query_set(self):
+    return GivingProjectQuerySet(self.model, using=self._db)
+
+  def with_progress(self):
+    return self.get_query_set().with_progress()
+
 class GivingProject(models.Model):
   title = models.CharField(max_length=255)
   public = models.BooleanField(default=True,
@@ -16,12 +37,9 @@ class GivingProject(models.Model):
                                ' the dropdown menu for members registering or '
                                'adding a project to their account.'))
 
-  pre_approved = models.TextField(blank=True,
-      help_text=('List of member emails, separated by commas.  Anyone who '
-      'registers using an email on this list will have their account '
-      'automatically approved.  IMPORTANT: Any syntax error can make this '
-      'feature stop working; in that case memberships will default to '
-      'requiring manual approval by an administrator.'))
+  # comma separated emails. No longer used - see PreApprovedEmail and
+  # ./manage.py convert_pre_approved
+  pre_approved = models.TextField(blank=True)
 
   #fundraising
   fundraising_training = models.DateTimeField(
@@ -52,6 +70,8 @@ class GivingProject(models.Model):
   surveys = models.ManyToManyField('Survey', through = 'GPSurvey',
                                    null=True, blank=True)
 
+  objects = GivingProjectManager()
+
   class Meta:
     ordering = ['-fundraising_deadline']
 
@@ -65,17 +85,123 @@ class GivingProject(models.Model):
   def require_estimates(self):
     return self.fundraising_training <= timezone.now()
 
+  def get_progress(self):
+    """ Project-wide progress totals, keyed by MembershipProgress.TOTAL_FIELDS
+
+    Uses annotations from GivingProject.objects.with_progress() when present,
+    otherwise runs that query for this project. """
+    if not hasattr(self, 'progress_contacts'):
+      annotated = GivingProject.objects.with_progress().get(pk=self.pk)
+      for field in MembershipProgress.TOTAL_FIELDS:
+        setattr(self, 'progress_' + field,
+                getattr(annotated, 'progress_' + field))
+    return dict((field, getattr(self, 'progress_' + field) or 0)
+                for field in MembershipProgress.TOTAL_FIELDS)
+
   def estimated(self):
-    donors = Donor.objects.filter(membership__giving_project=self)
-    estimated = 0
-    for donor in donors:
-      estimated += donor.estimated()
-    return estimated
+    return self.get_progress()['estimated']
+
+class PreApprovedEmail(models.Model):
+  """ Email whose memberships in a project are approved on registration """
+  giving_project = models.ForeignKey(GivingProject,
+                                     related_name='pre_approved_emails')
+  email = models.CharField(max_length=100) # lowercase
+
+  class Meta:
+    ordering = ('email',)
+    unique_together = ('giving_project', 'email')
+
+  def __unicode__(self):
+    return self.email
+
+  @staticmethod
+  def parse(text):
+    """ Read emails pasted from a spreadsheet or email client - separated by
+        commas, semicolons or whitespace, optionally as Name <email>
+
+    Returns:
+      (emails, invalid) - lists of lowercased, deduplicated valid emails and
+      the entries that weren't emails, both in the order given
+    """
+    text = re.sub(r'[^,;<>\n]*<([^<>]*)>', r' \1 ', text or '')
+    emails, invalid = [], []
+    for entry in re.split(r'[\s,;]+', text):
+      if not entry:
+        continue
+      email = entry.lower()
+      try:
+        validate_email(email)
+      except ValidationError:
+        invalid.append(entry)
+        continue
+      if email not in emails:
+        emails.append(email)
+    return emails, invalid
+
+  @classmethod
+  def is_approved(cls, giving_project_id, email):
+    return cls.objects.filter(giving_project_id=giving_project_id,
+                              email=email.lower()).exists()
+
+  @classmethod
+  def replace(cls, giving_project_id, emails):
+    """ Make a project's list match emails (from parse)
+
+    Returns:
+      (added, removed) counts
+    """
+    existing = set(cls.objects.filter(giving_project_id=giving_project_id)
+                   .values_list('email', flat=True))
+    removed = existing.difference(emails)
+    if removed:
+      cls.objects.filter(giving_project_id=giving_project_id,
+                         email__in=removed).delete()
+    added = [cls(giving_project_id=giving_project_id, email=email)
+             for email in emails if email not in existing]
+    cls.objects.bulk_create(added)
+    return len(added), len(removed)
+
+def overdue_cutoff():
+  """ Incomplete steps dated before this are considered overdue """
+  return timezone.now().date() - datetime.timedelta(days=1)
+
+class MembershipQuerySet(models.query.QuerySet):
+
+  def with_progress(self):
+    """ Annotate each membership with its MembershipProgress totals as
+        progress_<field> (None if the rollup hasn't been built) """
+    return self.annotate(**dict(
+        ('progress_' + field, models.Sum('progress__' + field))
+        for field in MembershipProgress.TOTAL_FIELDS))
+
+  def with_overdue_count(self):
+    """ Annotate each membership with overdue_count, the number of overdue
+        steps, using a correlated subquery """
+    ship_table = Membership._meta.db_table
+    sql = ('SELECT COUNT(*) FROM %s INNER JOIN %s ON %s.donor_id = %s.id '
+           'WHERE %s.membership_id = %s.id AND %s.completed IS NULL '
+           'AND %s.date < %%s') % (
+             Step._meta.db_table, Donor._meta.db_table, Step._meta.db_table,
+             Donor._meta.db_table, Donor._meta.db_table, ship_table,
+             Step._meta.db_table, Step._meta.db_table)
+    return self.extra(select={'overdue_count': sql},
+                      select_params=(overdue_cutoff(),))
+
+class MembershipManager(models.Manager):
+
+  def get_query_set(self):
+    return MembershipQuerySet(self.model, using=self._db)
+
+  def with_progress(self):
+    return self.get_query_set().with_progress()
+
+  def with_overdue_count(self):
+    return self.get_query_set().with_overdue_count()
 
 class Member(models.Model):
   email = models.EmailField(max_length=100, unique=True)
-  first_name = models.CharField(max_length=100)
-  last_name = models.CharField(max_length=100)
+  first_name = models.CharField(max_length=100, db_index=True) # indexed for
+  last_name = models.CharField(max_length=100, db_index=True)  # admin search
 
   giving_project = models.ManyToManyField(GivingProject, through='Membership')
   current = models.IntegerField(default=0)
@@ -86,14 +212,15 @@ class Member(models.Model):
   class Meta:
     ordering = ['first_name', 'last_name']
 
-class Membership(models.Model): #relationship b/n member and gp
+class Membership(ChangeTrackingMixin, models.Model): #relationship b/n member and gp
   giving_project = models.ForeignKey(GivingProject)
   member = models.ForeignKey(Member)
   approved = models.BooleanField(default=False)
   leader = models.BooleanField(default=False)
 
   copied_contacts = models.BooleanField(default=False)
-  #json encoded list of gp eval surveys completed
+  # json encoded list of gp eval surveys completed. No longer updated - see
+  # SurveyCompletion and ./manage.py convert_completed_surveys
   completed_surveys = models.CharField(max_length=255, default='[]')
 
   emailed = models.DateField(
@@ -103,8 +230,12 @@ class Membership(models.Model): #relationship b/n member and gp
       blank=True, null=True,
       help_text=('Last activity by this user on this membership.'))
 
+  # html shown on the home page. No longer written - see Notification and
+  # ./manage.py convert_notifications
   notifications = models.TextField(default='', blank=True)
 
+  objects = MembershipManager()
+
   class Meta:
     ordering = ['member']
     unique_together = ('giving_project', 'member')
@@ -113,48 +244,62 @@ class Membership(models.Model): #relationship b/n member and gp
     return unicode(self.member)+u', '+unicode(self.giving_project)
 
   def save(self, skip=False, *args, **kwargs):
-    if not skip:
-      try:
-        previous = Membership.objects.get(id=self.id)
-        logger.debug('Previously: ' + str(previous.approved) + ', now: ' +
-                      str(self.approved))
-        if self.approved and not previous.approved: #newly approved!
-          logger.debug('Detected approval on save for ' + unicode(self))
-          NotifyApproval(self)
-      except Membership.DoesNotExist:
-        pass
+    if not skip and self.approved and self.pk:
+      was_approved = self.loaded_value('approved')
+      if was_approved is None: # not loaded from the db
+        previous = Membership.objects.filter(pk=self.pk).values_list('approved', flat=True)
+        was_approved = previous[0] if previous else True
+      if not was_approved: #newly approved!
+        logger.debug('Detected approval on save for ' + unicode(self))
+        NotifyApproval(self)
+    new = self.pk is None
     super(Membership, self).save(*args, **kwargs)
+    if new: # start with an empty rollup so project totals include it
+      MembershipProgress(membership=self).save()
 
   def get_progress(self):
-    """ Aggregate donors to return progress metrics
-        (estimated, promised, received by year)
+    """ Return progress metrics (estimated, promised, received by year)
+        from the membership's MembershipProgress rollup. Uses annotations
+        from Membership.objects.with_progress() when present.
     """
-    progress = {
-      'estimated': 0,
-      'promised': 0,
-      'received_this': 0,
-      'received_next': 0,
-      'received_afternext': 0
+    if getattr(self, 'progress_contacts', None) is not None:
+      progress = MembershipProgress(**dict(
+          (field, getattr(self, 'progress_' + field))
+          for field in MembershipProgress.TOTAL_FIELDS))
+    else:
+      progress = MembershipProgress.get_for(self.pk)
+    return {
+      'estimated': progress.estimated,
+      'promised': progress.promised,
+      'received_this': progress.received_this,
+      'received_next': progress.received_next,
+      'received_afternext': progress.received_afternext,
+      'received_total': progress.received_total()
     }
-    donors = self.donor_set.all()
-
-    for donor in donors:
-      progress['estimated'] += donor.estimated()
-      if donor.promised:
-        progress['promised'] += donor.promised
-      progress['received_this'] = donor.received_this
-      progress['received_next'] = donor.received_next
-      progress['received_afternext'] = donor.received_afternext
 
-    progress['received_total'] = (progress['received_this'] +
-                                 progress['received_next'] +
-                                 progress['received_afternext'])
-
-    return progress
+  def pending_survey(self):
+    """ Id of the earliest GP survey that's due and hasn't been completed, or
+    None. Cached until a survey is completed or the next one comes due """
+    version, cached = survey_cache.get(self.pk)
+    if cached is None or cached['until'] and cached['until'] <= timezone.now():
+      survey_cache.count(self.pk, 'misses')
+      # NOT IN subquery on SurveyCompletion
+      upcoming = list(GPSurvey.objects
+          .filter(giving_project_id=self.giving_project_id)
+          .exclude(completions__membership=self)
+          .order_by('date').values_list('pk', 'date')[:1])
+      cached = {'pending': None, 'until': None}
+      if upcoming and upcoming[0][1] <= timezone.now():
+        cached['pending'] = upcoming[0][0]
+      elif upcoming:
+        cached['until'] = upcoming[0][1]
+      survey_cache.set(self.pk, version, cached)
+    else:
+      survey_cache.count(self.pk, 'hits')
+    return cached['pending']
 
   def overdue_steps(self, get_next=False): # 1 db query
-    cutoff = timezone.now().date() - datetime.timedelta(days=1)
-    steps = Step.objects.filter(donor__membership = self, completed__isnull = True, date__lt = cutoff).order_by('-date')
+    steps = Step.objects.filter(donor__membership = self, completed__isnull = True, date__lt = overdue_cutoff()).order_by('-date')
     count = steps.count()
     if not get_next:
       return count
@@ -164,72 +309,46 @@ class Membership(models.Model): #relationship b/n member and gp
       return count, steps[0]
 
   def update_story(self, timestamp):
-
+    """ Rebuild and write the story for the (local) day of timestamp.
+        Stories are normally written from StoryTally as steps complete """
     logger.info('update_story running for membership ' + str(self.pk) +
                  ' from ' + str(timestamp))
+    tally = StoryTally.rebuild(self.pk, timezone.localtime(timestamp).date())
+    if tally:
+      tally.write_story()
+    else:
+      logger.warning('update story called on ' + str(self.pk) + ' but there are no steps')
 
-    #today's range
-    today_min = timestamp.replace(hour=0, minute=0, second=0)
-    today_max = timestamp.replace(hour=23, minute=59, second=59)
 
-    #check for steps
-    logger.debug("Getting steps")
-    steps = Step.objects.filter(
-        completed__range=(today_min, today_max),
-        donor__membership = self).select_related('donor')
-    if not steps:
-      logger.warning('update story called on ' + str(self.pk) + 'but there are no steps')
-      return
+def open_step_sql():
+  """ SQL condition: the donor row has an incomplete step """
+  return ('EXISTS (SELECT 1 FROM %(step)s WHERE %(step)s.donor_id = %(donor)s.id '
+          'AND %(step)s.completed IS NULL)' % {
+            'step': Step._meta.db_table, 'donor': Donor._meta.db_table})
 
-    #get or create newsitem object
-    logger.debug('Checking for story with date between ' + str(today_min) +
-                  ' and ' + str(today_max))
-    search = self.newsitem_set.filter(date__range=(today_min, today_max))
-    if search:
-      story = search[0]
-    else:
-      story = NewsItem(date = timestamp, membership=self, summary = '')
+class DonorQuerySet(models.query.QuerySet):
 
-    #tally today's steps
-    talked, asked, promised = 0, 0, 0
-    talkedlist = [] #for talk counts, don't want to double up
-    askedlist = []
-    for step in steps:
-      logger.debug(unicode(step))
-      if step.asked:
-        asked += 1
-        askedlist.append(step.donor)
-        if step.donor in talkedlist: #if donor counted already, remove
-          talked -= 1
-          talkedlist.remove(step.donor)
-      elif not step.donor in talkedlist and not step.donor in askedlist:
-        talked += 1
-        talkedlist.append(step.donor)
-      if step.promised and step.promised > 0:
-        promised += step.promised
-    summary = self.member.first_name
-    if talked > 0:
-      summary += u' talked to ' + unicode(talked) + (u' people' if talked>1 else u' person')
-      if asked > 0:
-        if promised > 0:
-          summary += u', asked ' + unicode(asked)
-        else:
-          summary += u' and asked ' + unicode(asked)
-    elif asked > 0:
-      summary += u' asked ' + unicode(asked) + (u' people' if asked>1 else u' person')
-    else:
-      logger.error('News update with 0 talked, 0 asked. Story pk: ' + str(story.pk))
-    if promised > 0:
-      summary += u' and got $' + unicode(intcomma(promised)) + u' in promises'
-    summary += u'.'
-    logger.info(summary)
-    story.summary = summary
-    story.updated = timezone.now()
-    story.save()
-    logger.info('Story saved')
+  def with_open_step(self):
+    """ Annotate each donor with has_open_step (whether it has an incomplete
+        step), using a correlated subquery """
+    return self.extra(select={'has_open_step': open_step_sql()})
+
+  def without_open_step(self):
+    """ Donors that have no incomplete step """
+    return self.extra(where=['NOT ' + open_step_sql()])
+
+class DonorManager(models.Manager):
+
+  def get_query_set(self):
+    return DonorQuerySet(self.model, using=self._db)
 
+  def with_open_step(self):
+    return self.get_query_set().with_open_step()
 
-class Donor(models.Model):
+  def without_open_step(self):
+    return self.get_query_set().without_open_step()
+
+class Donor(ChangeTrackingMixin, models.Model):
   LIKELY_TO_JOIN_CHOICES = choices = (
       ('', '---------'),
       (3, '3 - Definitely'),
@@ -268,6 +387,8 @@ class Donor(models.Model):
   email = models.EmailField(max_length=100, blank=True)
   notes = models.TextField(blank=True)
 
+  objects = DonorManager()
+
   class Meta:
     ordering = ['firstname', 'lastname']
 
@@ -277,6 +398,11 @@ class Donor(models.Model):
     else:
       return self.firstname
 
+  @staticmethod
+  def name_key(firstname, lastname):
+    """ Normalized full name, for finding duplicate contacts """
+    return u' '.join((firstname + u' ' + lastname).lower().split())
+
   def estimated(self):
     if self.amount and self.likelihood:
       return int(self.amount*self.likelihood*.01)
@@ -319,6 +445,194 @@ class Step(models.Model):
     return unicode(self.date.strftime('%m/%d/%y')) + u' -  ' + self.description
 
 
+class MembershipProgress(models.Model):
+  """ Fundraising totals for a membership, kept current as donors change
+
+  Rows are created on first read (see get_for) and then adjusted in place by
+  the Donor signal handlers at the bottom of this file, so reading progress
+  doesn't require loading every donor. ./manage.py rebuild_progress
+  recalculates them from scratch.
+  """
+  membership = models.OneToOneField(Membership, related_name='progress')
+  updated = models.DateTimeField(default=timezone.now)
+
+  contacts = models.IntegerField(default=0)
+  estimated = models.IntegerField(default=0)
+  talked = models.IntegerField(default=0) # talked to, not yet asked
+  asked = models.IntegerField(default=0)
+  promised = models.IntegerField(default=0) # all promises
+  promised_pending = models.IntegerField(default=0) # promised, nothing received
+  received_this = models.IntegerField(default=0)
+  received_next = models.IntegerField(default=0)
+  received_afternext = models.IntegerField(default=0)
+
+  TOTAL_FIELDS = ('contacts', 'estimated', 'talked', 'asked', 'promised',
+                  'promised_pending', 'received_this', 'received_next',
+                  'received_afternext')
+
+  def __unicode__(self):
+    return u'Progress for %s' % self.membership_id
+
+  def received_total(self):
+    return self.received_this + self.received_next + self.received_afternext
+
+  @classmethod
+  def donor_values(cls, donor):
+    """ A single donor's contribution to each of the totals """
+    received = donor.received()
+    return {
+      'contacts': 1,
+      'estimated': donor.estimated(),
+      'talked': 1 if donor.talked and not donor.asked else 0,
+      'asked': 1 if donor.asked else 0,
+      'promised': donor.promised or 0,
+      'promised_pending': (donor.promised or 0) if received == 0 else 0,
+      'received_this': donor.received_this,
+      'received_next': donor.received_next,
+      'received_afternext': donor.received_afternext
+    }
+
+  @classmethod
+  def rebuild(cls, membership_id):
+    """ Recalculate totals for a membership from its donors. Returns the row """
+    totals = dict.fromkeys(cls.TOTAL_FIELDS, 0)
+    for donor in Donor.objects.filter(membership_id=membership_id):
+      for field, value in cls.donor_values(donor).iteritems():
+        totals[field] += value
+
+    try:
+      progress = cls.objects.get(membership_id=membership_id)
+    except cls.DoesNotExist:
+      progress = cls(membership_id=membership_id)
+    for field, value in totals.iteritems():
+      setattr(progress, field, value)
+    progress.updated = timezone.now()
+    progress.save()
+    logger.info('Rebuilt progress for membership ' + str(membership_id))
+    return progress
+
+  @classmethod
+  def get_for(cls, membership_id):
+    """ Get the rollup for a membership, building it if it doesn't exist """
+    try:
+      return cls.objects.get(membership_id=membership_id)
+    except cls.DoesNotExist:
+      return cls.rebuild(membership_id)
+
+  @classmethod
+  def adjust(cls, membership_id, old, new):
+    """ Apply the difference between two donor_values dicts to a membership's
+        totals. Does nothing if the row hasn't been built yet """
+    changes = {}
+    for field in cls.TOTAL_FIELDS:
+      delta = new.get(field, 0) - old.get(field, 0)
+      if delta:
+        changes[field] = models.F(field) + delta
+    if changes:
+      changes['updated'] = timezone.now()
+      cls.objects.filter(membership_id=membership_id).update(**changes)
+
+  @classmethod
+  def adjust_many(cls, changes):
+    """ Apply a batch of donor changes, one update per membership. For writes
+        that skip the Donor signals (bulk_create, update)
+
+    Args:
+      changes: list of (membership_id, old donor_values, new donor_values)
+        - use {} for old when creating, new when deleting
+    """
+    totals = {}
+    for membership_id, old, new in changes:
+      total = totals.setdefault(membership_id, dict.fromkeys(cls.TOTAL_FIELDS, 0))
+      for field in cls.TOTAL_FIELDS:
+        total[field] += new.get(field, 0) - old.get(field, 0)
+    for membership_id, total in totals.iteritems():
+      cls.adjust(membership_id, {}, total)
+
+  @classmethod
+  def fill_missing(cls, giving_project_id):
+    """ Build rollups for any memberships in the project that don't have one
+        (created before the table existed or loaded from fixtures) """
+    missing = Membership.objects.filter(giving_project_id=giving_project_id,
+                                        progress__isnull=True)
+    for ship_id in missing.values_list('pk', flat=True):
+      cls.rebuild(ship_id)
+
+
+class ProgressSnapshot(models.Model):
+  """ End of day fundraising totals for a membership, or for a whole giving
+  project when membership is null. Written nightly by take() for every
+  membership in a project that's still fundraising.
+  """
+  giving_project = models.ForeignKey(GivingProject)
+  membership = models.ForeignKey(Membership, null=True, blank=True)
+  date = models.DateField()
+
+  contacts = models.IntegerField(default=0)
+  talked = models.IntegerField(default=0)
+  asked = models.IntegerField(default=0)
+  promised = models.IntegerField(default=0) # promised, nothing received yet
+  received = models.IntegerField(default=0)
+
+  class Meta:
+    ordering = ('date',)
+    unique_together = ('giving_project', 'membership', 'date')
+
+  def __unicode__(self):
+    return u'Progress on %s' % self.date
+
+  @staticmethod
+  def totals(progress):
+    """ Snapshot values from a dict of MembershipProgress.TOTAL_FIELDS.
+        Promised is promised_pending, as shown on the project page """
+    return {'contacts': progress['contacts'] or 0,
+            'talked': progress['talked'] or 0,
+            'asked': progress['asked'] or 0,
+            'promised': progress['promised_pending'] or 0,
+            'received': ((progress['received_this'] or 0) +
+                         (progress['received_next'] or 0) +
+                         (progress['received_afternext'] or 0))}
+
+  @classmethod
+  def take(cls, date):
+    """ Snapshot every membership (and project) in projects fundraising on
+    date (a local date). Totals come from the rollups, which hold current
+    totals, so this has to run just after the midnight that ends date - see
+    cron.yaml. Running it again for the same date replaces that day's rows.
+
+    Returns:
+      number of rows written
+    """
+    projects = list(GivingProject.objects.filter(fundraising_deadline__gte=date)
+                                         .with_progress())
+    project_ids = [project.pk for project in projects]
+    ships = (MembershipProgress.objects
+        .filter(membership__giving_project_id__in=project_ids)
+        .values('membership_id', 'membership__giving_project_id',
+                *MembershipProgress.TOTAL_FIELDS))
+
+    rows = [cls(giving_project_id=row['membership__giving_project_id'],
+                membership_id=row['membership_id'], date=date, **cls.totals(row))
+            for row in ships]
+    rows += [cls(giving_project=project, date=date,
+                 **cls.totals(project.get_progress()))
+             for project in projects]
+
+    with transaction.commit_on_success():
+      cls.objects.filter(date=date, giving_project_id__in=project_ids).delete()
+      cls.objects.bulk_create(rows)
+    logger.info('Took %d progress snapshots for %s', len(rows), date)
+    return len(rows)
+
+  @classmethod
+  def series(cls, giving_project_id, membership_id=None):
+    """ (date, totals dict) for each day snapshotted, oldest first """
+    fields = ('date', 'contacts', 'talked', 'asked', 'promised', 'received')
+    rows = cls.objects.filter(giving_project_id=giving_project_id,
+                              membership_id=membership_id).values_list(*fields)
+    return [(row[0], dict(zip(fields[1:], row[1:]))) for row in rows]
+
+
 class NewsItem(models.Model):
   date = models.DateTimeField(default=timezone.now())
   updated = models.DateTimeField(default=timezone.now())
@@ -328,6 +642,174 @@ class NewsItem(models.Model):
   def __unicode__(self):
     return unicode(self.summary)
 
+def day_range(date):
+  """ Start and end (exclusive) of a local date, as aware datetimes """
+  start = timezone.make_aware(datetime.datetime.combine(date, datetime.time()),
+                              timezone.get_current_timezone())
+  return start, start + datetime.timedelta(days=1)
+
+class StoryTally(models.Model):
+  """ Running tally of the steps a membership completed in one (local) day
+
+  Each completed step is added as a delta; the day's NewsItem is written
+  from the tally rather than by re-reading the day's steps.
+  """
+  membership = models.ForeignKey(Membership)
+  date = models.DateField()
+  updated = models.DateTimeField(default=timezone.now)
+
+  talked = models.TextField(default='[]') #json list of donor ids
+  asked = models.TextField(default='[]') #json list of donor ids
+  promised = models.TextField(default='{}') #json donor id -> amount
+
+  story = models.OneToOneField(NewsItem, null=True, blank=True,
+                               on_delete=models.SET_NULL)
+
+  class Meta:
+    unique_together = ('membership', 'date')
+
+  def __unicode__(self):
+    return u'%s %s' % (self.membership, self.date)
+
+  def add_step(self, step):
+    """ Add a completed step to the tally (does not save) """
+    talked, asked = set(json.loads(self.talked)), set(json.loads(self.asked))
+    if step.asked:
+      asked.add(step.donor_id)
+    else:
+      talked.add(step.donor_id)
+    self.talked, self.asked = json.dumps(sorted(talked)), json.dumps(sorted(asked))
+    if step.promised:
+      promised = json.loads(self.promised)
+      key = str(step.donor_id)
+      promised[key] = promised.get(key, 0) + step.promised
+      self.promised = json.dumps(promised)
+    if step.completed and step.completed > self.updated:
+      self.updated = step.completed
+
+  def totals(self):
+    """ Returns (talked, asked, promised): donors talked to but not asked,
+        donors asked, total promised """
+    asked = set(json.loads(self.asked))
+    talked = set(json.loads(self.talked)) - asked
+    return len(talked), len(asked), sum(json.loads(self.promised).values())
+
+  def summary(self, name):
+    talked, asked, promised = self.totals()
+    summary = name
+    if talked > 0:
+      summary += u' talked to ' + unicode(talked) + (u' people' if talked>1 else u' person')
+      if asked > 0:
+        if promised > 0:
+          summary += u', asked ' + unicode(asked)
+        else:
+          summary += u' and asked ' + unicode(asked)
+    elif asked > 0:
+      summary += u' asked ' + unicode(asked) + (u' people' if asked>1 else u' person')
+    else:
+      logger.error('News update with 0 talked, 0 asked. Tally pk: ' + str(self.pk))
+    if promised > 0:
+      summary += u' and got $' + unicode(intcomma(promised)) + u' in promises'
+    return summary + u'.'
+
+  def write_story(self):
+    """ Create or update the day's NewsItem from the tally """
+    if self.totals() == (0, 0, 0):
+      logger.warning('No steps tallied for ' + unicode(self))
+      return
+    story = self.story or NewsItem(membership_id=self.membership_id,
+                                   date=self.updated)
+    story.summary = self.summary(self.membership.member.first_name)
+    story.updated = timezone.now()
+    story.save()
+    if self.story_id != story.pk:
+      self.story = story
+      self.save()
+    logger.info(story.summary)
+
+  @classmethod
+  @transaction.commit_on_success
+  def record(cls, step):
+    """ Add a newly completed step to its day's tally. Returns the tally """
+    date = timezone.localtime(step.completed).date()
+    membership_id = step.donor.membership_id
+    tally, created = cls.objects.get_or_create(membership_id=membership_id,
+                                               date=date)
+    if not created: # lock against concurrent completions
+      tally = cls.objects.select_for_update().get(pk=tally.pk)
+    tally.add_step(step)
+    tally.save()
+    return tally
+
+  @classmethod
+  def rebuild(cls, membership_id, date):
+    """ Recalculate a day's tally from its steps. Links the day's existing
+        story if it has none. Returns the tally, or None if no steps """
+    start, end = day_range(date)
+    steps = Step.objects.filter(donor__membership_id=membership_id,
+                                completed__gte=start, completed__lt=end)
+    try:
+      tally = cls.objects.get(membership_id=membership_id, date=date)
+    except cls.DoesNotExist:
+      tally = cls(membership_id=membership_id, date=date)
+    if not steps:
+      if tally.pk:
+        tally.delete()
+      return None
+    tally.talked, tally.asked, tally.promised = '[]', '[]', '{}'
+    tally.updated = start
+    for step in steps:
+      tally.add_step(step)
+    if not tally.story_id:
+      existing = NewsItem.objects.filter(membership_id=membership_id,
+                                         date__gte=start, date__lt=end)[:1]
+      if existing:
+        tally.story = existing[0]
+    tally.save()
+    return tally
+
+class Notification(models.Model):
+  """ Message shown on a member's home page until they've seen it """
+  GIFT, WELCOME, HTML = 'gift', 'welcome', 'html'
+  KIND_CHOICES = ((GIFT, 'Gifts received'), (WELCOME, 'Welcome'),
+                  (HTML, 'Other')) # html: converted from Membership.notifications
+
+  membership = models.ForeignKey(Membership)
+  kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+  payload = models.TextField(default='{}') # json, depends on kind
+  created = models.DateTimeField(default=timezone.now)
+  seen_at = models.DateTimeField(null=True, blank=True)
+
+  class Meta:
+    ordering = ('created',)
+    # unseen lookups for a membership
+    index_together = [['membership', 'seen_at']]
+
+  def __unicode__(self):
+    return u'%s notification for %s' % (self.kind, self.membership_id)
+
+  def data(self):
+    return json.loads(self.payload)
+
+  @classmethod
+  def gifts(cls, membership, donors):
+    """ Unsaved notification listing gifts received from donors """
+    return cls(membership=membership, kind=cls.GIFT, payload=json.dumps(
+        {'gifts': [{'name': unicode(donor), 'amount': donor.received()}
+                   for donor in donors]}))
+
+  @classmethod
+  def unseen(cls, membership_id):
+    return list(cls.objects.filter(membership_id=membership_id,
+                                   seen_at__isnull=True))
+
+  @classmethod
+  def mark_seen(cls, membership_id, ids):
+    """ Mark a batch of a membership's notifications seen, in one update """
+    return cls.objects.filter(membership_id=membership_id, pk__in=ids,
+                              seen_at__isnull=True).update(seen_at=timezone.now())
+
+
 class Resource(models.Model):
   title = models.CharField(max_length=255)
   summary = models.TextField(blank=True)
@@ -374,6 +856,11 @@ class Survey(models.Model):
     super(Survey, self).save(*args, **kwargs)
     logger.info('Survey saved. Questions are: ' + self.questions)
 
+  def choice_indexes(self):
+    """ Indexes of the multiple choice (not write-in) questions """
+    return set(i for i, question in enumerate(json.loads(self.questions))
+               if question['choices'])
+
 
 class GPSurvey(models.Model):
   survey = models.ForeignKey(Survey)
@@ -383,6 +870,19 @@ class GPSurvey(models.Model):
   def __unicode__(self):
     return '%s - %s' % (self.giving_project.title, self.survey.title)
 
+class SurveyCompletion(models.Model):
+  """ Marks a GP survey as completed by a membership """
+  membership = models.ForeignKey(Membership)
+  gp_survey = models.ForeignKey(GPSurvey, related_name='completions')
+  date = models.DateTimeField(default=timezone.now)
+
+  class Meta:
+    unique_together = ('membership', 'gp_survey')
+
+  def __unicode__(self):
+    return u'%s completed %s' % (self.membership_id, self.gp_survey_id)
+
+
 class SurveyResponse(models.Model):
 
   date = models.DateTimeField(default=timezone.now())
@@ -393,3 +893,232 @@ class SurveyResponse(models.Model):
     return 'Response to %s %s survey' % (self.gp_survey.giving_project.title,
         self.date.strftime('%m/%d/%y'))
 
+  def answer_pairs(self):
+    """ List of (question, answer) from the json responses """
+    qa = json.loads(self.responses)
+    return zip(qa[::2], qa[1::2])
+
+  def counted_answers(self):
+    """ (question index, answer) for answers to multiple choice questions """
+    choices = self.gp_survey.survey.choice_indexes()
+    return [(i, answer[:255]) for i, (question, answer)
+            in enumerate(self.answer_pairs()) if i in choices]
+
+  def write_answers(self):
+    """ Store answers in SurveyAnswer and add them to the survey's counts """
+    with transaction.commit_on_success():
+      self.answers.all().delete()
+      SurveyAnswer.objects.bulk_create([
+          SurveyAnswer(response=self, question_index=i, question=question,
+                       answer=answer)
+          for i, (question, answer) in enumerate(self.answer_pairs())])
+      SurveyAnswerCount.adjust(self.gp_survey_id, self.counted_answers(), 1)
+
+
+class SurveyAnswer(models.Model):
+  """ One answer from a SurveyResponse, so answers can be queried without
+      parsing each response's json. Written when the response is created """
+  response = models.ForeignKey(SurveyResponse, related_name='answers')
+  question_index = models.PositiveIntegerField()
+  question = models.TextField()
+  answer = models.TextField()
+
+  class Meta:
+    ordering = ('response', 'question_index')
+    unique_together = ('response', 'question_index')
+
+
+class SurveyAnswerCount(models.Model):
+  """ Number of responses to a GPSurvey giving an answer to one of its
+      multiple choice questions. Kept current as responses are added and
+      deleted; ./manage.py rebuild_survey_answers recalculates them """
+  gp_survey = models.ForeignKey(GPSurvey, related_name='answer_counts')
+  question_index = models.PositiveIntegerField()
+  answer = models.CharField(max_length=255)
+  count = models.IntegerField(default=0)
+
+  class Meta:
+    unique_together = ('gp_survey', 'question_index', 'answer')
+
+  @classmethod
+  def adjust(cls, gp_survey_id, answers, delta):
+    """ Add delta to the counts for a list of (question index, answer) """
+    for index, answer in answers:
+      lookup = {'gp_survey_id': gp_survey_id, 'question_index': index,
+                'answer': answer}
+      if delta > 0:
+        cls.objects.get_or_create(**lookup)
+      cls.objects.filter(**lookup).update(count=models.F('count') + delta)
+
+  @classmethod
+  def rebuild(cls, gp_survey):
+    """ Recalculate a GPSurvey's counts from its SurveyAnswers """
+    rows = (SurveyAnswer.objects
+        .filter(response__gp_survey=gp_survey,
+                question_index__in=gp_survey.survey.choice_indexes())
+        .values_list('question_index', 'answer')
+        .annotate(total=models.Count('pk'))
+        .order_by()) # default ordering would be added to the group by
+    with transaction.commit_on_success():
+      cls.objects.filter(gp_survey=gp_survey).delete()
+      cls.objects.bulk_create([
+          cls(gp_survey=gp_survey, question_index=index, answer=answer[:255],
+              count=total) for index, answer, total in rows])
+
+
+
+# Survey answers
+
+def record_survey_answers(sender, instance, created, raw, **kwargs):
+  if created and not raw:
+    instance.write_answers()
+
+def remove_survey_answers(sender, instance, **kwargs):
+  try:
+    answers = instance.counted_answers()
+  except (GPSurvey.DoesNotExist, Survey.DoesNotExist): # deleted along with it
+    return
+  SurveyAnswerCount.adjust(instance.gp_survey_id, answers, -1)
+
+models.signals.post_save.connect(record_survey_answers, sender=SurveyResponse)
+models.signals.post_delete.connect(remove_survey_answers, sender=SurveyResponse)
+
+
+# Progress rollup maintenance
+
+def snapshot_donor_progress(sender, instance, **kwargs):
+  """ Remember what a donor contributed to progress when it was loaded """
+  if instance._deferred:
+    return
+  if instance.pk and instance.membership_id:
+    instance._progress_snapshot = (instance.membership_id,
+                                   MembershipProgress.donor_values(instance))
+  else:
+    instance._progress_snapshot = None
+
+def update_donor_progress(sender, instance, created, raw, **kwargs):
+  if raw: # fixture loading - totals will be rebuilt on next read
+    MembershipProgress.objects.filter(
+        membership_id=instance.membership_id).delete()
+    return
+  snapshot = getattr(instance, '_progress_snapshot', False)
+  if snapshot is False: # loaded without all fields
+    MembershipProgress.rebuild(instance.membership_id)
+  else:
+    new = MembershipProgress.donor_values(instance)
+    if snapshot and snapshot[0] != instance.membership_id: # moved
+      MembershipProgress.adjust(snapshot[0], snapshot[1], {})
+      MembershipProgress.adjust(instance.membership_id, {}, new)
+    else:
+      MembershipProgress.adjust(instance.membership_id,
+                                snapshot[1] if snapshot else {}, new)
+  instance._progress_snapshot = (instance.membership_id,
+                                 MembershipProgress.donor_values(instance))
+
+def remove_donor_progress(sender, instance, **kwargs):
+  snapshot = getattr(instance, '_progress_snapshot', None)
+  if snapshot:
+    MembershipProgress.adjust(snapshot[0], snapshot[1], {})
+  else:
+    MembershipProgress.adjust(instance.membership_id,
+                              MembershipProgress.donor_values(instance), {})
+
+def bulk_donor_progress(sender, instances, **kwargs):
+  """ Apply a batch written by fund.bulk with one update per membership """
+  changes, rebuild = [], set()
+  for donor in instances:
+    snapshot = getattr(donor, '_progress_snapshot', False)
+    new = MembershipProgress.donor_values(donor)
+    if snapshot is False:
+      rebuild.add(donor.membership_id)
+    elif snapshot and snapshot[0] != donor.membership_id:
+      changes.append((snapshot[0], snapshot[1], {}))
+      changes.append((donor.membership_id, {}, new))
+    else:
+      changes.append((donor.membership_id, snapshot[1] if snapshot else {}, new))
+    donor._progress_snapshot = (donor.membership_id, new)
+  MembershipProgress.adjust_many(changes)
+  for membership_id in rebuild:
+    MembershipProgress.rebuild(membership_id)
+
+models.signals.post_init.connect(snapshot_donor_progress, sender=Donor)
+models.signals.post_save.connect(update_donor_progress, sender=Donor)
+models.signals.post_delete.connect(remove_donor_progress, sender=Donor)
+bulk.bulk_created.connect(bulk_donor_progress, sender=Donor)
+bulk.bulk_updated.connect(bulk_donor_progress, sender=Donor)
+
+
+# News & grants block cache invalidation
+
+def invalidate_project_blocks(sender, instance, **kwargs):
+  """ Giving project saved - site_visits changes which grants are shown """
+  blocks.invalidate(instance.pk)
+
+def invalidate_membership_blocks(sender, instance, **kwargs):
+  blocks.invalidate(instance.giving_project_id)
+
+def invalidate_news_blocks(sender, instance, **kwargs):
+  gp_ids = (Membership.objects.filter(pk=instance.membership_id)
+                              .values_list('giving_project_id', flat=True))
+  blocks.invalidate(*gp_ids)
+
+models.signals.post_save.connect(invalidate_project_blocks, sender=GivingProject)
+models.signals.post_delete.connect(invalidate_membership_blocks, sender=Membership)
+models.signals.post_save.connect(invalidate_news_blocks, sender=NewsItem)
+models.signals.post_delete.connect(invalidate_news_blocks, sender=NewsItem)
+
+
+# Cached membership resolution for MembershipMiddleware, keyed by member id
+
+membership_cache = VersionedCache('fund-membership', 60 * 60 * 12)
+
+def refresh_cached_membership(sender, instance, raw, **kwargs):
+  """ Keep the cached membership current when it is saved. Any other change
+      (approval, another of the member's memberships) could change which
+      membership is resolved, so bump the version instead """
+  version, entry = membership_cache.get(instance.member_id)
+  cached = entry and entry['membership']
+  if (not raw and cached and cached.pk == instance.pk and
+      cached.approved == instance.approved and
+      cached.giving_project_id == instance.giving_project_id):
+    for field in instance._meta.fields:
+      setattr(cached, field.attname, getattr(instance, field.attname))
+    cached._snapshot_fields()
+    membership_cache.set(instance.member_id, version, entry)
+  else:
+    membership_cache.invalidate(instance.member_id)
+
+def invalidate_cached_membership(sender, instance, **kwargs):
+  membership_cache.invalidate(instance.member_id)
+
+def invalidate_cached_member(sender, instance, **kwargs):
+  """ Member saved - current may have changed """
+  membership_cache.invalidate(instance.pk)
+
+def invalidate_cached_project(sender, instance, **kwargs):
+  """ Cached memberships carry their giving project """
+  membership_cache.invalidate(*Membership.objects.filter(giving_project=instance)
+                                                 .values_list('member_id', flat=True))
+
+models.signals.post_save.connect(refresh_cached_membership, sender=Membership)
+models.signals.post_delete.connect(invalidate_cached_membership, sender=Membership)
+models.signals.post_save.connect(invalidate_cached_member, sender=Member)
+models.signals.post_delete.connect(invalidate_cached_member, sender=Member)
+models.signals.post_save.connect(invalidate_cached_project, sender=GivingProject)
+
+
+# Pending survey cache, keyed by membership id (see Membership.pending_survey)
+
+survey_cache = VersionedCache('fund-surveys', 60 * 60 * 12)
+
+def invalidate_survey_completion(sender, instance, **kwargs):
+  survey_cache.invalidate(instance.membership_id)
+
+def invalidate_project_surveys(sender, instance, **kwargs):
+  survey_cache.invalidate(*Membership.objects.filter(
+      giving_project_id=instance.giving_project_id).values_list('pk', flat=True))
+
+models.signals.post_save.connect(invalidate_survey_completion, sender=SurveyCompletion)
+models.signals.post_delete.connect(invalidate_survey_completion, sender=SurveyCompletion)
+models.signals.post_save.connect(invalidate_project_surveys, sender=GPSurvey)
+models.signals.post_delete.connect(invalidate_project_surveys, sender=GPSurvey)
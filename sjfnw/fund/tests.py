@@ -1,15 +1,21 @@
 from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import call_command
 from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import RequestFactory
 from django.test.utils import override_settings
 from django.utils import timezone
 
 from sjfnw.constants import TEST_MIDDLEWARE
-from sjfnw.fund import models, forms
+from sjfnw.fund import activity, blocks, dedupe, models, modelforms, forms, views
+from sjfnw.fund.middleware import MembershipMiddleware
 from sjfnw.grants.models import ProjectApp
 from sjfnw.tests import BaseTestCase
 
 from datetime import timedelta
-import unittest, logging, json
+import unittest, logging, json, unicodecsv
 logger = logging.getLogger('sjfnw')
 
 
@@ -95,6 +101,94 @@ class BaseFundTestCase(BaseTestCase):
     mem.save()
 
 
+@override_settings(MIDDLEWARE_CLASSES = TEST_MIDDLEWARE,
+    PASSWORD_HASHERS = ('django.contrib.auth.hashers.MD5PasswordHasher',))
+class MembershipResolution(BaseFundTestCase):
+  """ Cached membership resolution in MembershipMiddleware """
+
+  def setUp(self):
+    super(MembershipResolution, self).setUp('newbie')
+    self.user = User.objects.get(username='newacct@gmail.com')
+    self.client.get(reverse('sjfnw.fund.views.home')) # resolves & caches
+
+  def process(self):
+    """ Runs the middleware on a request using the client's session
+
+    Returns:
+      request, number of queries run by the middleware
+    """
+    request = RequestFactory().get(reverse('sjfnw.fund.views.home'))
+    request.user = self.user
+    request.session = self.client.session
+    request.session.get('fund_member_id') # load session before counting
+    queries = self.count_queries(MembershipMiddleware().process_view, request,
+                                 views.home, [], {})
+    return request, queries
+
+  def test_cached(self):
+    """ Verify a resolved membership is reused without queries """
+
+    request, queries = self.process()
+    self.assertEqual(queries, 0)
+    self.assertEqual(request.membership_status, 3)
+    self.assertEqual(request.membership.pk, self.pre_id)
+    self.assertEqual(request.membership.giving_project.title, 'Pre training')
+
+  def test_set_current(self):
+    """ Verify set_current is picked up, then cached again """
+
+    self.client.get(reverse('sjfnw.fund.views.set_current',
+                            kwargs={'ship_id': self.post_id}))
+    request, queries = self.process()
+    self.assertEqual(request.membership.pk, self.post_id)
+    request, queries = self.process()
+    self.assertEqual(queries, 0)
+    self.assertEqual(request.membership.pk, self.post_id)
+
+  def test_saved(self):
+    """ Verify saves to the cached membership are reflected without queries """
+
+    ship = models.Membership.objects.get(pk=self.pre_id)
+    ship.notifications = 'Hello'
+    ship.save(skip=True)
+
+    request, queries = self.process()
+    self.assertEqual(queries, 0)
+    self.assertEqual(request.membership.notifications, 'Hello')
+
+  def test_unapproved(self):
+    """ Verify approval changes are picked up """
+
+    for ship in models.Membership.objects.filter(member_id=self.member_id):
+      ship.approved = False
+      ship.save(skip=True)
+
+    request, queries = self.process()
+    self.assertEqual(request.membership_status, 2)
+
+  def test_current_unapproved(self):
+    """ Verify an unapproved current membership is kept as current while
+        requests use an approved one """
+
+    ship = models.Membership.objects.get(pk=self.pre_id)
+    ship.approved = False
+    ship.save(skip=True)
+
+    request, queries = self.process()
+    self.assertEqual(request.membership_status, 3)
+    self.assertEqual(request.membership.pk, self.post_id)
+    self.assertEqual(models.Member.objects.get(pk=self.member_id).current,
+                     self.pre_id)
+
+  def test_deleted(self):
+    """ Verify membership deletion is picked up """
+
+    models.Membership.objects.filter(member_id=self.member_id).delete()
+
+    request, queries = self.process()
+    self.assertEqual(request.membership_status, 1)
+
+
 @override_settings(MIDDLEWARE_CLASSES = TEST_MIDDLEWARE,
     PASSWORD_HASHERS = ('django.contrib.auth.hashers.MD5PasswordHasher',))
 class Home(BaseFundTestCase):
@@ -549,6 +643,77 @@ class StepComplete(BaseFundTestCase):
     self.assertIsNone(step1.completed)
 
 
+@override_settings(MIDDLEWARE_CLASSES = TEST_MIDDLEWARE,
+    PASSWORD_HASHERS = ('django.contrib.auth.hashers.MD5PasswordHasher',))
+class Stories(BaseFundTestCase):
+  """ News stories built from step completions """
+
+  fixtures = TEST_FIXTURE
+
+  def setUp(self):
+    super(Stories, self).setUp('testy')
+    self.form_data = {'asked': '', 'response': 2, 'promised_amount': '',
+                      'last_name': '', 'email': '', 'phone': '', 'notes': '',
+                      'next_step': '', 'next_step_date': '',
+                      'likely_to_join': ''}
+
+  def complete(self, donor_id, step_id, **data):
+    form_data = dict(self.form_data, **data)
+    response = self.client.post(reverse('sjfnw.fund.views.done_step',
+        kwargs = {'donor_id': donor_id, 'step_id': step_id}), form_data)
+    self.assertEqual(response.content, 'success')
+
+  def add_donor_step(self, firstname):
+    donor = models.Donor(membership_id=self.ship_id, firstname=firstname)
+    donor.save()
+    step = models.Step(donor=donor, description='Talk', date='2013-04-06')
+    step.save()
+    return donor.pk, step.pk
+
+  def complete_steps(self):
+    """ Asks Anna, talks to one donor, gets a promise from another """
+    self.complete(self.donor_id, self.step_id, asked='on')
+    self.complete(*self.add_donor_step('Bo'))
+    donor_id, step_id = self.add_donor_step('Cy')
+    self.complete(donor_id, step_id, asked='on', response=1,
+                  promised_amount=100, last_name='Sozzity',
+                  email='blah@gmail.com', promise_reason=['Social justice'],
+                  likely_to_join=1)
+    # talking again to an asked donor doesn't count as talked
+    donor = models.Donor.objects.get(pk=self.donor_id)
+    step = models.Step(donor=donor, description='Follow up', date='2013-04-07')
+    step.save()
+    self.complete(self.donor_id, step.pk)
+
+  def test_tally(self):
+    """ Verify completions are tallied into one story for the day """
+
+    self.complete_steps()
+
+    self.assertEqual(models.StoryTally.objects.count(), 1)
+    stories = models.NewsItem.objects.filter(membership_id=self.ship_id)
+    self.assertEqual(len(stories), 1)
+    self.assertEqual(stories[0].summary,
+        'Test talked to 1 person, asked 2 and got $100 in promises.')
+
+  def test_update_stories(self):
+    """ Verify update_stories rebuilds tallies and reuses the day's story """
+
+    self.complete_steps()
+    story = models.NewsItem.objects.get(membership_id=self.ship_id)
+    models.StoryTally.objects.all().delete()
+    story.summary = ''
+    story.save()
+
+    today = timezone.localtime(timezone.now()).strftime('%Y-%m-%d')
+    call_command('update_stories', today)
+
+    story = models.NewsItem.objects.get(membership_id=self.ship_id)
+    self.assertEqual(story.summary,
+        'Test talked to 1 person, asked 2 and got $100 in promises.')
+    self.assertEqual(models.StoryTally.objects.get().story_id, story.pk)
+
+
 @override_settings(MIDDLEWARE_CLASSES = TEST_MIDDLEWARE,
     PASSWORD_HASHERS = ('django.contrib.auth.hashers.MD5PasswordHasher',))
 class Grants(BaseFundTestCase):
@@ -589,6 +754,71 @@ class Grants(BaseFundTestCase):
       self.assertContains(response, unicode(papp.application.organization))
 
 
+@override_settings(MIDDLEWARE_CLASSES = TEST_MIDDLEWARE,
+    PASSWORD_HASHERS = ('django.contrib.auth.hashers.MD5PasswordHasher',))
+class ProjectBlocks(BaseFundTestCase):
+  """ Shared news & grants block cache """
+
+  fixtures = Grants.fixtures
+
+  def setUp(self):
+    super(ProjectBlocks, self).setUp('testy')
+    self.gp = models.GivingProject.objects.get(pk=19)
+
+  def add_memberships(self, count):
+    for i in range(count):
+      member = models.Member(first_name='Member', last_name=str(i),
+                             email='member%d@gmail.com' % i)
+      member.save()
+      models.Membership(giving_project=self.gp, member=member,
+                        approved=True).save()
+    return list(models.Membership.objects.select_related('giving_project')
+                                         .filter(giving_project=self.gp))
+
+  def test_shared_fill(self):
+    """ Verify one cold fill serves every member of the project """
+
+    ships = self.add_memberships(30)
+
+    self.assertNotEqual(self.count_queries(views.get_block_content, ships[0],
+                                           get_steps=False), 0)
+    for ship in ships[1:]:
+      self.assertEqual(self.count_queries(views.get_block_content, ship,
+                                          get_steps=False), 0)
+    self.assertEqual(blocks.stats(self.gp.pk), {'hits': 29, 'misses': 1})
+
+    news, grants = views.get_block_content(ships[0], get_steps=False)
+    self.assertEqual(len(grants),
+        ProjectApp.objects.filter(giving_project=self.gp)
+                          .exclude(application__pre_screening_status=45).count())
+
+  def test_invalidation(self):
+    """ Verify news, project app and giving project changes are shown """
+
+    ship = self.add_memberships(1)[0]
+    news, grants = views.get_block_content(ship, get_steps=False)
+    self.assertEqual(news, [])
+    self.assertNotEqual(grants, [])
+
+    models.NewsItem(membership=ship, summary='Good news').save()
+    news, grants = views.get_block_content(ship, get_steps=False)
+    self.assertEqual([n.summary for n in news], ['Good news'])
+
+    papp = grants[0]
+    papp.delete()
+    news, grants = views.get_block_content(ship, get_steps=False)
+    self.assertNotIn(papp.pk, [g.pk for g in grants])
+
+    ProjectApp.objects.filter(giving_project=self.gp).update(screening_status=None)
+    self.gp.site_visits = True
+    self.gp.save()
+    ship = models.Membership.objects.get(pk=ship.pk)
+    news, grants = views.get_block_content(ship, get_steps=False)
+    self.assertEqual(grants, [])
+
+    self.assertEqual(blocks.stats(self.gp.pk)['hits'], 0)
+
+
 @override_settings(MIDDLEWARE_CLASSES = TEST_MIDDLEWARE,
     PASSWORD_HASHERS = ('django.contrib.auth.hashers.MD5PasswordHasher',))
 class CopyContacts(BaseFundTestCase):
@@ -721,6 +951,160 @@ class CopyContacts(BaseFundTestCase):
     self.assertTemplateNotUsed(self.template)
 
 
+class ContactDedupe(unittest.TestCase):
+  """ Clustering and merging contacts for copy_contacts """
+
+  def contact(self, firstname, lastname='', phone='', email='', notes=''):
+    return {'firstname': firstname, 'lastname': lastname, 'phone': phone,
+            'email': email, 'notes': notes}
+
+  def test_dedupe(self):
+    """ Verify contacts are linked through normalized keys, the first
+        contact's fields win and blanks are filled from the rest """
+    contacts = [self.contact('Ann', phone='206-555-1234', notes='Neighbor'),
+                self.contact('ann ', 'Lee', email='ann@example.com'),
+                self.contact('Ann', 'LEE', phone='(206) 555 1234', notes='Met at work'),
+                self.contact('Ann', 'Other', phone='555-12'),
+                self.contact('Bob', email='ann@example.com')]
+
+    groups = dedupe.cluster(contacts)
+    self.assertEqual([len(group) for group in groups], [3, 1, 1])
+
+    merged = dedupe.dedupe(contacts)
+    self.assertEqual(len(merged), 3)
+    self.assertEqual(merged[0], {'firstname': 'Ann', 'lastname': 'Lee',
+                                 'phone': '206-555-1234', 'email': 'ann@example.com',
+                                 'notes': 'Neighbor Met at work'})
+    self.assertEqual(merged[2]['firstname'], 'Bob')
+
+
+@override_settings(MIDDLEWARE_CLASSES = TEST_MIDDLEWARE,
+    PASSWORD_HASHERS = ('django.contrib.auth.hashers.MD5PasswordHasher',))
+class FindDuplicates(BaseFundTestCase):
+  """ Removing duplicate donors in chunks """
+
+  fixtures = TEST_FIXTURE
+
+  def setUp(self):
+    super(FindDuplicates, self).setUp('testy')
+
+  def test_chunks(self):
+    """ Verify dry run doesn't delete, and duplicates without steps or
+        conversations are deleted across chunks with progress kept current """
+    ship_id = self.ship_id
+    for first, last, talked in [('Dup', 'Person', False), ('dup ', 'PERSON', True),
+                                ('Dup', 'Person', False), ('Dup', '', False)]:
+      models.Donor(membership_id=ship_id, firstname=first, lastname=last,
+                   talked=talked).save()
+    stepped = models.Donor(membership_id=ship_id, firstname='Dup', lastname='Person')
+    stepped.save()
+    models.Step(donor=stepped, description='Call', date='2013-04-06').save()
+    total = models.Donor.objects.count()
+
+    report = views.find_duplicates_chunk(dry_run=True)
+    self.assertEqual((report['deleted'], report['kept']), (2, 1))
+    self.assertEqual(models.Donor.objects.count(), total)
+
+    report = views.find_duplicates_chunk(size=1)
+    self.assertEqual((report['deleted'], report['kept']), (2, 1))
+    self.assertEqual(report['ships'], set([ship_id]))
+    self.assertEqual(models.Donor.objects.count(), total - 2)
+    remaining = models.Donor.objects.filter(membership_id=ship_id, firstname__istartswith='dup')
+    self.assertEqual(sorted(remaining.values_list('talked', flat=True)), [False, False, True])
+    self.assertEqual(models.MembershipProgress.get_for(ship_id).contacts,
+                     models.Donor.objects.filter(membership_id=ship_id).count())
+
+
+@override_settings(MIDDLEWARE_CLASSES = TEST_MIDDLEWARE,
+    PASSWORD_HASHERS = ('django.contrib.auth.hashers.MD5PasswordHasher',))
+class DonorExport(BaseFundTestCase):
+  """ Donor CSV export from the admin """
+
+  fixtures = TEST_FIXTURE
+  url = '/admin/fund/donor/'
+
+  def setUp(self):
+    super(DonorExport, self).setUp('')
+    self.logInAdmin()
+
+  def export(self):
+    donor_ids = models.Donor.objects.values_list('pk', flat=True)
+    response = self.client.post(self.url, {'action': 'export_donors',
+                                           '_selected_action': list(donor_ids)})
+    self.assertEqual(response.status_code, 200)
+    self.assertEqual(response['Content-Type'], 'text/csv')
+    return list(unicodecsv.reader(response.content.splitlines(True),
+                                  encoding='utf8'))
+
+  def test_export(self):
+    """ Verify every donor is exported and the number of queries doesn't grow
+        with the number of donors """
+    rows = self.export()
+    self.assertEqual(len(rows) - 1, models.Donor.objects.count())
+    queries = self.count_queries(self.export)
+
+    ship = models.Membership.objects.select_related('member', 'giving_project')[0]
+    for i in range(20):
+      models.Donor(membership=ship, firstname='Export', lastname=str(i),
+                   promise_reason='["Other"]').save()
+    rows = self.export()
+    self.assertEqual(len(rows) - 1, models.Donor.objects.count())
+    self.assertEqual(self.count_queries(self.export), queries)
+
+    row = [row for row in rows if row[1] == '19'][0]
+    self.assertEqual(row[4], unicode(ship.member))
+    self.assertEqual(row[5], unicode(ship.giving_project))
+    self.assertEqual(row[18], 'Other')
+
+
+@override_settings(MIDDLEWARE_CLASSES = TEST_MIDDLEWARE,
+    PASSWORD_HASHERS = ('django.contrib.auth.hashers.MD5PasswordHasher',))
+class AdminAutocomplete(BaseFundTestCase):
+  """ Member & application search on the giving project admin page """
+
+  fixtures = TEST_FIXTURE
+
+  def setUp(self):
+    super(AdminAutocomplete, self).setUp('')
+    self.logInAdmin()
+    self.url = '/admin/fund/givingproject/1/'
+
+  def test_change_page(self):
+    """ Verify member choices aren't rendered and the page size and query
+        count don't grow with the number of members """
+    response = self.client.get(self.url)
+    self.assertContains(response, 'class="autocomplete"')
+    size = len(response.content)
+    queries = self.count_queries(self.client.get, self.url)
+    self.assertGreater(queries, 0)
+
+    for i in range(30):
+      models.Member(first_name='Extra', last_name=str(i),
+                    email='extra%d@example.com' % i).save()
+    with self.assertNumQueries(queries):
+      response = self.client.get(self.url)
+    self.assertNotContains(response, 'Extra 1')
+    self.assertEqual(len(response.content), size)
+
+    ship = models.Membership.objects.filter(giving_project_id=1).select_related('member')[0]
+    self.assertContains(response, unicode(ship.member))
+
+  def test_search(self):
+    """ Verify members are matched by name prefix """
+    models.Member(first_name='Zelda', last_name='Quill', email='zq@example.com').save()
+    url = '/admin/fund/autocomplete/members'
+    for term in ['zel', 'QUI', 'zq@', 'zelda q']:
+      matches = json.loads(self.client.get(url, {'q': term}).content)
+      self.assertEqual([match['label'] for match in matches], ['Zelda Quill'])
+    self.assertEqual(json.loads(self.client.get(url, {'q': 'zelda x'}).content), [])
+    self.assertEqual(json.loads(self.client.get(url).content), [])
+
+    response = self.client.get('/admin/fund/autocomplete/applications', {'q': 'a', 'gp': 1})
+    self.assertEqual(response.status_code, 200)
+    response = self.client.get('/admin/fund/autocomplete/applications', {'q': 'a', 'gp': 'x'})
+    self.assertEqual(json.loads(response.content), [])
+
+
 @override_settings(MIDDLEWARE_CLASSES = TEST_MIDDLEWARE,
     PASSWORD_HASHERS = ('django.contrib.auth.hashers.MD5PasswordHasher',))
 class GPSurveys(BaseFundTestCase):
@@ -826,6 +1210,50 @@ class GPSurveys(BaseFundTestCase):
     self.assertEqual(new_response.responses, json.dumps(
       ["How well did we meet our goals? (1 = did not meet, 5 = met all our goals)", "2",
        "Any other comments for us?", "No comments."]))
+    self.assertTrue(models.SurveyCompletion.objects.filter(
+        membership_id=1, gp_survey_id=self.gps_pk).exists())
+
+  def test_answers(self):
+    """ Verify responses are stored as answers, counted for the results page
+        and exported, and counts drop when a response is deleted """
+    self.pre_create_survey()
+    for answer in ['2', '2', '5']:
+      models.SurveyResponse(gp_survey_id=self.gps_pk, responses=json.dumps(
+          ['Goals?', answer, 'Comments?', 'Comment on ' + answer])).save()
+
+    self.assertEqual(models.SurveyAnswer.objects.count(), 6)
+    counts = models.SurveyAnswerCount.objects.filter(gp_survey_id=self.gps_pk)
+    self.assertEqual(sorted(counts.values_list('question_index', 'answer', 'count')),
+                     [(0, '2', 2), (0, '5', 1)])
+
+    self.logInAdmin()
+    response = self.client.get('/admin/fund/gpsurvey/%d/results' % self.gps_pk)
+    self.assertEqual(response.context['responses'], 3)
+    self.assertEqual(response.context['results'][0]['choices'],
+                     [(1, 0), (2, 2), (3, 0), (4, 0), (5, 1)])
+
+    export = {'action': 'export_responses', '_selected_action': list(
+        models.SurveyResponse.objects.values_list('pk', flat=True))}
+    response = self.client.post('/admin/fund/surveyresponse/', export)
+    self.assertEqual(response.status_code, 200)
+    rows = list(unicodecsv.reader(response.content.splitlines(True),
+                                  encoding='utf8'))
+    self.assertEqual(len(rows), 4)
+    self.assertEqual(rows[0][4:], ['Question', 'Answer', 'Question', 'Answer'])
+    self.assertEqual(rows[1][4:], ['Goals?', '2', 'Comments?', 'Comment on 2'])
+
+    # responses not converted yet are exported from their json, in order
+    models.SurveyResponse.objects.order_by('pk')[0].answers.all().delete()
+    response = self.client.post('/admin/fund/surveyresponse/', export)
+    self.assertEqual(list(unicodecsv.reader(response.content.splitlines(True),
+                                            encoding='utf8')), rows)
+
+    models.SurveyResponse.objects.filter(responses__contains='"5"').delete()
+    self.assertEqual(sorted(counts.values_list('question_index', 'answer', 'count')),
+                     [(0, '2', 2), (0, '5', 0)])
+    models.SurveyAnswerCount.rebuild(models.GPSurvey.objects.get(pk=self.gps_pk))
+    self.assertEqual(sorted(counts.values_list('question_index', 'answer', 'count')),
+                     [(0, '2', 2)])
 
   def test_future_survey(self):
     """ Verify that survey doesn't show if the date has not been reached """
@@ -850,12 +1278,715 @@ class GPSurveys(BaseFundTestCase):
     self.logInTesty()
 
     # Mark completed
-    membership = models.Membership.objects.get(pk=1)
-    membership.completed_surveys = '[1]'
-    membership.save()
+    models.SurveyCompletion(membership_id=1, gp_survey_id=self.gps_pk).save()
 
     # Check home page
     response = self.client.get(self.url, follow=True)
-    self.assertTemplateNotUsed(self.template)
+    self.assertTemplateNotUsed(response, self.template)
+
+  def test_pending_survey(self):
+    """ Verify the pending survey is cached, refreshed on completion and
+        when a future survey comes due, and that json lists are converted """
+    self.pre_create_survey()
+    membership = models.Membership.objects.get(pk=1)
+    self.assertEqual(membership.pending_survey(), self.gps_pk)
+    self.assertEqual(self.count_queries(membership.pending_survey), 0)
+
+    gp_survey = models.GPSurvey.objects.get(pk=self.gps_pk)
+    later = models.GPSurvey(survey=gp_survey.survey, giving_project_id=1,
+                            date=timezone.now() + timedelta(seconds=2))
+    later.save()
+    models.SurveyCompletion(membership=membership, gp_survey=gp_survey).save()
+    self.assertIsNone(membership.pending_survey())
+    self.assertEqual(self.count_queries(membership.pending_survey), 0)
+
+    models.GPSurvey.objects.filter(pk=later.pk).update(date=timezone.now())
+    models.survey_cache.set(1, models.survey_cache.version(1),
+                            {'pending': None, 'until': timezone.now()})
+    self.assertEqual(membership.pending_survey(), later.pk)
+
+    # json list conversion
+    models.SurveyCompletion.objects.all().delete()
+    membership.completed_surveys = json.dumps([self.gps_pk, later.pk, 999])
+    membership.save()
+    call_command('convert_completed_surveys')
+    call_command('convert_completed_surveys')
+    self.assertEqual(sorted(models.SurveyCompletion.objects.filter(membership=membership)
+                            .values_list('gp_survey_id', flat=True)),
+                     sorted([self.gps_pk, later.pk]))
+    self.assertIsNone(membership.pending_survey())
+
+
+
 
+@override_settings(MIDDLEWARE_CLASSES = TEST_MIDDLEWARE,
+    PASSWORD_HASHERS = ('django.contrib.auth.hashers.MD5PasswordHasher',))
+class ProgressRollup(BaseFundTestCase):
+  """ MembershipProgress totals stay in sync with donor changes """
+
+  fixtures = TEST_FIXTURE
+
+  def setUp(self):
+    super(ProgressRollup, self).setUp('newbie')
+
+  def assert_matches_rebuild(self, ship_id):
+    progress = models.MembershipProgress.objects.get(membership_id=ship_id)
+    rebuilt = models.MembershipProgress.rebuild(ship_id)
+    for field in models.MembershipProgress.TOTAL_FIELDS:
+      self.assertEqual(getattr(progress, field), getattr(rebuilt, field), field)
+
+  def test_donor_changes(self):
+    """ Verify that creating, editing and deleting donors adjusts totals """
+
+    progress = models.MembershipProgress.get_for(self.post_id)
+    self.assertEqual(progress.contacts, 0)
+
+    donor = models.Donor(membership_id=self.post_id, firstname='Anna',
+                         amount=500, likelihood=50, talked=True)
+    donor.save()
+    other = models.Donor(membership_id=self.post_id, firstname='Banana',
+                         amount=100, likelihood=10)
+    other.save()
+
+    progress = models.MembershipProgress.objects.get(membership_id=self.post_id)
+    self.assertEqual(progress.contacts, 2)
+    self.assertEqual(progress.estimated, 260)
+    self.assertEqual(progress.talked, 1)
+
+    donor = models.Donor.objects.get(pk=donor.pk)
+    donor.asked = True
+    donor.promised = 200
+    donor.save()
+    progress = models.MembershipProgress.objects.get(membership_id=self.post_id)
+    self.assertEqual(progress.talked, 0)
+    self.assertEqual(progress.asked, 1)
+    self.assertEqual(progress.promised_pending, 200)
+
+    donor.received_this = 150
+    donor.save()
+    progress = models.MembershipProgress.objects.get(membership_id=self.post_id)
+    self.assertEqual(progress.promised_pending, 0)
+    self.assertEqual(progress.received_total(), 150)
+
+    other.delete()
+    progress = models.MembershipProgress.objects.get(membership_id=self.post_id)
+    self.assertEqual(progress.contacts, 1)
+    self.assertEqual(progress.estimated, 250)
+    self.assert_matches_rebuild(self.post_id)
+
+  def test_move_donor(self):
+    """ Verify that moving a donor to another membership updates both """
+
+    models.MembershipProgress.get_for(self.pre_id)
+    models.MembershipProgress.get_for(self.post_id)
+
+    donor = models.Donor(membership_id=self.pre_id, firstname='Anna',
+                         amount=300, likelihood=100)
+    donor.save()
+    donor.membership_id = self.post_id
+    donor.save()
+
+    pre = models.MembershipProgress.objects.get(membership_id=self.pre_id)
+    post = models.MembershipProgress.objects.get(membership_id=self.post_id)
+    self.assertEqual(pre.contacts, 0)
+    self.assertEqual(pre.estimated, 0)
+    self.assertEqual(post.contacts, 1)
+    self.assertEqual(post.estimated, 300)
+
+  def test_project_totals(self):
+    """ Verify with_progress sums membership totals per project """
+
+    donor = models.Donor(membership_id=self.post_id, firstname='Anna',
+                         amount=500, likelihood=50, promised=100)
+    donor.save()
+    donor = models.Donor(membership_id=self.pre_id, firstname='Banana',
+                         amount=100, likelihood=100)
+    donor.save()
+
+    projects = models.GivingProject.objects.with_progress()
+    post = projects.get(title='Post training')
+    self.assertEqual(post.progress_contacts, 1)
+    self.assertEqual(post.estimated(), 250)
+    self.assertEqual(post.get_progress()['promised_pending'], 100)
+    pre = projects.get(title='Pre training')
+    self.assertEqual(pre.estimated(), 100)
+
+    # unannotated instance runs the query itself
+    post = models.GivingProject.objects.get(title='Post training')
+    self.assertEqual(post.estimated(), 250)
+
+  def test_fill_missing(self):
+    """ Verify memberships without a rollup are built before project totals """
+
+    donor = models.Donor(membership_id=self.post_id, firstname='Anna',
+                         amount=500, likelihood=50)
+    donor.save()
+    models.MembershipProgress.objects.all().delete()
+
+    post = models.GivingProject.objects.get(title='Post training')
+    self.assertEqual(post.estimated(), 0)
+    models.MembershipProgress.fill_missing(post.pk)
+    post = models.GivingProject.objects.with_progress().get(pk=post.pk)
+    self.assertEqual(post.estimated(), 250)
+
+  def test_project_changelist(self):
+    """ Verify the giving project changelist runs a constant number of queries
+        regardless of how many projects are listed """
+
+    self.logInAdmin()
+    url = '/admin/fund/givingproject/'
+    self.client.get(url)
+    before = self.count_queries(self.client.get, url)
+    self.assertGreater(before, 0)
 
+    today = timezone.now()
+    for i in range(10):
+      models.GivingProject(title='Extra %d' % i,
+          fundraising_training=today, fundraising_deadline=today).save()
+
+    with self.assertNumQueries(before):
+      response = self.client.get(url)
+    self.assertContains(response, 'Extra 9')
+
+
+@override_settings(MIDDLEWARE_CLASSES = TEST_MIDDLEWARE,
+    PASSWORD_HASHERS = ('django.contrib.auth.hashers.MD5PasswordHasher',))
+class MembershipChangelist(BaseFundTestCase):
+  """ Membership admin list - progress & overdue step columns """
+
+  url = '/admin/fund/membership/'
+
+  def setUp(self):
+    super(MembershipChangelist, self).setUp('admin')
+    self.gp = models.GivingProject.objects.get(title='Post training')
+
+  def add_memberships(self, count):
+    """ Creates memberships with a donor and an overdue step each """
+    start = models.Member.objects.count()
+    for i in range(start, start + count):
+      member = models.Member(first_name='Member', last_name=str(i),
+                             email='member%d@gmail.com' % i)
+      member.save()
+      ship = models.Membership(giving_project=self.gp, member=member,
+                               approved=True)
+      ship.save()
+      donor = models.Donor(membership=ship, firstname='Donor', amount=100,
+                           likelihood=50, promised=40)
+      donor.save()
+      models.Step(donor=donor, description='Overdue',
+                  date=timezone.now().date() - timedelta(days=5)).save()
+
+  def test_annotations(self):
+    """ Verify the annotated columns match per-membership calculations """
+
+    self.add_memberships(2)
+    ship = models.Membership.objects.all()[0]
+    models.Step(donor=ship.donor_set.all()[0], description='Also overdue',
+                date=timezone.now().date() - timedelta(days=3)).save()
+
+    annotated = (models.Membership.objects.with_progress()
+                                          .with_overdue_count().get(pk=ship.pk))
+    self.assertEqual(annotated.overdue_count, 2)
+    self.assertEqual(annotated.overdue_count, ship.overdue_steps())
+    self.assertEqual(annotated.get_progress(), ship.get_progress())
+    self.assertEqual(annotated.get_progress()['estimated'], 50)
+    self.assertEqual(annotated.get_progress()['promised'], 40)
+
+  def test_query_count(self):
+    """ Verify the changelist query count doesn't grow with memberships """
+
+    self.add_memberships(2)
+    response = self.client.get(self.url)
+    self.assertContains(response, '$50')
+    small = self.count_queries(self.client.get, self.url)
+    self.assertGreater(small, 0)
+
+    self.add_memberships(20)
+    with self.assertNumQueries(small):
+      self.client.get(self.url)
+
+
+@override_settings(MIDDLEWARE_CLASSES = TEST_MIDDLEWARE,
+    PASSWORD_HASHERS = ('django.contrib.auth.hashers.MD5PasswordHasher',))
+class ChangeTracking(BaseFundTestCase):
+  """ Saves write only changed fields """
+
+  fixtures = TEST_FIXTURE
+
+  def setUp(self):
+    super(ChangeTracking, self).setUp('testy')
+
+  def test_changed_fields(self):
+    """ Verify changed_fields and the update sent for a loaded donor """
+
+    donor = models.Donor.objects.get(pk=self.donor_id)
+    self.assertEqual(donor.changed_fields, [])
+    self.assertEqual(self.count_queries(donor.save), 0)
+
+    donor.amount = 750
+    donor.notes = 'Call after 5'
+    self.assertEqual(sorted(donor.changed_fields), ['amount', 'notes'])
+
+    start = len(connection.queries)
+    connection.use_debug_cursor = True
+    donor.save()
+    connection.use_debug_cursor = False
+    updates = [q['sql'] for q in connection.queries[start:]
+               if q['sql'].startswith('UPDATE "fund_donor"')]
+    self.assertEqual(len(updates), 1)
+    self.assertIn('"notes"', updates[0])
+    self.assertNotIn('"firstname"', updates[0])
+    self.assertEqual(donor.changed_fields, [])
+
+    self.assertEqual(models.Donor.objects.get(pk=self.donor_id).amount, 750)
+
+  def test_stale_instance(self):
+    """ Verify assigning the loaded value still writes it, and a row deleted
+        since loading is re-inserted """
+
+    donor = models.Donor.objects.get(pk=self.donor_id)
+    models.Donor.objects.filter(pk=self.donor_id).update(amount=900)
+    donor.amount = 500
+    self.assertEqual(donor.changed_fields, ['amount'])
+    donor.save()
+    self.assertEqual(models.Donor.objects.get(pk=self.donor_id).amount, 500)
+
+    models.Donor.objects.filter(pk=self.donor_id).delete()
+    donor.notes = 'Back again'
+    donor.save()
+    self.assertEqual(models.Donor.objects.get(pk=self.donor_id).notes, 'Back again')
+
+  def test_membership_approval(self):
+    """ Verify approval is detected without re-reading the membership """
+
+    gp = models.GivingProject.objects.get(title='Pre training')
+    ship = models.Membership(giving_project=gp, member_id=self.member_id)
+    ship.save()
+
+    ship = models.Membership.objects.get(pk=ship.pk)
+    ship.approved = True
+    self.assertEqual(self.count_queries(ship.save, skip=True), 1)
+    self.assertEqual(len(mail.outbox), 0)
+
+    ship = models.Membership.objects.get(pk=ship.pk)
+    ship.approved = False
+    ship.save()
+    ship = models.Membership.objects.get(pk=ship.pk)
+    ship.approved = True
+    ship.save()
+    self.assertEqual(len(mail.outbox), 1)
+
+    ship.notifications = 'Approved!'
+    ship.save()
+    self.assertEqual(len(mail.outbox), 1)
+
+
+@override_settings(MIDDLEWARE_CLASSES = TEST_MIDDLEWARE,
+    PASSWORD_HASHERS = ('django.contrib.auth.hashers.MD5PasswordHasher',))
+class Notifications(BaseFundTestCase):
+  """ Notifications on the home page """
+
+  fixtures = TEST_FIXTURE
+  url = reverse('sjfnw.fund.views.home')
+
+  def setUp(self):
+    super(Notifications, self).setUp('testy')
+
+  def writes(self, func, *args, **kwargs):
+    """ SQL statements other than selects run by func """
+    start = len(connection.queries)
+    self.count_queries(func, *args, **kwargs)
+    return [query['sql'] for query in connection.queries[start:]
+            if not query['sql'].lstrip().upper().startswith('SELECT')]
+
+  def test_gifts(self):
+    """ Verify gift notifications stack, viewing home doesn't write and
+        notifications are marked seen in one batch """
+    donor = models.Donor.objects.get(pk=self.donor_id)
+    donor.received_this = 50
+    donor.save()
+    self.client.get('/mail/gifts')
+    donor.received_next, donor.gift_notified = 75, False
+    donor.save()
+    self.client.get('/mail/gifts')
+
+    notifications = models.Notification.unseen(self.ship_id)
+    self.assertEqual(len(notifications), 2)
+    self.assertEqual(notifications[1].data()['gifts'][0]['amount'], 125)
+
+    self.client.get(self.url) # session setup
+    response = self.client.get(self.url)
+    self.assertContains(response, '$50 gift or pledge received')
+    self.assertContains(response, '$125 gift or pledge received')
+    self.assertEqual(self.writes(self.client.get, self.url), [])
+
+    post_url = reverse('sjfnw.fund.views.notifications_seen')
+    data = {'id': [notification.pk for notification in notifications]}
+    self.assertEqual(len(self.writes(self.client.post, post_url, data)), 1)
+    self.assertEqual(models.Notification.unseen(self.ship_id), [])
+    self.assertNotContains(self.client.get(self.url), 'gift or pledge received')
+
+
+@override_settings(MIDDLEWARE_CLASSES = TEST_MIDDLEWARE,
+    PASSWORD_HASHERS = ('django.contrib.auth.hashers.MD5PasswordHasher',))
+class ActivityTracking(BaseFundTestCase):
+  """ Coalesced last_activity updates """
+
+  fixtures = TEST_FIXTURE
+
+  def setUp(self):
+    super(ActivityTracking, self).setUp('testy')
+
+  def test_touch_and_flush(self):
+    """ Verify touches don't query, and are written once per day in a flush """
+    self.client.post(reverse('sjfnw.fund.views.add_mult'), {
+        'form-TOTAL_FORMS': 0, 'form-INITIAL_FORMS': 0, 'form-MAX_NUM_FORMS': 1000})
+    ship = models.Membership.objects.get(pk=self.ship_id)
+    self.assertIsNone(ship.last_activity)
+    self.assertEqual(self.count_queries(activity.touch, ship), 0)
+
+    self.assertEqual(activity.flush(), 1)
+    self.assertEqual(activity.flush(), 0)
+    ship = models.Membership.objects.get(pk=self.ship_id)
+    self.assertEqual(ship.last_activity, activity.today())
+
+    activity.touch(ship)
+    self.assertEqual(activity.flush(), 0)
+
+    other = models.Membership.objects.exclude(pk=self.ship_id)[0]
+    activity.touch(other)
+    self.client.get('/cron/activity')
+    self.assertEqual(models.Membership.objects.get(pk=other.pk).last_activity,
+                     activity.today())
+
+  def test_flush_during_touch(self):
+    """ Verify a flush doesn't pass an entry a touch hasn't set yet, and
+        skips an entry that was lost """
+    ship = models.Membership.objects.get(pk=self.ship_id)
+    other = models.Membership.objects.exclude(pk=self.ship_id)[0]
+    date = activity.today()
+    count_key = activity._key(date, 'count')
+
+    activity.touch(ship)
+    cache.incr(count_key) # a touch of other has taken index 2, not set it yet
+    self.assertEqual(activity.flush(), 1)
+    cache.set(activity._key(date, 'ship-2'), other.pk)
+    self.assertEqual(activity.flush(), 1)
+    self.assertEqual(models.Membership.objects.get(pk=other.pk).last_activity, date)
+
+    cache.incr(count_key) # index 3 is never set
+    self.assertEqual(activity.flush(), 0)
+    self.assertEqual(activity.flush(), 0)
+    self.assertEqual(cache.get(activity._key(date, 'flushed')), 3)
+
+
+@override_settings(MIDDLEWARE_CLASSES = TEST_MIDDLEWARE,
+    PASSWORD_HASHERS = ('django.contrib.auth.hashers.MD5PasswordHasher',))
+class PreApproval(BaseFundTestCase):
+  """ Pre-approved emails for registration """
+
+  fixtures = TEST_FIXTURE
+
+  def setUp(self):
+    super(PreApproval, self).setUp('testy')
+    self.pre = models.GivingProject.objects.get(title='Pre training')
+    ship = models.Membership(giving_project=self.pre, member_id=self.member_id)
+    ship.save()
+    self.new_ship_id = ship.pk
+    member = models.Member.objects.get(pk=self.member_id)
+    member.current = ship.pk
+    member.save()
+
+  def test_parse(self):
+    """ Verify pasted lists are split, normalized and validated """
+    emails, invalid = models.PreApprovedEmail.parse(
+        'A@b.org, Test Acct <TestAcct@gmail.com>;\nc@d.com  a@b.org, oops')
+    self.assertEqual(emails, ['a@b.org', 'testacct@gmail.com', 'c@d.com'])
+    self.assertEqual(invalid, ['oops'])
+
+    form = modelforms.GivingProjectAdminForm(
+        {'pre_approved_emails': 'a@b.org, oops'}, instance=self.pre)
+    self.assertIn('pre_approved_emails', form.errors)
+
+    self.assertEqual(models.PreApprovedEmail.replace(self.pre.pk, emails), (3, 0))
+    self.assertEqual(models.PreApprovedEmail.replace(self.pre.pk, emails[1:]), (0, 1))
+
+  def test_registered(self):
+    """ Verify a pre-approved membership is approved in one indexed lookup
+
+    Without ?sh, registered checks member.current, which the middleware
+    leaves on the new (unapproved) membership """
+    response = self.client.get('/fund/registered')
+    self.assertTemplateUsed(response, 'fund/registered.html')
+    self.assertFalse(models.Membership.objects.get(pk=self.new_ship_id).approved)
+    self.assertEqual(models.Member.objects.get(pk=self.member_id).current,
+                     self.new_ship_id)
+
+    models.PreApprovedEmail(giving_project=self.pre,
+                            email='testacct@gmail.com').save()
+    response = self.client.get('/fund/registered')
+    self.assertRedirects(response, reverse('sjfnw.fund.views.home'))
+    self.assertTrue(models.Membership.objects.get(pk=self.new_ship_id).approved)
+
+
+@override_settings(MIDDLEWARE_CLASSES = TEST_MIDDLEWARE,
+    PASSWORD_HASHERS = ('django.contrib.auth.hashers.MD5PasswordHasher',))
+class OverdueEmails(BaseFundTestCase):
+  """ Overdue steps reminder cron """
+
+  url = '/mail/overdue-step'
+
+  def setUp(self):
+    super(OverdueEmails, self).setUp('')
+    self.gp = models.GivingProject.objects.get(title='Post training')
+    self.today = timezone.now().date()
+
+  def add_membership(self, i, overdue_dates, emailed=None, gp=None):
+    member = models.Member(first_name='Member', last_name=str(i),
+                           email='member%d@gmail.com' % i)
+    member.save()
+    ship = models.Membership(giving_project=gp or self.gp, member=member,
+                             approved=True, emailed=emailed)
+    ship.save()
+    donor = models.Donor(membership=ship, firstname='Donor')
+    donor.save()
+    for days in overdue_dates:
+      models.Step(donor=donor, description='Step %d' % days,
+                  date=self.today - timedelta(days=days)).save()
+    return ship
+
+  def test_reminders(self):
+    """ Verify who is emailed, the step shown and emailed stamps """
+
+    due = self.add_membership(1, [3, 10])
+    self.add_membership(2, [0]) # not overdue yet
+    self.add_membership(3, [5], emailed=self.today - timedelta(days=2))
+    old = self.add_membership(4, [5], emailed=self.today - timedelta(days=8))
+    self.add_membership(5, [5], gp=models.GivingProject.objects.create(
+        title='Over', fund_goal=100,
+        fundraising_training=self.today - timedelta(days=100),
+        fundraising_deadline=self.today - timedelta(days=10)))
+
+    self.client.get(self.url)
+
+    self.assertEqual(sorted(m.to[0] for m in mail.outbox),
+                     ['member1@gmail.com', 'member4@gmail.com'])
+    body = [m.body for m in mail.outbox if m.to[0] == 'member1@gmail.com'][0]
+    self.assertIn('Step 3', body)
+    emailed = models.Membership.objects.filter(emailed=self.today)
+    self.assertEqual(sorted(ship.pk for ship in emailed), [due.pk, old.pk])
+
+    self.client.get(self.url)
+    self.assertEqual(len(mail.outbox), 2)
+
+  def test_chunks(self):
+    """ Verify chunks cover every membership, with constant queries per chunk """
+
+    for i in range(5):
+      self.add_membership(i, [4])
+    small = self.count_queries(views.email_overdue_chunk, size=5)
+    self.assertEqual(len(mail.outbox), 5)
+
+    for i in range(5, 20):
+      self.add_membership(i, [4])
+    models.Membership.objects.update(emailed=None)
+    mail.outbox = []
+    large = self.count_queries(views.email_overdue_chunk, size=5)
+    self.assertEqual(len(mail.outbox), 20)
+    # each chunk runs the same queries, plus one to find there are no more
+    self.assertEqual(large - 1, (small - 1) * 4)
+
+
+@override_settings(MIDDLEWARE_CLASSES = TEST_MIDDLEWARE,
+    PASSWORD_HASHERS = ('django.contrib.auth.hashers.MD5PasswordHasher',))
+class AddMultiple(BaseFundTestCase):
+  """ Adding multiple contacts at once """
+
+  fixtures = TEST_FIXTURE
+  url = reverse('sjfnw.fund.views.add_mult')
+
+  def setUp(self):
+    super(AddMultiple, self).setUp('testy')
+
+  def form_data(self, names):
+    data = {'form-TOTAL_FORMS': len(names), 'form-INITIAL_FORMS': 0,
+            'form-MAX_NUM_FORMS': 1000}
+    for i, (first, last) in enumerate(names):
+      data.update({'form-%d-firstname' % i: first, 'form-%d-lastname' % i: last,
+                   'form-%d-amount' % i: 100, 'form-%d-likelihood' % i: 50,
+                   'form-%d-confirm' % i: ''})
+    return data
+
+  def test_bulk_add(self):
+    """ Verify contacts are created in a handful of queries, duplicates are
+        matched by normalized name and progress is updated """
+
+    names = [('Contact', str(i)) for i in range(99)] + [(' anna', '')]
+    queries = self.count_queries(self.client.post, self.url,
+                                 self.form_data(names))
+
+    self.assertLess(queries, 20)
+    self.assertEqual(models.Donor.objects.filter(membership_id=self.ship_id).count(), 100)
+    self.assertFalse(models.Donor.objects.filter(firstname=' anna').exists())
+    progress = models.MembershipProgress.get_for(self.ship_id)
+    self.assertEqual(progress.contacts, 100)
+    self.assertEqual(progress.estimated, 250 + 99 * 50)
+
+    # confirmed duplicate is added
+    data = self.form_data([('Anna', '')])
+    data['form-0-confirm'] = '1'
+    self.client.post(self.url, data)
+    self.assertEqual(models.MembershipProgress.get_for(self.ship_id).contacts, 101)
+
+
+@override_settings(MIDDLEWARE_CLASSES = TEST_MIDDLEWARE,
+    PASSWORD_HASHERS = ('django.contrib.auth.hashers.MD5PasswordHasher',))
+class ProgressSnapshots(BaseFundTestCase):
+  """ Daily progress snapshots """
+
+  fixtures = TEST_FIXTURE
+
+  def setUp(self):
+    super(ProgressSnapshots, self).setUp('testy')
+
+  def test_take(self):
+    """ Verify every membership in a fundraising project is snapshotted,
+        changed that day or not, and retaking a day replaces its rows """
+    today = timezone.localtime(timezone.now()).date()
+    ship = models.Membership.objects.get(pk=self.ship_id)
+    pre = models.GivingProject.objects.get(title='Pre training')
+    unchanged = models.Membership(giving_project=pre, member_id=self.member_id)
+    unchanged.save()
+    models.MembershipProgress.objects.update(
+        updated=timezone.now() - timedelta(days=3))
+    models.Donor(membership=ship, firstname='New', promised=200,
+                 received_this=50, asked=True).save()
+    models.Donor(membership=ship, firstname='Pending', promised=75).save()
+
+    projects = models.GivingProject.objects.filter(fundraising_deadline__gte=today)
+    expected = (projects.count() + models.MembershipProgress.objects.filter(
+        membership__giving_project__in=projects).count())
+    self.assertEqual(models.ProgressSnapshot.take(today), expected)
+    self.assertEqual(models.ProgressSnapshot.take(today), expected)
+    self.assertEqual(models.ProgressSnapshot.objects.count(), expected)
+    self.assertTrue(models.ProgressSnapshot.objects.filter(
+        membership=unchanged, date=today).exists())
+
+    progress = models.MembershipProgress.get_for(ship.pk)
+    date, totals = models.ProgressSnapshot.series(ship.giving_project_id, ship.pk)[0]
+    self.assertEqual(date, today)
+    self.assertEqual(totals['contacts'], progress.contacts)
+    self.assertEqual(totals['promised'], 75) # as the project page shows it
+    self.assertEqual(totals['promised'], progress.promised_pending)
+    self.assertEqual(totals['received'], progress.received_total())
+
+    project = ship.giving_project.get_progress()
+    date, totals = models.ProgressSnapshot.series(ship.giving_project_id)[0]
+    self.assertEqual(totals['asked'], project['asked'])
+
+
+@override_settings(MIDDLEWARE_CLASSES = TEST_MIDDLEWARE,
+    PASSWORD_HASHERS = ('django.contrib.auth.hashers.MD5PasswordHasher',))
+class AddEstimates(BaseFundTestCase):
+  """ Adding estimates to contacts in bulk """
+
+  fixtures = TEST_FIXTURE
+  url = reverse('sjfnw.fund.views.add_estimates')
+
+  def setUp(self):
+    super(AddEstimates, self).setUp('testy')
+
+  def test_bulk_estimates(self):
+    """ Verify estimates are saved with one update per distinct value and
+        progress is updated """
+
+    for i in range(40):
+      models.Donor(membership_id=self.ship_id, firstname='Donor',
+                   lastname=str(i)).save()
+    donors = models.Donor.objects.filter(membership_id=self.ship_id, amount=None)
+    ids = list(donors.values_list('pk', flat=True))
+    self.assertEqual(len(ids), 40)
+
+    data = {'form-TOTAL_FORMS': 40, 'form-INITIAL_FORMS': 40,
+            'form-MAX_NUM_FORMS': 1000}
+    for i, pk in enumerate(ids):
+      data.update({'form-%d-donor' % i: pk,
+                   'form-%d-amount' % i: 100 if i < 30 else 200,
+                   'form-%d-likelihood' % i: 50 if i < 30 else 25})
+    queries = self.count_queries(self.client.post, self.url, data)
+
+    self.assertLess(queries, 20)
+    self.assertFalse(donors.exists())
+    self.assertEqual(
+        models.Donor.objects.filter(pk__in=ids, amount=200, likelihood=25).count(), 10)
+    progress = models.MembershipProgress.get_for(self.ship_id)
+    self.assertEqual(progress.contacts, 41)
+    self.assertEqual(progress.estimated, 250 + 30 * 50 + 10 * 50)
+
+
+@override_settings(MIDDLEWARE_CLASSES = TEST_MIDDLEWARE,
+    PASSWORD_HASHERS = ('django.contrib.auth.hashers.MD5PasswordHasher',))
+class AddMultipleSteps(BaseFundTestCase):
+  """ Step candidates for the add multiple steps form """
+
+  fixtures = TEST_FIXTURE
+  url = reverse('sjfnw.fund.views.add_mult_step')
+
+  def setUp(self):
+    super(AddMultipleSteps, self).setUp('testy')
+
+  def add_donors(self, count, **kwargs):
+    donors = []
+    for i in range(count):
+      donor = models.Donor(membership_id=self.ship_id, firstname='Donor',
+                           lastname=str(i), **kwargs)
+      donor.save()
+      donors.append(donor)
+    return donors
+
+  def test_candidates(self):
+    """ Verify donors with open steps, promises or gifts are left out, and
+        the query count doesn't grow with the number of contacts """
+
+    # Anna (from setUp) has an open step
+    completed = self.add_donors(1)[0]
+    models.Step(donor=completed, description='Done', date='2013-04-06',
+                completed=timezone.now()).save()
+    self.add_donors(2, promised=100)
+    self.add_donors(2, received_next=50)
+    fresh = self.add_donors(3)
+
+    response = self.client.get(self.url)
+    self.assertEqual(sorted(donor.pk for form, donor in response.context['fd']),
+                     sorted([completed.pk] + [donor.pk for donor in fresh]))
+    queries = self.count_queries(self.client.get, self.url)
+
+    self.add_donors(30)
+    response = self.client.get(self.url)
+    self.assertEqual(response.context['size'], 10)
+    self.assertEqual(self.count_queries(self.client.get, self.url), queries)
+
+    donor = models.Donor.objects.with_open_step().get(pk=self.donor_id)
+    self.assertTrue(donor.has_open_step)
+
+  def test_post(self):
+    """ Verify the form carries donor ids and steps are only added to the
+        membership's own donors """
+    fresh = self.add_donors(2)
+    other_ship = models.Membership.objects.exclude(pk=self.ship_id)[0]
+    other = models.Donor(membership=other_ship, firstname='Other')
+    other.save()
+
+    response = self.client.get(self.url)
+    self.assertContains(response, 'value="%d"' % fresh[0].pk)
+
+    response = self.client.post(self.url, {
+        'form-TOTAL_FORMS': 3, 'form-INITIAL_FORMS': 3, 'form-MAX_NUM_FORMS': 1000,
+        'form-0-donor': fresh[0].pk, 'form-0-date': '12/1/2013',
+        'form-0-description': 'Talk to about project',
+        'form-1-donor': fresh[1].pk, 'form-1-date': '', 'form-1-description': '',
+        'form-2-donor': other.pk, 'form-2-date': '12/1/2013',
+        'form-2-description': 'Ask'})
+    self.assertEqual(response.content, 'success')
+    self.assertEqual(models.Step.objects.filter(donor=fresh[0]).count(), 1)
+    self.assertFalse(models.Step.objects.filter(donor__in=[fresh[1], other]).exists())
@@ -12,6 +12,7 @@ urlpatterns = patterns('sjfnw.fund.views',
   (r'^$', 'home'),
   (r'^gp/?', 'project_page'),
   (r'^grants/?', 'grant_list'),
+  (r'^notifications/seen$', 'notifications_seen'),
 
   #manage memberships
   (r'^projects/?', 'manage_account'),
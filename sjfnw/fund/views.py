@@ -1,13 +1,16 @@
 ﻿from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth import authenticate, login
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.contrib.humanize.templatetags.humanize import intcomma
-from django.core.mail import EmailMultiAlternatives
+from django.core.cache import cache
+from django.core.mail import EmailMultiAlternatives, get_connection
 from django.core.urlresolvers import reverse
+from django.db.models import Count, Max, Q
 from django.forms.formsets import formset_factory
 from django.http import HttpResponse, Http404
-from django.shortcuts import render, redirect
+from django.shortcuts import get_object_or_404, render, redirect
 from django.template.loader import render_to_string
 from django.utils import timezone
 from django.utils.html import strip_tags
@@ -18,9 +21,9 @@ from sjfnw import constants
 from sjfnw.grants.models import Organization, GrantApplication, ProjectApp
 
 from sjfnw.fund.decorators import approved_membership
-from sjfnw.fund import forms, modelforms, models, utils
+from sjfnw.fund import activity, blocks, bulk, dedupe, forms, modelforms, models, utils
 
-import datetime, logging, os, json
+import datetime, logging, operator, os, json
 
 if not settings.DEBUG:
   ereporter.register_logger()
@@ -29,9 +32,32 @@ logger = logging.getLogger('sjfnw')
 
 # MAIN VIEWS
 
+def get_project_blocks(giving_project):
+  """ Query the news and grants blocks shared by a project's members
+
+  Returns:
+    news: news items, sorted by date descending
+    grants: ProjectApps ordered by org name
+  """
+  news = list(models.NewsItem.objects
+              .filter(membership__giving_project=giving_project)
+              .order_by('-date')[:25])
+  p_apps = ProjectApp.objects.filter(giving_project=giving_project)
+  p_apps = p_apps.select_related('giving_project', 'application',
+      'application__organization')
+  # never show screened out by sub-committee
+  p_apps = p_apps.exclude(application__pre_screening_status=45)
+  if giving_project.site_visits == 1:
+    logger.info('Filtering grants for site visits')
+    p_apps = p_apps.filter(screening_status__gte=70)
+  p_apps = p_apps.order_by('application__organization__name')
+  return news, list(p_apps)
+
 def get_block_content(membership, get_steps=True):
   """ Provide upper block content for the 3 main views
 
+  News and grants come from the giving project's shared cache (see blocks)
+
   Args:
     membership: current Membership
     get_steps: include list of upcoming steps or not (default True)
@@ -48,21 +74,10 @@ def get_block_content(membership, get_steps=True):
     bks.append(models.Step.objects.select_related('donor')
                      .filter(donor__membership=membership,
                      completed__isnull=True).order_by('date')[:2])
-  # project news
-  bks.append(models.NewsItem.objects
-            .filter(membership__giving_project=membership.giving_project)
-            .order_by('-date')[:25])
-  # grants
-  p_apps = ProjectApp.objects.filter(giving_project=membership.giving_project)
-  p_apps = p_apps.select_related('giving_project', 'application',
-      'application__organization')
-  # never show screened out by sub-committee
-  p_apps = p_apps.exclude(application__pre_screening_status=45)
-  if membership.giving_project.site_visits == 1:
-    logger.info('Filtering grants for site visits')
-    p_apps = p_apps.filter(screening_status__gte=70)
-  p_apps = p_apps.order_by('application__organization__name')
-  bks.append(p_apps)
+  # project news & grants
+  giving_project = membership.giving_project
+  bks.extend(blocks.get_or_fill(giving_project.pk,
+                                lambda: get_project_blocks(giving_project)))
 
   return bks
 
@@ -86,14 +101,10 @@ def home(request):
   membership = request.membership
 
   # check if there's a survey to fill out
-  surveys = models.GPSurvey.objects.filter(
-      giving_project=membership.giving_project, date__lte=timezone.now()
-  ).exclude(
-      id__in=json.loads(membership.completed_surveys)
-  ).order_by('date')
-  if surveys:
+  pending = membership.pending_survey()
+  if pending:
     logger.info('Needs to fill out survey; redirecting')
-    return redirect(reverse('sjfnw.fund.views.gp_survey', kwargs = {'gp_survey': surveys[0].pk}))
+    return redirect(reverse('sjfnw.fund.views.gp_survey', kwargs = {'gp_survey': pending}))
 
 
   # check if they have contacts
@@ -134,26 +145,25 @@ def home(request):
   news, grants = get_block_content(membership, get_steps=False)
   header = membership.giving_project.title
 
+  # progress totals
+  progress = models.MembershipProgress.get_for(membership.pk)
+  prog = {'contacts': progress.contacts, 'estimated': progress.estimated,
+          'talked': progress.talked, 'asked': progress.asked,
+          'promised': progress.promised_pending,
+          'received': progress.received_total()}
+
   # collect & organize contact data
-  prog = {'contacts':len(donors), 'estimated':0, 'talked':0, 'asked':0,
-          'promised':0, 'received':0}
   donor_data = {}
   empty_date = datetime.date(2500, 1, 1)
   for donor in donors:
     donor_data[donor.pk] = {'donor':donor, 'complete_steps':[],
                             'next_step':False, 'next_date':empty_date,
                             'overdue':False}
-    prog['estimated'] += donor.estimated()
     if donor.asked:
-      prog['asked'] += 1
       donor_data[donor.pk]['next_date'] = datetime.date(2600, 1, 1)
-    elif donor.talked:
-      prog['talked'] += 1
     if donor.received() > 0:
-      prog['received'] += donor.received()
       donor_data[donor.pk]['next_date'] = datetime.date(2800, 1, 1)
     elif donor.promised:
-      prog['promised'] += donor.promised
       donor_data[donor.pk]['next_date'] = datetime.date(2700, 1, 1)
 
   # progress chart calculations
@@ -172,12 +182,8 @@ def home(request):
     logger.error('No contacts but no redirect to add_mult')
     prog['contactsremaining'] = 0
 
-  notif = membership.notifications #TODO replace with messages
-  #on live, only show a notification once
-  if notif and not settings.DEBUG:
-    logger.info('Displaying notification to ' + unicode(membership) + ': ' + notif)
-    membership.notifications = ''
-    membership.save(skip=True)
+  # marked seen by the page once shown (see notifications_seen)
+  notifications = models.Notification.unseen(membership.pk)
 
   # get all steps
   step_list = list(models.Step.objects.filter(donor__membership=membership).order_by('date'))
@@ -205,7 +211,18 @@ def home(request):
   return render(request, 'fund/page_personal.html', {
     '1active':'true', 'header':header, 'news':news, 'grants':grants,
     'steps':upcoming_steps, 'donor_list': donor_list, 'progress':prog,
-    'notif':notif, 'suggested':suggested, 'load':load, 'loadto':loadto})
+    'notifications':notifications, 'suggested':suggested, 'load':load,
+    'loadto':loadto})
+
+@login_required(login_url='/fund/login/')
+@approved_membership()
+def notifications_seen(request):
+  """ AJAX - marks the posted notification ids seen. On live, notifications
+      are only shown once """
+  if request.method == 'POST' and not settings.DEBUG:
+    ids = [int(pk) for pk in request.POST.getlist('id') if pk.isdigit()]
+    models.Notification.mark_seen(request.membership.pk, ids)
+  return HttpResponse('success')
 
 @login_required(login_url='/fund/login/')
 @approved_membership()
@@ -213,24 +230,20 @@ def project_page(request):
 
   membership = request.membership
   member = membership.member
-  project = membership.giving_project
+  models.MembershipProgress.fill_missing(membership.giving_project_id)
+  project = models.GivingProject.objects.with_progress().get(
+      pk=membership.giving_project_id)
 
   #blocks
   steps, news, grants = get_block_content(membership)
 
-  project_progress = {'contacts':0, 'talked':0, 'asked':0, 'promised':0, 'received':0}
-  donors = list(models.Donor.objects.filter(membership__giving_project=project))
-  project_progress['contacts'] = len(donors)
-  for donor in donors:
-    #project_progress['estimated'] += donor.estimated()
-    if donor.asked:
-      project_progress['asked'] += 1
-    elif donor.talked:
-      project_progress['talked'] += 1
-    if donor.received() > 0:
-      project_progress['received'] += donor.received()
-    elif donor.promised:
-      project_progress['promised'] += donor.promised
+  totals = project.get_progress()
+  project_progress = {'contacts': totals['contacts'],
+                      'talked': totals['talked'], 'asked': totals['asked'],
+                      'promised': totals['promised_pending'],
+                      'received': (totals['received_this'] +
+                                   totals['received_next'] +
+                                   totals['received_afternext'])}
 
   project_progress['contactsremaining'] = project_progress['contacts'] - project_progress['talked'] -  project_progress['asked']
   project_progress['togo'] =  project.fund_goal - project_progress['promised'] -  project_progress['received']
@@ -238,6 +251,8 @@ def project_page(request):
     project_progress['togo'] = 0
 
   resources = models.ProjectResource.objects.filter(giving_project = project).select_related('resource').order_by('session')
+  history = [[date.strftime('%m/%d'), totals['promised'], totals['received']]
+             for date, totals in models.ProgressSnapshot.series(project.pk)]
 
   #base
   header = project.title
@@ -249,6 +264,7 @@ def project_page(request):
   'grants':grants,
   'steps':steps,
   'project_progress':project_progress,
+  'progress_history':json.dumps(history) if len(history) > 1 else '',
   'resources':resources})
 
 @login_required(login_url='/fund/login/')
@@ -323,8 +339,9 @@ def fund_register(request):
         if gp: #create Membership
           giv = models.GivingProject.objects.get(pk=gp)
           membership = models.Membership(member = member, giving_project = giv)
-          membership.notifications = '<table><tr><td>Welcome to Project Central!<br>I\'m Odo, your Online Donor Organizing assistant. I\'ll be here to guide you through the fundraising process and cheer you on.</td><td><img src="/static/images/odo1.png" height=88 width=54 alt="Odo waving"></td></tr></table>'
           membership.save()
+          models.Notification(membership=membership,
+                              kind=models.Notification.WELCOME).save()
           member.current = membership.pk
           member.save()
           logger.info('Registration - membership in ' + unicode(giv) + 'created, welcome message set')
@@ -371,19 +388,17 @@ def registered(request):
     logger.warning('Membership approved before check at /registered ' + request.user.username)
     return redirect(home)
 
-  proj = ship.giving_project
-  if proj.pre_approved:
-    app_list = [email.strip().lower() for email in proj.pre_approved.split(',')]
-    logger.info('Checking pre-approval for ' + request.user.username + ' in ' + unicode(proj) + ', list: ' + proj.pre_approved)
-    if ship.member.email in app_list:
-      ship.approved = True
-      ship.save(skip=True)
-      member.current = nship
-      member.save()
-      logger.info('Pre-approval succeeded')
-      return redirect(home)
+  if models.PreApprovedEmail.is_approved(ship.giving_project_id, member.email):
+    ship.approved = True
+    ship.save(skip=True)
+    member.current = nship
+    member.save()
+    logger.info('Pre-approval succeeded for ' + request.user.username +
+                ' in project ' + unicode(ship.giving_project_id))
+    return redirect(home)
 
-  return render(request, 'fund/registered.html', {'member':member, 'proj':proj})
+  return render(request, 'fund/registered.html',
+                {'member':member, 'proj':ship.giving_project})
 
 # MEMBERSHIP MANAGEMENT
 
@@ -479,10 +494,8 @@ def gp_survey(request, gp_survey):
     if form.is_valid():
       resp = form.save()
       logger.info('survey response saved')
-      completed = json.loads(request.membership.completed_surveys)
-      completed.append(gp_survey.pk)
-      request.membership.completed_surveys = json.dumps(completed)
-      request.membership.save()
+      models.SurveyCompletion.objects.get_or_create(
+          membership=request.membership, gp_survey=gp_survey)
       return HttpResponse('success')
 
   else: #GET
@@ -493,6 +506,70 @@ def gp_survey(request, gp_survey):
   return render(request, 'fund/fill_gp_survey.html', {
     'form': form, 'survey': gp_survey.survey, 'news': news, 'steps': steps, 'grants': grants})
 
+AUTOCOMPLETE_LIMIT = 20
+
+def autocomplete_response(matches):
+  return HttpResponse(json.dumps([{'id': pk, 'label': label} for pk, label in matches]),
+                      content_type='application/json')
+
+@staff_member_required
+def search_members(request):
+  """ Admin autocomplete - members whose first name, last name or email starts
+      with ?q, or first & last name for "first last" """
+  term = request.GET.get('q', '').strip()
+  if not term:
+    return autocomplete_response([])
+  parts = term.split(None, 1)
+  if len(parts) > 1:
+    query = Q(first_name__istartswith=parts[0], last_name__istartswith=parts[1])
+  else:
+    query = (Q(first_name__istartswith=term) | Q(last_name__istartswith=term) |
+             Q(email__istartswith=term))
+  members = (models.Member.objects.filter(query)
+             .values_list('pk', 'first_name', 'last_name')[:AUTOCOMPLETE_LIMIT])
+  return autocomplete_response((pk, first + u' ' + last) for pk, first, last in members)
+
+@staff_member_required
+def search_applications(request):
+  """ Admin autocomplete - grant applications from organizations whose name
+      starts with ?q. Pass ?gp to limit to the year before that giving
+      project's fundraising deadline """
+  term = request.GET.get('q', '').strip()
+  if not term:
+    return autocomplete_response([])
+  gp = request.GET.get('gp', '')
+  if gp and not gp.isdigit():
+    return autocomplete_response([])
+  apps = GrantApplication.objects.filter(organization__name__istartswith=term)
+  if gp:
+    deadline = models.GivingProject.objects.filter(pk=gp).values_list(
+        'fundraising_deadline', flat=True)
+    if deadline:
+      apps = apps.filter(submission_time__gte=deadline[0] - datetime.timedelta(weeks=52))
+  apps = (apps.order_by('organization__name', '-submission_time')
+          .values_list('pk', 'organization__name', 'grant_cycle__title')[:AUTOCOMPLETE_LIMIT])
+  return autocomplete_response((pk, u'%s - %s' % (org, cycle)) for pk, org, cycle in apps)
+
+@staff_member_required
+def survey_results(request, gp_survey_id):
+  """ Staff summary of a GP survey's multiple choice answers, from the
+      precomputed SurveyAnswerCounts """
+  gp_survey = get_object_or_404(
+      models.GPSurvey.objects.select_related('survey', 'giving_project'),
+      pk=gp_survey_id)
+  counts = dict(((index, answer), count) for index, answer, count in
+                gp_survey.answer_counts.values_list('question_index', 'answer', 'count'))
+
+  results = []
+  for i, question in enumerate(json.loads(gp_survey.survey.questions)):
+    if question['choices']:
+      results.append({'question': question['question'],
+                      'choices': [(choice, counts.get((i, unicode(choice)), 0))
+                                  for choice in question['choices']]})
+  return render(request, 'admin/fund/survey_results.html', {
+    'gp_survey': gp_survey, 'results': results,
+    'responses': gp_survey.surveyresponse_set.count()})
+
 
 
 # CONTACTS
@@ -517,13 +594,11 @@ def copy_contacts(request):
       formset = copy_formset(request.POST)
       logger.info('Copy contracts submitted')
       if formset.is_valid():
-        for form in formset.cleaned_data:
-          if form['select']:
-            contact = models.Donor(membership = request.membership,
-                firstname = form['firstname'], lastname = form['lastname'],
-                phone = form['phone'], email = form['email'], notes = form['notes'])
-            contact.save()
-            logger.debug('Contact created')
+        contacts = [models.Donor(membership = request.membership,
+                        firstname = form['firstname'], lastname = form['lastname'],
+                        phone = form['phone'], email = form['email'], notes = form['notes'])
+                    for form in formset.cleaned_data if form['select']]
+        bulk.create(models.Donor, contacts)
         request.membership.copied_contacts = True
         request.membership.save()
         return HttpResponse("success")
@@ -532,24 +607,12 @@ def copy_contacts(request):
         logger.warning(formset.errors)
 
   else: #GET
-    all_donors = models.Donor.objects.filter(membership__member=request.membership.member).order_by('firstname', 'lastname', '-added')
-    # extract name, contact info, notes. handle duplicates
-    initial_data = []
-    for donor in all_donors:
-      if (initial_data and donor.firstname == initial_data[-1]['firstname'] and
-             (donor.lastname and donor.lastname == initial_data[-1]['lastname'] or
-                 donor.phone and donor.phone == initial_data[-1]['phone'] or
-                 donor.email and donor.email == initial_data[-1]['email'])): #duplicate - do not override
-        logger.info('Duplicate found! ' + str(donor))
-        initial_data[-1]['lastname'] = initial_data[-1]['lastname'] or donor.lastname
-        initial_data[-1]['phone'] = initial_data[-1]['phone'] or donor.phone
-        initial_data[-1]['email'] = initial_data[-1]['email'] or donor.email
-        initial_data[-1]['notes'] += donor.notes
-        initial_data[-1]['notes'] = initial_data[-1]['notes'][:253]
-      else: #not duplicate; add a row
-        initial_data.append({
-            'firstname': donor.firstname, 'lastname': donor.lastname,
-            'phone': donor.phone, 'email': donor.email, 'notes': donor.notes})
+    # newest first, so the most recent details win when merging
+    all_donors = (models.Donor.objects
+        .filter(membership__member=request.membership.member)
+        .order_by('-added', '-pk')
+        .values('firstname', 'lastname', 'phone', 'email', 'notes'))
+    initial_data = dedupe.dedupe(all_donors)
 
     logger.info('initial data list of ' + str(len(initial_data)))
     formset = copy_formset(initial=initial_data)
@@ -578,20 +641,20 @@ def add_mult(request):
   empty_error = ''
 
   if request.method == 'POST':
-    membership.last_activity = timezone.now()
-    membership.save()
+    activity.touch(membership)
     formset = contact_formset(request.POST)
     if formset.is_valid():
       if formset.has_changed():
         logger.info('AddMult valid formset')
-        #count = 0
-        donors = models.Donor.objects.filter(membership=membership)
-        donors = [donor.firstname + ' ' + donor.lastname for donor in donors]
-        duplicates = []
+        existing = set(models.Donor.name_key(first, last) for first, last in
+                       models.Donor.objects.filter(membership=membership)
+                                           .values_list('firstname', 'lastname'))
+        duplicates, contacts = [], []
         for form in formset.cleaned_data:
           if form:
             confirm = form['confirm'] and form['confirm'] == '1'
-            if not confirm and (form['firstname'] + ' ' + form['lastname'] in donors):
+            if not confirm and (models.Donor.name_key(form['firstname'],
+                                                      form['lastname']) in existing):
               initial = {'confirm': u'1',
                          'firstname': form['firstname'],
                          'lastname': form['lastname']}
@@ -611,8 +674,10 @@ def add_mult(request):
                 contact = models.Donor(firstname = form['firstname'],
                                        lastname= form['lastname'],
                                        membership = membership)
-              contact.save()
-              logger.info('contact created')
+              contacts.append(contact)
+        if contacts:
+          bulk.create(models.Donor, contacts)
+          logger.info(str(len(contacts)) + ' contacts created')
         if duplicates:
           logger.info('Showing confirmation page for duplicates: ' + str(duplicates))
           empty_error = '<ul class="errorlist"><li>The contacts below have the same name as contacts you have already entered. Press submit again to confirm that you want to add them.</li></ul>'
@@ -651,26 +716,28 @@ def add_estimates(request):
   membership = request.membership
 
   # get all donors without estimates
-  for donor in membership.donor_set.all():
-    if not donor.amount:
-      initiald.append({'donor': donor})
-      dlist.append(donor)
+  for donor in membership.donor_set.filter(Q(amount__isnull=True) | Q(amount=0)):
+    initiald.append({'donor': donor.pk})
+    dlist.append(donor)
   # create formset
   est_formset = formset_factory(forms.DonorEstimates, extra=0)
 
   if request.method == 'POST':
-    membership.last_activity = timezone.now()
-    membership.save(skip=True)
+    activity.touch(membership)
     formset = est_formset(request.POST)
     logger.debug('Adding estimates - posted: ' + str(request.POST))
     if formset.is_valid():
       logger.debug('Adding estimates - is_valid passed, cycling through forms')
-      for form in formset.cleaned_data:
-        if form:
-          current = form['donor']
-          current.amount = form['amount']
-          current.likelihood = form['likelihood']
-          current.save()
+      estimates = [form for form in formset.cleaned_data if form]
+      donors = membership.donor_set.in_bulk([form['donor'] for form in estimates])
+      for form in estimates:
+        donor = donors.get(form['donor'])
+        if donor:
+          donor.amount = form['amount']
+          donor.likelihood = form['likelihood']
+        else:
+          logger.warning('Estimate for donor not in membership: ' + str(form))
+      bulk.update_changed(models.Donor, donors.values())
       return HttpResponse("success")
     else: #invalid form
       fd = zip(formset, dlist)
@@ -704,8 +771,7 @@ def edit_donor(request, donor_id):
 
   if request.method == 'POST':
     logger.debug(request.POST)
-    request.membership.last_activity = timezone.now()
-    request.membership.save(skip=True)
+    activity.touch(request.membership)
     if est:
       form = modelforms.DonorForm(request.POST, instance=donor,
                               auto_id = str(donor.pk) + '_id_%s')
@@ -741,8 +807,7 @@ def delete_donor(request, donor_id):
   action = '/fund/' + str(donor_id) + '/delete'
 
   if request.method == 'POST':
-    request.membership.last_activity = timezone.now()
-    request.membership.save(skip=True)
+    activity.touch(request.membership)
     donor.delete()
     return redirect(home)
 
@@ -761,12 +826,13 @@ def add_step(request, donor_id):
                ', donor id: ' + str(donor_id))
 
   try:
-    donor = models.Donor.objects.get(pk=donor_id, membership=membership)
+    donor = models.Donor.objects.with_open_step().get(pk=donor_id,
+                                                      membership=membership)
   except models.Donor.DoesNotExist:
     logger.error('Single step - tried to add step to nonexistent donor.')
     raise Http404
 
-  if donor.get_next_step():
+  if donor.has_open_step:
     logger.error('Trying to add step, donor has an incomplete')
     raise Http404 #TODO better error
 
@@ -775,8 +841,7 @@ def add_step(request, donor_id):
   divid = donor_id+'-addstep'
 
   if request.method == 'POST':
-    membership.last_activity = timezone.now()
-    membership.save(skip=True)
+    activity.touch(membership)
     form = modelforms.StepForm(request.POST, auto_id = str(donor.pk) + '_id_%s')
     logger.info('Single step - POST: ' + str(request.POST))
     if form.is_valid():
@@ -802,27 +867,33 @@ def add_mult_step(request):
   membership = request.membership
   suggested = membership.giving_project.suggested_steps.splitlines()
 
-  for donor in membership.donor_set.order_by('-added'): #sort by added
-    if (donor.received() == 0 and donor.promised is None and donor.get_next_step() is None):
-      initiald.append({'donor': donor})
-      dlist.append(donor)
-      size = size +1
-    if size > 9:
-      break
+  # 10 most recently added that have no promise/gift and no incomplete step
+  candidates = (membership.donor_set.without_open_step()
+                .filter(promised__isnull=True, received_this=0,
+                        received_next=0, received_afternext=0)
+                .order_by('-added')[:10])
+  for donor in candidates:
+    initiald.append({'donor': donor.pk})
+    dlist.append(donor)
+    size = size +1
   step_formset = formset_factory(forms.MassStep, extra=0)
   if request.method == 'POST':
-    membership.last_activity = timezone.now()
-    membership.save(skip=True)
+    activity.touch(membership)
     formset = step_formset(request.POST)
     logger.debug('Multiple steps - posted: ' + str(request.POST))
     if formset.is_valid():
       logger.debug('Multiple steps - is_valid passed, cycling through forms')
-      for form in formset.cleaned_data:
-        if form:
-          step = models.Step(donor = form['donor'], date = form['date'],
+      steps = [form for form in formset.cleaned_data if form]
+      donor_ids = membership.donor_set.in_bulk(
+          [form['donor'] for form in steps]).keys()
+      for form in steps:
+        if form['donor'] in donor_ids:
+          step = models.Step(donor_id = form['donor'], date = form['date'],
                              description = form['description'])
           step.save()
           logger.info('Multiple steps - step created')
+        else:
+          logger.warning('Step for donor not in membership: ' + str(form))
       return HttpResponse("success")
     else:
       logger.info('Multiple steps invalid')
@@ -862,8 +933,7 @@ def edit_step(request, donor_id, step_id):
   divid = donor_id+'-nextstep'
 
   if request.method == 'POST':
-    request.membership.last_activity = timezone.now()
-    request.membership.save(skip=True)
+    activity.touch(request.membership)
     form = modelforms.StepForm(request.POST, instance=step, auto_id = str(step.pk) +
                            '_id_%s')
     if form.is_valid():
@@ -878,6 +948,25 @@ def edit_step(request, donor_id, step_id):
                 'formid':formid, 'suggested':suggested,
                 'target': str(step.pk) + '_id_description'})
 
+STORY_DELAY = 60 # seconds to collect step completions into one story write
+
+def schedule_story(tally_id):
+  """ Defer writing a tally's story, unless a write is already pending """
+  if cache.add('fund-story-%d' % tally_id, True, STORY_DELAY * 10):
+    deferred.defer(write_story, tally_id, _countdown=STORY_DELAY)
+    logger.info('Scheduled story for tally ' + str(tally_id))
+
+def write_story(tally_id):
+  """ Deferred task - writes the story for a StoryTally """
+  # clear first so completions tallied after this point schedule another write
+  cache.delete('fund-story-%d' % tally_id)
+  try:
+    tally = models.StoryTally.objects.get(pk=tally_id)
+  except models.StoryTally.DoesNotExist:
+    logger.warning('Story tally ' + str(tally_id) + ' no longer exists')
+    return
+  tally.write_story()
+
 @login_required(login_url='/fund/login/')
 @approved_membership()
 def done_step(request, donor_id, step_id):
@@ -902,9 +991,7 @@ def done_step(request, donor_id, step_id):
   action = reverse('sjfnw.fund.views.done_step', kwargs={'donor_id': donor_id, 'step_id': step_id})
 
   if request.method == 'POST':
-    # update membership activity timestamp
-    membership.last_activity = timezone.now()
-    membership.save(skip=True)
+    activity.touch(membership)
 
     # get posted form
     form = forms.StepDoneForm(request.POST, auto_id = str(step.pk) + '_id_%s')
@@ -949,10 +1036,12 @@ def done_step(request, donor_id, step_id):
       step.save()
       donor.save()
 
-      #call story creator/updater
+      # add to today's story
+      tally = models.StoryTally.record(step)
       if os.getenv('SERVER_SOFTWARE', '').startswith('Google App Engine'):
-        deferred.defer(membership.update_story, timezone.now())
-        logger.info('Calling update story')
+        schedule_story(tally.pk)
+      else:
+        tally.write_story()
 
       # process next step input
       next_step = form.cleaned_data['next_step']
@@ -990,30 +1079,89 @@ def done_step(request, donor_id, step_id):
                  'step':step})
 
 # CRON EMAILS
+OVERDUE_BATCH = 100 # memberships per chunk of overdue step reminders
+
 def email_overdue(request):
+  """ Cron - emails members with overdue steps (see email_overdue_chunk) """
+  email_overdue_chunk()
+  return HttpResponse("")
+
+def email_overdue_chunk(after=0, today=None, size=OVERDUE_BATCH):
+  """ Sends overdue step reminders for memberships with pk > after, up to size
+  of them. Continues with the next chunk in a deferred task (on App Engine)
+  or a loop, so each invocation stays within the request deadline.
+
+  Members are emailed about each active membership with overdue steps, at
+  most once a week. The email shows the most recent overdue step.
+  """
   #TODO - in email content, show all overdue steps (not just for that ship)
-  today = datetime.date.today()
-  ships = models.Membership.objects.filter(giving_project__fundraising_deadline__gte=today)
+  today = today or datetime.date.today()
   limit = today-datetime.timedelta(days=7)
   subject, from_email = 'Fundraising Steps', constants.FUND_EMAIL
-  for ship in ships:
-    user = ship.member
-    if not ship.emailed or (ship.emailed <= limit):
-      num, st = ship.overdue_steps(get_next=True)
-      if num > 0 and st:
-        logger.info(user.email + ' has overdue step(s), emailing.')
-        to = user.email
-        html_content = render_to_string('fund/email_overdue.html',
-                                        {'login_url':constants.APP_BASE_URL+'fund/login',
-                                        'ship':ship, 'num':num, 'step':st,
-                                        'base_url':constants.APP_BASE_URL})
-        text_content = strip_tags(html_content)
-        msg = EmailMultiAlternatives(subject, text_content, from_email, [to],
-                                     [constants.SUPPORT_EMAIL])
-        msg.attach_alternative(html_content, "text/html")
-        msg.send()
-        ship.emailed = today
-        ship.save(skip=True)
+
+  while True:
+    # (membership id, overdue count, latest overdue date) in one grouped query
+    rows = list(models.Step.objects
+        .filter(completed__isnull=True, date__lt=models.overdue_cutoff(),
+                donor__membership__pk__gt=after,
+                donor__membership__giving_project__fundraising_deadline__gte=today)
+        .filter(Q(donor__membership__emailed__isnull=True) |
+                Q(donor__membership__emailed__lte=limit))
+        .values_list('donor__membership')
+        .annotate(count=Count('pk'), latest=Max('date'))
+        # by id, to match the cursor - a membership's own ordering is by name
+        .order_by('donor__membership__pk')[:size])
+    if not rows:
+      return
+
+    ships = (models.Membership.objects.select_related('member', 'giving_project')
+                                      .in_bulk([row[0] for row in rows]))
+    steps = {}
+    latest = reduce(operator.or_, [Q(donor__membership_id=ship_id, date=date)
+                                   for ship_id, num, date in rows])
+    for step in (models.Step.objects.filter(latest, completed__isnull=True)
+                                    .select_related('donor').order_by('-pk')):
+      steps.setdefault(step.donor.membership_id, step)
+
+    messages, emailed = [], []
+    for ship_id, num, date in rows:
+      ship, step = ships.get(ship_id), steps.get(ship_id)
+      if not ship or not step: # deleted or completed in the meantime
+        continue
+      logger.info(ship.member.email + ' has overdue step(s), emailing.')
+      html_content = render_to_string('fund/email_overdue.html',
+                                      {'login_url':constants.APP_BASE_URL+'fund/login',
+                                      'ship':ship, 'num':num, 'step':step,
+                                      'base_url':constants.APP_BASE_URL})
+      text_content = strip_tags(html_content)
+      msg = EmailMultiAlternatives(subject, text_content, from_email,
+                                   [ship.member.email], [constants.SUPPORT_EMAIL])
+      msg.attach_alternative(html_content, "text/html")
+      messages.append(msg)
+      emailed.append(ship)
+    get_connection().send_messages(messages)
+
+    models.Membership.objects.filter(pk__in=[ship.pk for ship in emailed]).update(emailed=today)
+    # update() skips signals
+    models.membership_cache.invalidate(*[ship.member_id for ship in emailed])
+    logger.info('Sent %d overdue step reminders', len(messages))
+
+    after = rows[-1][0]
+    if len(rows) < size:
+      return
+    if os.getenv('SERVER_SOFTWARE', '').startswith('Google App Engine'):
+      deferred.defer(email_overdue_chunk, after, today, size)
+      return
+
+def flush_activity(request):
+  """ Cron - writes recent member activity to last_activity (see activity) """
+  activity.flush_recent()
+  return HttpResponse("")
+
+def snapshot_progress(request):
+  """ Cron - records yesterday's fundraising totals (see ProgressSnapshot) """
+  yesterday = timezone.localtime(timezone.now()).date() - datetime.timedelta(days=1)
+  models.ProgressSnapshot.take(yesterday)
   return HttpResponse("")
 
 def new_accounts(request):
@@ -1043,7 +1191,7 @@ def gift_notify(request):
   """
   Send an email to members letting them know gifts have been received
   Mark donors as notified
-  Put details in membership notif
+  Add a Notification listing the gifts for each membership
   """
 
   donors = models.Donor.objects.filter(
@@ -1057,20 +1205,9 @@ def gift_notify(request):
       memberships[donor.membership] = []
     memberships[donor.membership].append(donor)
 
-  for ship, dlist in memberships.iteritems():
-    gift_str = ''
-    for d in dlist:
-      gift_str += ('$' + str(d.received()) + ' gift or pledge received from ' +
-                  d.firstname)
-      if d.lastname:
-        gift_str += ' '+d.lastname
-      gift_str += '!<br>'
-    ship.notifications = ('<table><tr><td>' + gift_str +
-                         '</td><td><img src="/static/images/odo2.png"' +
-                         'height=86 width=176 alt="Odo flying">' +
-                         '</td></tr></table>')
-    ship.save(skip=True)
-    logger.info('Gift notification set for ' + str(ship))
+  models.Notification.objects.bulk_create(
+      [models.Notification.gifts(ship, dlist) for ship, dlist in memberships.iteritems()])
+  logger.info('Gift notifications added for ' + str(len(memberships)) + ' memberships')
 
   login_url = constants.APP_BASE_URL + 'fund/'
   subject, from_email = 'Gift or pledge received', constants.FUND_EMAIL
@@ -1084,32 +1221,71 @@ def gift_notify(request):
     msg.attach_alternative(html_content, "text/html")
     msg.send()
     logger.info('Emailed gift notification to ' + to)
-  donors.update(gift_notified=True)
+  # only the donors notified about - more may have been received since
+  models.Donor.objects.filter(pk__in=[donor.pk for donor in donors]).update(
+      gift_notified=True)
   return HttpResponse("")
 
+DUPLICATE_BATCH = 200 # memberships per chunk of duplicate removal
+
 def find_duplicates(request): #no url
-  donors = (models.Donor.objects.select_related('membership')
-                                .prefetch_related('step_set')
-                                .order_by('firstname', 'lastname',
-                                          'membership', '-talked'))
-  ships = []
-  deleted = 0
-  prior = None
-  for donor in donors:
-    if (prior and donor.membership == prior.membership and
-        donor.firstname == prior.firstname and donor.lastname and
-        donor.lastname == prior.lastname and not donor.talked):
-      #matches prev, no completed steps
-      if donor.get_next_step():
-        logger.warning('%s matched but has a step. Not deleting.' % unicode(donor))
-        prior = donor
-      else:
-        logger.info('Deleting %s' % unicode(donor))
-        donor.delete()
-      deleted += 1
-      if not donor.membership in ships:
-        ships.append(donor.membership)
-    else:
-      prior = donor
-  return render(request, 'fund/test.html', {'deleted':deleted, 'ships':ships})
+  """ Deletes duplicate donors (see find_duplicates_chunk). Pass ?dry_run=1 to
+      list them without deleting """
+  report = find_duplicates_chunk(dry_run=bool(request.GET.get('dry_run')))
+  ships = (models.Membership.objects.select_related('member')
+                                    .filter(pk__in=report['ships']))
+  return render(request, 'fund/test.html',
+                {'deleted': report['deleted'], 'kept': report['kept'],
+                 'dry_run': report['dry_run'], 'ships': ships})
+
+def find_duplicates_chunk(after=0, dry_run=False, size=DUPLICATE_BATCH):
+  """ Removes duplicate donors from memberships with pk > after, size
+  memberships at a time. Continues with the next chunk in a deferred task (on
+  App Engine) or a loop, so only one chunk of donors is in memory at once.
+
+  Donors are duplicates if they're in the same membership with the same
+  normalized name. The one talked to (or else the oldest) is kept; the others
+  are deleted unless they've been talked to or have an open step.
+
+  Returns:
+    report dict for the chunks run in this call - deleted & kept counts, ids
+    of affected memberships and the ids after which it stopped
+  """
+  report = {'deleted': 0, 'kept': 0, 'ships': set(), 'dry_run': dry_run,
+            'after': after}
+
+  while True:
+    ship_ids = list(models.Membership.objects.filter(pk__gt=after)
+                    .order_by('pk').values_list('pk', flat=True)[:size])
+    if not ship_ids:
+      return report
+
+    donors = (models.Donor.objects.with_open_step()
+              .filter(membership_id__in=ship_ids)
+              .order_by('membership', '-talked', 'pk')
+              .values('pk', 'membership_id', 'firstname', 'lastname', 'talked',
+                      'has_open_step'))
+    remove, kept = dedupe.find_duplicates(donors)
+    for donor in kept:
+      logger.warning('Donor %(pk)d (%(firstname)s %(lastname)s) in membership '
+                     '%(membership_id)d matched but has been talked to or has a '
+                     'step. Not deleting.' % donor)
+    for donor in remove:
+      logger.info('%s donor %d (%s %s) in membership %d' % (
+          'Would delete' if dry_run else 'Deleting', donor['pk'],
+          donor['firstname'], donor['lastname'], donor['membership_id']))
+    if remove and not dry_run:
+      # queryset delete still sends the signals that keep progress current
+      models.Donor.objects.filter(pk__in=[donor['pk'] for donor in remove]).delete()
+
+    report['deleted'] += len(remove)
+    report['kept'] += len(kept)
+    report['ships'].update(donor['membership_id'] for donor in remove)
+    after = report['after'] = ship_ids[-1]
+
+    if len(ship_ids) < size:
+      return report
+    if os.getenv('SERVER_SOFTWARE', '').startswith('Google App Engine'):
+      deferred.defer(find_duplicates_chunk, after, dry_run, size)
+      return report
 
@@ -0,0 +1,119 @@
+""" Versioned delta autosave for drafts (DraftGrantApplication, YERDraft)
+
+  The page sends only the fields changed since its last save, along with
+  base_version - the draft version those edits started from. Changes are
+  merged into the stored contents and written with a compare-and-set on the
+  version column. field_versions records the version each field was last
+  changed in, so two editors only conflict when both changed the same field.
+
+  Posts without base_version are full saves from older pages and replace
+  the contents, as autosave used to.
+
+  Form pages are issued a signed token for their draft (make_token), which
+  autosaves present instead of the session - see views.autosave_draft.
+"""
+
+from django.core import signing
+from django.utils import timezone
+
+from sjfnw.grants.models import DraftGrantApplication, YERDraft
+
+import json, logging
+
+logger = logging.getLogger('sjfnw')
+
+MAX_ATTEMPTS = 3
+
+# posted with the changes, not part of the contents
+PROTOCOL_FIELDS = ('base_version', 'user_id', 'token')
+
+DRAFT_MODELS = {'apply': DraftGrantApplication, 'report': YERDraft}
+
+TOKEN_SALT = 'sjfnw.grants.autosave'
+TOKEN_MAX_AGE = 60 * 60 * 24 * 3 # a form left open longer has to be reloaded
+
+def make_token(draft_type, draft_id):
+  """ Token allowing autosaves to one draft, for the page editing it """
+  return signing.dumps([draft_type, draft_id], salt=TOKEN_SALT)
+
+def check_token(token, draft_type, draft_id):
+  """ Whether token was issued for this draft and hasn't expired """
+  try:
+    issued = signing.loads(token, salt=TOKEN_SALT, max_age=TOKEN_MAX_AGE)
+  except signing.BadSignature: # includes expired
+    return False
+  return issued == [draft_type, int(draft_id)]
+
+class Conflict(Exception):
+  """ Fields changed by someone else since base_version """
+  def __init__(self, fields):
+    super(Conflict, self).__init__('Autosave conflict: ' + ', '.join(fields))
+    self.fields = fields
+
+def parse_post(post):
+  """ Split an autosave POST into (base_version, changes)
+
+  Returns:
+    base_version: int, or None for a full save
+    changes: dict of field name to value (the last value if repeated)
+  """
+  base_version = post.get('base_version')
+  if base_version is None or base_version == '':
+    return None, dict((key, post[key]) for key in post)
+  changes = dict((key, post[key]) for key in post if key not in PROTOCOL_FIELDS)
+  return int(base_version), changes
+
+def save_changes(draft, base_version, changes, modified_by=None, force=False):
+  """ Merge changes into a draft's contents and write them
+
+  Args:
+    draft: DraftGrantApplication or YERDraft
+    base_version: version the changes are based on, or None to replace the
+      contents with changes
+    changes: dict of field name to value
+    modified_by: user id to record, if the model tracks it
+    force: overwrite fields even if they changed since base_version
+
+  Returns:
+    the draft's version after saving. Nothing is written if the changes
+    match what's stored
+
+  Raises:
+    Conflict: another save changed one of the fields to a different value
+  """
+  model = type(draft)
+  for attempt in range(MAX_ATTEMPTS):
+    if base_version is None:
+      contents = dict(changes)
+      versions = dict.fromkeys(contents, draft.version + 1)
+    else:
+      contents = draft.get_contents_dict().copy()
+      versions = json.loads(draft.field_versions)
+      changed = [field for field, value in changes.iteritems()
+                 if contents.get(field) != value]
+      if not changed:
+        return draft.version
+      conflicts = sorted(field for field in changed
+                         if versions.get(field, 0) > base_version)
+      if conflicts and not force:
+        raise Conflict(conflicts)
+      for field in changed:
+        contents[field] = changes[field]
+        versions[field] = draft.version + 1
+
+    values = {'contents': json.dumps(contents),
+              'field_versions': json.dumps(versions),
+              'version': draft.version + 1, 'modified': timezone.now()}
+    if modified_by is not None:
+      values['modified_by'] = modified_by
+    if model.objects.filter(pk=draft.pk, version=draft.version).update(**values):
+      for name, value in values.iteritems():
+        setattr(draft, name, value)
+      return draft.version
+
+    # saved by someone else since it was read - merge onto theirs
+    logger.info('Autosave of %s %d raced another save; retrying',
+                model.__name__, draft.pk)
+    draft = model.objects.get(pk=draft.pk)
+
+  raise Conflict([])
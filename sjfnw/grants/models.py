@@ -4,8 +4,10 @@ from django.core.validators import BaseValidator
 from django.db import models
 from django.utils import timezone
 
+from sjfnw.fund import blocks
 from sjfnw.fund.models import GivingProject
 from sjfnw import constants
+from sjfnw.utils import ChangeTrackingMixin, CompressedJSONField
 
 from datetime import timedelta
 import logging, json, re
@@ -202,7 +204,10 @@ class DraftGrantApplication(models.Model):
   modified = models.DateTimeField(blank=True, default = timezone.now)
   modified_by = models.CharField(blank=True, max_length=100)
 
-  contents = models.TextField(default='{}')
+  contents = CompressedJSONField(default='{}')
+  # see sjfnw.grants.autosave
+  version = models.PositiveIntegerField(default=0)
+  field_versions = models.TextField(default='{}') # json, field -> version
 
   demographics = models.FileField(upload_to='/', max_length=255)
   funding_sources = models.FileField(upload_to='/', max_length=255)
@@ -226,6 +231,10 @@ class DraftGrantApplication(models.Model):
   def __unicode__(self):
     return u'DRAFT: ' + self.organization.name + ' - ' + self.grant_cycle.title
 
+  def save(self, *args, **kwargs):
+    self.version += 1 # so autosaves based on an earlier read retry
+    super(DraftGrantApplication, self).save(*args, **kwargs)
+
   def overdue(self):
     return self.grant_cycle.close <= timezone.now()
 
@@ -254,7 +263,7 @@ def validate_file_extension(value):
   if not value.name.lower().split(".")[-1] in constants.ALLOWED_FILE_TYPES:
     raise ValidationError(u'That file type is not supported.')
 
-class GrantApplication(models.Model):
+class GrantApplication(ChangeTrackingMixin, models.Model):
   """ Submitted grant application """
 
   #automated fields
@@ -534,8 +543,15 @@ class GrantApplication(models.Model):
   def save(self, *args, **kwargs):
     """ Whenever grant application is updated, update org profile if it is the
     most recent app for the org """
+    changed = set(self.changed_fields)
     super(GrantApplication, self).save(*args, **kwargs)
 
+    profile_fields = set(Organization._meta.get_all_field_names())
+    profile_fields.add('submission_time')
+    if not changed & profile_fields:
+      logger.info('App saving - no profile fields changed - regular save')
+      return
+
     # check if there are more recent apps
     apps = GrantApplication.objects.filter(organization_id=self.organization_id,
       submission_time__gt=self.submission_time)
@@ -775,7 +791,10 @@ class YERDraft(models.Model):
 
   award = models.OneToOneField(GivingProjectGrant)
   modified = models.DateTimeField(default=timezone.now())
-  contents = models.TextField(default='{}')
+  contents = CompressedJSONField(default='{}')
+  # see sjfnw.grants.autosave
+  version = models.PositiveIntegerField(default=0)
+  field_versions = models.TextField(default='{}') # json, field -> version
 
   photo1 = models.FileField(upload_to='/', blank=True, max_length=255)
   photo2 = models.FileField(upload_to='/', blank=True, max_length=255)
@@ -786,3 +805,30 @@ class YERDraft(models.Model):
 
   def __unicode__(self):
     return 'DRAFT year-end report for ' + unicode(self.award)
+
+  def save(self, *args, **kwargs):
+    self.version += 1 # so autosaves based on an earlier read retry
+    super(YERDraft, self).save(*args, **kwargs)
+
+
+# Giving project news & grants block cache invalidation
+
+def invalidate_app_blocks(sender, instance, **kwargs):
+  """ Application saved - affects the grants block of each project it's in """
+  blocks.invalidate(*ProjectApp.objects.filter(application_id=instance.pk)
+                                       .values_list('giving_project_id', flat=True))
+
+def invalidate_projectapp_blocks(sender, instance, **kwargs):
+  blocks.invalidate(instance.giving_project_id)
+
+def invalidate_moved_projectapp_blocks(sender, instance, raw, **kwargs):
+  """ Giving project changed - the old project's block is stale too """
+  if instance.pk and not raw:
+    blocks.invalidate(*ProjectApp.objects.filter(pk=instance.pk)
+                                         .exclude(giving_project_id=instance.giving_project_id)
+                                         .values_list('giving_project_id', flat=True))
+
+models.signals.post_save.connect(invalidate_app_blocks, sender=GrantApplication)
+models.signals.pre_save.connect(invalidate_moved_projectapp_blocks, sender=ProjectApp)
+models.signals.post_save.connect(invalidate_projectapp_blocks, sender=ProjectApp)
+models.signals.post_delete.connect(invalidate_projectapp_blocks, sender=ProjectApp)
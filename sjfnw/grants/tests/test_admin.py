@@ -2,8 +2,10 @@ from django import forms
 from django.core.urlresolvers import reverse
 from django.test.utils import override_settings
 from django.utils import timezone
+from django.utils.html import escape
 
 from sjfnw.constants import TEST_MIDDLEWARE
+from sjfnw.fund.models import Member
 from sjfnw.grants.forms import AppReportForm, AwardReportForm, OrgReportForm
 from sjfnw.grants.tests.base import BaseGrantTestCase, LIVE_FIXTURES, assert_app_matches_draft
 from sjfnw.grants import models
@@ -353,11 +355,44 @@ class AdminInlines(BaseGrantTestCase):
       Displays one of the assigned apps
     """
 
-    apps = models.ProjectApp.objects.filter(giving_project_id=19)
+    papp = models.ProjectApp.objects.filter(giving_project_id=19).select_related(
+        'application__organization', 'application__grant_cycle')[0]
 
     response = self.client.get('/admin/fund/givingproject/19/')
 
-    self.assertContains(response, 'selected="selected">' + str(apps[0].application))
+    # autocomplete inputs show the current application's label
+    self.assertContains(response, 'class="autocomplete"')
+    self.assertContains(response, 'value="%s"' % escape(u'%s - %s' % (
+        papp.application.organization.name, papp.application.grant_cycle.title)))
+
+  def test_givingproject_size(self):
+    """ Verify the GP page doesn't list unassigned applications or all members,
+        and its size and queries don't grow with the number of members
+
+    Setup:
+      GP 19 has projectapps; live fixtures have many other applications
+    """
+
+    url = '/admin/fund/givingproject/19/'
+    assigned = set(models.ProjectApp.objects.filter(giving_project_id=19)
+        .values_list('application__organization__name', flat=True))
+    other = (models.GrantApplication.objects.exclude(organization__name__in=assigned)
+                                            .select_related('organization')[0])
+
+    response = self.client.get(url)
+    self.assertNotContains(response, escape(other.organization.name))
+    self.assertNotContains(response, '<option value="%d"' % other.pk)
+    size = len(response.content)
+    queries = self.count_queries(self.client.get, url)
+    self.assertGreater(queries, 0)
+
+    for i in range(30):
+      Member(first_name='Extra', last_name=str(i),
+             email='extra%d@example.com' % i).save()
+    with self.assertNumQueries(queries):
+      response = self.client.get(url)
+    self.assertNotContains(response, 'Extra 1')
+    self.assertEqual(len(response.content), size)
 
   def test_application(self):
     """ Verify that gp assignment and awards are shown on application page
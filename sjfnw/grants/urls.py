@@ -29,6 +29,7 @@ apply_urls += patterns('sjfnw.grants.views',
 )
 
 root_urls = patterns('sjfnw.grants.views',
+  (r'^autosave/(?P<draft_type>apply|report)/(?P<draft_id>\d+)/?$', 'autosave_draft'),
   (r'^(?P<draft_type>.*)/(?P<draft_id>\d+)/add-file/?$', 'add_file'),
   (r'^(?P<draft_type>.*)/(?P<draft_id>\d+)/remove/(?P<file_field>.*)/?$', 'remove_file')
 )
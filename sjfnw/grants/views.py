@@ -6,7 +6,7 @@ from django.contrib.auth.models import User
 from django.core.mail import EmailMultiAlternatives
 from django.core.urlresolvers import reverse
 from django.forms.models import model_to_dict
-from django.http import HttpResponse, Http404
+from django.http import HttpResponse, HttpResponseNotAllowed, Http404
 from django.shortcuts import render, render_to_response, get_object_or_404, redirect
 from django.template.loader import render_to_string
 from django.utils import timezone
@@ -22,7 +22,7 @@ from sjfnw.grants.decorators import registered_org
 from sjfnw.grants.forms import LoginForm, RegisterForm, RolloverForm, AdminRolloverForm, AppReportForm, OrgReportForm, AwardReportForm, LoginAsOrgForm, RolloverYERForm
 from sjfnw.grants.modelforms import GrantApplicationModelForm, OrgProfile, YearEndReportForm
 from sjfnw.grants.utils import local_date_str, ServeBlob, DeleteBlob
-from sjfnw.grants import models
+from sjfnw.grants import autosave, models
 
 import urllib2
 import datetime, logging, json
@@ -227,7 +227,7 @@ def Apply(request, organization, cycle_id): # /apply/[cycle_id]
       return render(request, 'grants/submitted_closed.html', {'cycle':cycle})
 
     #get fields & files from draft
-    draft_data = json.loads(draft.contents)
+    draft_data = draft.get_contents_dict().copy()
     #logger.debug('draft data: ' + str(draft_data))
     files_data = model_to_dict(draft, fields = draft.file_fields())
     #logger.debug('Files data from draft: ' + str(files_data))
@@ -281,7 +281,7 @@ def Apply(request, organization, cycle_id): # /apply/[cycle_id]
         return render(request, 'grants/cycle_info.html', {'cycle':cycle})
 
     else: #load a draft
-      dict = json.loads(draft.contents)
+      dict = draft.get_contents_dict().copy()
       timeline = []
       for i in range(15): #covering both timeline formats
         if 'timeline_' + str(i) in dict:
@@ -320,7 +320,8 @@ def Apply(request, organization, cycle_id): # /apply/[cycle_id]
       'form': form, 'cycle': cycle, 'file_urls': file_urls,
       'limits': models.GrantApplication.NARRATIVE_CHAR_LIMITS,
       'draft': draft, 'profiled': profiled, 'org': organization,
-      'user_override': user_override, 'flag': flag
+      'user_override': user_override, 'flag': flag,
+      'autosave_token': autosave.make_token('apply', draft.pk)
   })
 
 def autosave_app(request, cycle_id):  # /apply/[cycle_id]/autosave/
@@ -346,23 +347,47 @@ def autosave_app(request, cycle_id):  # /apply/[cycle_id]/autosave/
   draft = get_object_or_404(models.DraftGrantApplication, organization=organization, grant_cycle=cycle)
 
   if request.method == 'POST':
-    curr_user = request.POST.get('user_id')
-
-    #check for simultaneous editing
-    if request.GET.get('override') != 'true': #override skips this check
-      if draft.modified + datetime.timedelta(seconds=35) > timezone.now(): #edited recently
-        if draft.modified_by and draft.modified_by != curr_user: #last save wasn't this userid
-          logger.info('Requiring confirmation')
-          return HttpResponse("confirm override", status=409)
-    else:
-      logger.info('Override skipped check')
-    #get or create saved json, update it
-    logger.debug("Autosaving")
-    draft.contents = json.dumps(request.POST)
-    draft.modified = timezone.now()
-    draft.modified_by = curr_user
-    draft.save()
-    return HttpResponse("success")
+    return save_draft_changes(request, draft,
+                              modified_by=request.POST.get('user_id', ''))
+
+def save_draft_changes(request, draft, **kwargs):
+  """ Merge an autosave POST into a draft (see sjfnw.grants.autosave)
+
+  Returns json with the draft's new version, or a 409 listing the fields
+  someone else changed unless ?override=true """
+  try:
+    base_version, changes = autosave.parse_post(request.POST)
+  except ValueError:
+    return HttpResponse('Invalid base_version', status=400)
+  force = request.GET.get('override') == 'true'
+  try:
+    version = autosave.save_changes(draft, base_version, changes, force=force,
+                                    **kwargs)
+  except autosave.Conflict as err:
+    logger.info('Requiring confirmation - ' + unicode(err))
+    return HttpResponse(json.dumps({'conflicts': err.fields}), status=409,
+                        mimetype='application/json')
+  return HttpResponse(json.dumps({'version': version}),
+                      mimetype='application/json')
+
+def autosave_draft(request, draft_type, draft_id): # /autosave/[type]/[draft_id]
+  """ Autosave authorized by the token issued with the form page
+
+  Doesn't use the session, user or organization, so the draft is the only
+  lookup. app.yaml serves it without middleware (see wsgi.py) """
+  if request.method != 'POST':
+    return HttpResponseNotAllowed(['POST'])
+  if not autosave.check_token(request.POST.get('token', ''), draft_type, draft_id):
+    return HttpResponse(LOGIN_URL, status=401)
+  model = autosave.DRAFT_MODELS[draft_type]
+  try:
+    draft = model.objects.get(pk=draft_id)
+  except model.DoesNotExist: # submitted or discarded
+    raise Http404
+  if draft_type == 'apply':
+    return save_draft_changes(request, draft,
+                              modified_by=request.POST.get('user_id', ''))
+  return save_draft_changes(request, draft)
 
 def add_file(request, draft_type, draft_id):
   """ Upload a file to a draft
@@ -447,11 +472,7 @@ def autosave_yer(request, award_id):
   draft = get_object_or_404(models.YERDraft, award_id=award_id)
 
   if request.method == 'POST':
-    draft.contents = json.dumps(request.POST)
-    logger.info(draft.contents)
-    draft.modified = timezone.now()
-    draft.save()
-    return HttpResponse("success")
+    return save_draft_changes(request, draft)
 
 
 @login_required(login_url=LOGIN_URL)
@@ -479,7 +500,7 @@ def year_end_report(request, organization, award_id):
   draft, cr = models.YERDraft.objects.get_or_create(award=award)
 
   if request.method == 'POST':
-    draft_data = json.loads(draft.contents)
+    draft_data = draft.get_contents_dict().copy()
     files_data = model_to_dict(draft, fields = ['photo1', 'photo2', 'photo3', 'photo4', 'photo_release'])
     logger.info(files_data)
     draft_data['award'] = award.pk
@@ -513,7 +534,7 @@ def year_end_report(request, organization, award_id):
                       'phone': app.telephone_number, 'email': app.email_address}
       logger.info('Created new YER draft')
     else:
-      initial_data = json.loads(draft.contents)
+      initial_data = draft.get_contents_dict().copy()
       # manually convert multi-widget TODO improve this
       initial_data['contact_person'] = (initial_data.get('contact_person_0', '') +
           ', ' + initial_data.get('contact_person_1', ''))
@@ -532,7 +553,8 @@ def year_end_report(request, organization, award_id):
 
   return render(request, 'grants/yer_form.html', {
       'form': form, 'org': organization, 'draft': draft, 'award': award,
-      'file_urls': file_urls, 'user_override': user_override
+      'file_urls': file_urls, 'user_override': user_override,
+      'autosave_token': autosave.make_token('report', draft.pk)
   })
 
 
@@ -586,7 +608,7 @@ def CopyApp(request, organization):
       elif draft:
         try:
           application = models.DraftGrantApplication.objects.get(pk = int(draft))
-          content = json.loads(application.contents)
+          content = application.get_contents_dict().copy()
           logger.info(content)
           content['cycle_question'] = ''
           logger.info(content)
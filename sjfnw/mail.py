@@ -1,9 +1,11 @@
-import logging
+import logging, threading, time
 from email.mime.base import MIMEBase
 
 from django.conf import settings
 from django.core.mail.backends.base import BaseEmailBackend
 from django.core.mail import EmailMultiAlternatives
+from django.core.signals import request_finished
+from django.utils.importlib import import_module
 
 from google.appengine.api import mail as gaemail
 from google.appengine.ext import deferred
@@ -14,25 +16,165 @@ from google.appengine.runtime import apiproxy_errors
 
 logger = logging.getLogger('sjfnw')
 
+BATCH_SIZE = getattr(settings, 'EMAIL_BATCH_SIZE', 50) # messages per task
+MAX_ATTEMPTS = getattr(settings, 'EMAIL_MAX_ATTEMPTS', 5) # per message
+RETRY_DELAY = 60 # seconds, doubled for each attempt
+
+
+# Task queues
+
+class DeferredQueue(object):
+  """ App Engine task queue, via deferred """
+
+  def add(self, func, *args, **kwargs):
+    deferred.defer(func, *args, **kwargs)
+
+class LocalQueue(object):
+  """ In-process stand-in for the task queue, for tests, benchmarks and
+  local development. Records each task enqueued and how long it took.
+
+  Args:
+    run: whether to run tasks as they're added (default True)
+  """
+
+  def __init__(self, run=True):
+    self.run = run
+    self.tasks = [] # dicts: func, args, kwargs, options, seconds
+
+  def add(self, func, *args, **kwargs):
+    options = dict((key, kwargs.pop(key)) for key in kwargs.keys()
+                   if key.startswith('_'))
+    task = {'func': func, 'args': args, 'kwargs': kwargs, 'options': options,
+            'seconds': 0}
+    self.tasks.append(task)
+    if self.run:
+      start = time.time()
+      func(*args, **kwargs)
+      task['seconds'] = time.time() - start
+
+_queues = {}
+
+def get_queue():
+  """ Returns the queue named by settings.EMAIL_TASK_QUEUE (a dotted path to
+      a class like DeferredQueue), creating it on first use """
+  path = getattr(settings, 'EMAIL_TASK_QUEUE', 'sjfnw.mail.DeferredQueue')
+  if path not in _queues:
+    module, name = path.rsplit('.', 1)
+    _queues[path] = getattr(import_module(module), name)()
+  return _queues[path]
+
+
+# Sending
+
 def _send_deferred(message, fail_silently=False):
+  """ Deferred task - sends one message (tasks queued before batching) """
   try:
     message.send()
   except (gaemail.Error, apiproxy_errors.Error):
     if not fail_silently:
       raise
 
+def _send_batch(messages, fail_silently=False, attempt=1):
+  """ Deferred task - sends App Engine EmailMessages. Each failed message is
+  retried in a later task, with backoff. If the quota is hit, the rest of
+  the batch is retried together. """
+  failed = []
+  for i, message in enumerate(messages):
+    try:
+      message.send()
+    except apiproxy_errors.OverQuotaError:
+      logger.warning('Mail quota reached, retrying %d messages later',
+                     len(messages) - i)
+      failed.extend(messages[i:])
+      break
+    except (gaemail.Error, apiproxy_errors.Error), err:
+      logger.warning('Sending mail to %s failed: %s', message.to, err)
+      failed.append(message)
+  if not failed:
+    return
+  if attempt >= MAX_ATTEMPTS:
+    logger.error('Giving up on %d messages after %d attempts',
+                 len(failed), attempt)
+    if not fail_silently:
+      raise deferred.PermanentTaskFailure('%d messages could not be sent' %
+                                          len(failed))
+  else:
+    _enqueue(failed, fail_silently, attempt + 1,
+             countdown=RETRY_DELAY * 2 ** (attempt - 1))
+
+def _enqueue(messages, fail_silently, attempt=1, countdown=0):
+  """ Adds tasks sending messages, BATCH_SIZE at a time """
+  queue_name = getattr(settings, 'EMAIL_QUEUE_NAME', 'default')
+  for i in range(0, len(messages), BATCH_SIZE):
+    get_queue().add(_send_batch, messages[i:i + BATCH_SIZE],
+                    fail_silently=fail_silently, attempt=attempt,
+                    _queue=queue_name, _countdown=countdown)
+
+_collected = threading.local()
+
+def _flush():
+  """ Enqueues messages collected on this thread and stops collecting """
+  messages = getattr(_collected, 'messages', None)
+  _collected.messages = None
+  if messages:
+    _enqueue(messages, False)
+
+class EmailBatchMiddleware(object):
+  """ Collects messages sent during a request so they are enqueued together,
+      rather than in a task per send()
+
+  List it first, so its process_request always runs. Messages are flushed
+  in process_response or process_exception, and otherwise when the request
+  finishes (_flush_finished) - so sends after the request, such as deferred
+  tasks on the same thread, are never held in an abandoned list.
+  """
+
+  def process_request(self, request):
+    if getattr(_collected, 'messages', None):
+      logger.warning('Enqueueing %d messages left from an earlier request',
+                     len(_collected.messages))
+      _flush()
+    _collected.messages = []
+
+  def process_response(self, request, response):
+    _flush()
+    return response
+
+  def process_exception(self, request, exception):
+    _flush()
+
+def _flush_finished(sender, **kwargs):
+  """ request_finished - flushes if the middleware's response hooks weren't
+      reached, e.g. a later response middleware raised """
+  _flush()
+
+request_finished.connect(_flush_finished)
+
 
 class EmailBackend(BaseEmailBackend):
-  """ Asynchronous email backend """
+  """ Asynchronous email backend
+
+  Messages are sent by deferred tasks, in batches. Within a request that
+  EmailBatchMiddleware covers, they're held until the response.
+  """
 
   def send_messages(self, email_messages):
-    """ Call _send for each message & return count of messages """
+    """ Convert messages & queue them, return count of messages """
 
-    num_sent = 0
+    messages = []
     for message in email_messages:
-      if self._send(message):
-        num_sent += 1
-    return num_sent
+      try:
+        messages.append(self._copy_message(message))
+      except (ValueError, gaemail.InvalidEmailError), err:
+        logger.error(err)
+        if not self.fail_silently:
+          raise
+    collected = getattr(_collected, 'messages', None)
+    if collected is not None and not self.fail_silently:
+      collected.extend(messages)
+    else:
+      _enqueue(messages, self.fail_silently)
+    return len(messages)
 
   def _copy_message(self, message):
     """ Create and return App Engine EmailMessage class from message """
@@ -65,26 +207,6 @@ class EmailBackend(BaseEmailBackend):
           break
     return gmsg
 
-  def _send(self, message):
-    """
-    Use _copy_message to convert to gae email obj
-    Call _defer_message to add to send queue
-    """
-    try:
-      message = self._copy_message(message)
-    except (ValueError, gaemail.InvalidEmailError), err:
-      logger.error(err)
-      if not self.fail_silently:
-        raise
-      return False
-    self._defer_message(message)
-    return True
-
-  def _defer_message(self, message):
-    queue_name = getattr(settings, 'EMAIL_QUEUE_NAME', 'default')
-    deferred.defer(_send_deferred, message, fail_silently=self.fail_silently,
-                   _queue=queue_name)
-
 #Djangoappengine license:
 
 #Copyright (c) Waldemar Kornewald, Thomas Wanschik, and all contributors.
@@ -28,6 +28,11 @@ if (os.getenv('SERVER_SOFTWARE', '').startswith('Google App Engine') or os.geten
       'NAME': 'sjfdb',
     }
   }
+  CACHES = { # memcache is provided under the python-memcached interface
+    'default': {
+      'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+    }
+  }
   DEBUG = False
 elif 'test' in sys.argv:
   DATABASES = {
@@ -51,6 +56,7 @@ else:
 
 MIDDLEWARE_CLASSES = (
   #'google.appengine.ext.appstats.recording.AppStatsDjangoMiddleware', #must be first
+  'sjfnw.mail.EmailBatchMiddleware',
   'django.middleware.common.CommonMiddleware',
   'django.contrib.sessions.middleware.SessionMiddleware',
   'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -74,6 +80,8 @@ LOGGING = {'version': 1,}
 
 EMAIL_BACKEND = 'sjfnw.mail.EmailBackend'
 EMAIL_QUEUE_NAME = 'default'
+EMAIL_BATCH_SIZE = 50 # messages per deferred task
+#EMAIL_TASK_QUEUE = 'sjfnw.mail.LocalQueue' # run mail tasks in process
 
 USE_TZ = True
 TIME_ZONE = 'America/Los_Angeles'
@@ -0,0 +1,38 @@
+/* Search-as-you-type for AutocompleteInput (sjfnw/forms.py)
+ * The visible text input searches; the hidden input before it holds the id */
+(function($) {
+  var MIN_LENGTH = 2;
+
+  $('input.autocomplete').live('keyup', function() {
+    var input = $(this);
+    var term = $.trim(input.val());
+    var results = input.next('ul.autocomplete-results');
+    if (!results.length) {
+      results = $('<ul class="autocomplete-results"></ul>').insertAfter(input);
+    }
+    clearTimeout(input.data('timer'));
+    if (!term) {
+      input.prev('input').val('');
+    }
+    if (term.length < MIN_LENGTH) {
+      results.empty();
+      return;
+    }
+    input.data('timer', setTimeout(function() {
+      $.getJSON(input.attr('data-url'), {q: term}, function(matches) {
+        results.empty();
+        $.each(matches, function(i, match) {
+          $('<li></li>').text(match.label).data('id', match.id).appendTo(results);
+        });
+      });
+    }, 250));
+  });
+
+  $('ul.autocomplete-results li').live('click', function() {
+    var item = $(this);
+    var input = item.parent().prev('input.autocomplete');
+    input.val(item.text());
+    input.prev('input').val(item.data('id'));
+    item.parent().empty();
+  });
+})(django.jQuery);
@@ -23,14 +23,16 @@ formUtils.status_texts = { //for ajax error messages
  * @param {number} submit_id - pk of object used in post TODO is this just cycle?
  * @param {string.alphanum} user_id - randomly generated user id for mult edit warning
  * @param {string} staff_user - querystring for user override (empty string if n/a)
+ * @param {number} version - version of the draft the page was loaded with
+ * @param {string} token - signed token for saving to this draft
  */
-formUtils.init = function(url_prefix, draft_id, submit_id, user_id, staff_user) {
+formUtils.init = function(url_prefix, draft_id, submit_id, user_id, staff_user, version, token) {
   if (staff_user && staff_user !== 'None') {
     formUtils.staff_user = staff_user;
   } else {
     formUtils.staff_user = '';
   }
-  autoSave.init(url_prefix, submit_id, user_id);
+  autoSave.init(url_prefix, draft_id, submit_id, user_id, version, token);
   fileUploads.init(url_prefix, draft_id);
 };
 
@@ -94,21 +96,59 @@ autoSave.pause_timer = false;
    page load -> --> init ->
    page blur -> pause() -> sets onfocus, sets pause_timer -30-> clears save_timer
 
+   each save sends only the fields changed since the last one, with the draft
+   version they're based on (see sjfnw.grants.autosave)
 */
 
-autoSave.init = function(url_prefix, submit_id, user_id) {
+autoSave.init = function(url_prefix, draft_id, submit_id, user_id, version, token) {
   autoSave.submit_url = '/' + url_prefix + '/' + submit_id;
-  autoSave.save_url = autoSave.submit_url + '/autosave' + formUtils.staff_user;
+  if (token) { // saves straight to the draft, without the session
+    autoSave.save_url = '/autosave/' + url_prefix + '/' + draft_id;
+    autoSave.token = token;
+  } else {
+    autoSave.save_url = autoSave.submit_url + '/autosave' + formUtils.staff_user;
+    autoSave.token = '';
+  }
   autoSave.submit_url += formUtils.staff_user;
   if (user_id) {
     autoSave.user_id = user_id;
   } else {
     autoSave.user_id = '';
   }
+  autoSave.version = version || 0;
+  autoSave.saved = autoSave.formValues();
   console.log('Autosave variables loaded');
   autoSave.resume();
 };
 
+autoSave.formValues = function() {
+  /* field name -> value, last one wins like the server's request.POST */
+  var values = {};
+  $.each($('form').serializeArray(), function(i, field) {
+    values[field.name] = field.value;
+  });
+  return values;
+};
+
+autoSave.changes = function(values) {
+  /* fields that differ from the last save. cleared fields (e.g. unchecked
+     boxes) aren't serialized, so they're sent as empty */
+  var changes = {}, count = 0, name;
+  for (name in values) {
+    if (values[name] !== autoSave.saved[name]) {
+      changes[name] = values[name];
+      count++;
+    }
+  }
+  for (name in autoSave.saved) {
+    if (!(name in values)) {
+      changes[name] = '';
+      count++;
+    }
+  }
+  return count ? changes : null;
+};
+
 
 autoSave.pause = function() {
   if ( !window.onfocus ) {
@@ -152,18 +192,37 @@ autoSave.resume = function() {
 
 autoSave.save = function (submit, override){
   if (!override){ override = 'false'; }
-  if (formUtils.staff_user) { //TODO use querystring function
+  if (autoSave.save_url.indexOf('?') !== -1) { //TODO use querystring function
     override = '&override=' + override;
   } else {
     override = '?override=' + override;
   }
+  var values = autoSave.formValues();
+  var changes = autoSave.changes(values);
+  if (!changes) {
+    console.log(formUtils.logTime() + "no changes to autosave");
+    if (submit) {
+      document.getElementById('hidden_submit_app').click();
+    } else {
+      $('.autosaved').html(formUtils.currentTimeDisplay());
+    }
+    return;
+  }
   console.log(formUtils.logTime() + "autosaving");
+  changes.base_version = autoSave.version;
+  changes.user_id = autoSave.user_id;
+  if (autoSave.token) {
+    changes.token = autoSave.token;
+  }
   $.ajax({
     url: autoSave.save_url + override,
     type:"POST",
-    data:$('form').serialize() + '&user_id=' + autoSave.user_id,
+    data:changes,
+    dataType:"json",
     success:function(data, textStatus, jqXHR){
       if (jqXHR.status==200) {
+        autoSave.version = data.version;
+        autoSave.saved = values;
         if (submit) { //trigger the submit button
           var submit_all = document.getElementById('hidden_submit_app');
           submit_all.click();
@@ -1,6 +1,16 @@
 from django.contrib.auth.models import User
+from django.core import mail
+from django.core.cache import cache
+from django.core.signals import request_started
+from django.db import connection, reset_queries
 from django.test import TestCase
 from django.test.simple import DjangoTestSuiteRunner
+from django.test.utils import override_settings
+
+from google.appengine.api import mail as gaemail
+from google.appengine.ext import deferred
+
+from sjfnw import mail as sjfnw_mail
 
 from unittest import TextTestRunner, TextTestResult
 from unittest.signals import registerResult
@@ -18,7 +28,8 @@ logging.getLogger('sjfnw').setLevel(0)
 class BaseTestCase(TestCase):
 
   def setUp(self, login):
-    pass #self.printName()
+    cache.clear() # cached data is keyed by ids, which get reused between tests
+    #self.printName()
 
   def printName(self):
     """ Outputs class name, method name and method desc to console """
@@ -38,6 +49,22 @@ class BaseTestCase(TestCase):
     superuser = User.objects.create_superuser('admin@gmail.com', 'admin@gmail.com', 'admin')
     self.client.login(username = 'admin@gmail.com', password = 'admin')
 
+  def count_queries(self, func, *args, **kwargs):
+    """ Returns the number of db queries run by func(*args, **kwargs)
+
+    Like assertNumQueries, stops requests from resetting connection.queries
+    while counting, so func can use the test client """
+    debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    request_started.disconnect(reset_queries)
+    start = len(connection.queries)
+    try:
+      func(*args, **kwargs)
+    finally:
+      connection.use_debug_cursor = debug_cursor
+      request_started.connect(reset_queries)
+    return len(connection.queries) - start
+
   def assertMessage(self, response, text):
     """ Asserts that a message (django.contrib.messages) with the given text
         is displayed """
@@ -49,6 +76,95 @@ class BaseTestCase(TestCase):
     abstract = True
 
 
+class FakeMessage(object):
+  """ Stands in for an App Engine EmailMessage """
+
+  def __init__(self, error=None):
+    self.error = error
+    self.to = ['member@gmail.com']
+    self.sent = False
+
+  def send(self):
+    if self.error:
+      raise self.error
+    self.sent = True
+
+
+@override_settings(EMAIL_TASK_QUEUE = 'sjfnw.mail.LocalQueue')
+class MailBatching(BaseTestCase):
+  """ sjfnw.mail.EmailBackend batching & retries, using the local queue """
+
+  def setUp(self):
+    super(MailBatching, self).setUp('')
+    self.queue = sjfnw_mail.get_queue()
+    self.queue.run = False
+    self.queue.tasks = []
+    sjfnw_mail._collected.messages = None
+
+  def test_batches(self):
+    """ Verify messages are enqueued BATCH_SIZE per task """
+
+    messages = [mail.EmailMessage('Subject', 'Body', 'sjfnw@gmail.com',
+                                  ['member%d@gmail.com' % i])
+                for i in range(sjfnw_mail.BATCH_SIZE * 2 + 1)]
+    sent = sjfnw_mail.EmailBackend().send_messages(messages)
+
+    self.assertEqual(sent, len(messages))
+    self.assertEqual([len(task['args'][0]) for task in self.queue.tasks],
+                     [sjfnw_mail.BATCH_SIZE, sjfnw_mail.BATCH_SIZE, 1])
+
+  def test_request_batch(self):
+    """ Verify messages sent individually during a request share a task """
+
+    middleware = sjfnw_mail.EmailBatchMiddleware()
+    middleware.process_request(None)
+    for i in range(3):
+      sjfnw_mail.EmailBackend().send_messages([mail.EmailMessage('Subject',
+          'Body', 'sjfnw@gmail.com', ['member%d@gmail.com' % i])])
+    self.assertEqual(self.queue.tasks, [])
+    middleware.process_response(None, None)
+    self.assertEqual(len(self.queue.tasks), 1)
+    self.assertEqual(len(self.queue.tasks[0]['args'][0]), 3)
+
+  def test_abandoned(self):
+    """ Verify messages held for a request whose response hooks weren't
+        reached are still enqueued """
+
+    def send(to):
+      sjfnw_mail.EmailBackend().send_messages([
+          mail.EmailMessage('Subject', 'Body', 'sjfnw@gmail.com', [to])])
+
+    middleware = sjfnw_mail.EmailBatchMiddleware()
+    middleware.process_request(None)
+    send('member1@gmail.com')
+    self.assertEqual(self.queue.tasks, [])
+    middleware.process_request(None) # next request on the thread
+    self.assertEqual(len(self.queue.tasks), 1)
+
+    send('member2@gmail.com')
+    sjfnw_mail._flush_finished(None) # request_finished
+    self.assertEqual(len(self.queue.tasks), 2)
+    send('member3@gmail.com') # outside a request - not held
+    self.assertEqual(len(self.queue.tasks), 3)
+
+  def test_retry(self):
+    """ Verify only failed messages are retried, with backoff """
+
+    ok, failing = FakeMessage(), FakeMessage(gaemail.Error('Failed'))
+    sjfnw_mail._send_batch([ok, failing, FakeMessage()])
+
+    self.assertTrue(ok.sent)
+    self.assertEqual(len(self.queue.tasks), 1)
+    task = self.queue.tasks[0]
+    self.assertEqual(task['args'][0], [failing])
+    self.assertEqual(task['kwargs']['attempt'], 2)
+    self.assertEqual(task['options']['_countdown'], sjfnw_mail.RETRY_DELAY)
+
+    self.assertRaises(deferred.PermanentTaskFailure, sjfnw_mail._send_batch,
+                      [failing], attempt=sjfnw_mail.MAX_ATTEMPTS)
+    self.assertEqual(len(self.queue.tasks), 1)
+
+
 class ColorTestSuiteRunner(DjangoTestSuiteRunner):
   """ Redirects run_suite to ColorTestRunner """
 
@@ -48,6 +48,9 @@ urlpatterns = patterns('',
   (r'^admin-advanced/grants/grantapplication/(?P<app_id>\d+)/rollover', 'sjfnw.grants.views.AdminRollover'),
   (r'^admin/grants/organization/login', 'sjfnw.grants.views.Impersonate'),
   (r'^admin/grants/organization/(?P<org_id>\d+)/update', 'sjfnw.grants.views.update_profile'),
+  (r'^admin/fund/gpsurvey/(?P<gp_survey_id>\d+)/results', 'sjfnw.fund.views.survey_results'),
+  (r'^admin/fund/autocomplete/members', 'sjfnw.fund.views.search_members'),
+  (r'^admin/fund/autocomplete/applications', 'sjfnw.fund.views.search_applications'),
 
   #reporting
   (r'^admin/grants/search/?', 'sjfnw.grants.views.grants_report'),
@@ -59,6 +62,10 @@ urlpatterns = patterns('',
   (r'^mail/drafts/?', 'sjfnw.grants.views.DraftWarning'),
   (r'^mail/yer/?', 'sjfnw.grants.views.yer_reminder_email'),
 
+  # cron
+  (r'^cron/progress-snapshot', 'sjfnw.fund.views.snapshot_progress'),
+  (r'^cron/activity', 'sjfnw.fund.views.flush_activity'),
+
   # dev
   (r'^dev/jslog/?', 'sjfnw.views.log_javascript'),
   (r'^dev/donor-dups', 'sjfnw.fund.views.find_duplicates'),
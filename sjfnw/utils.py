@@ -1,4 +1,9 @@
-import logging
+from django.core.cache import cache
+from django.db import DatabaseError, models
+from django.db.models.fields.files import FieldFile
+from django.utils.functional import curry
+
+import base64, json, logging, time, zlib
 logger = logging.getLogger('sjfnw')
 
 def log_queries(queries):
@@ -11,3 +16,222 @@ def log_queries(queries):
 
   logger.info(output)
 
+def _tracked_value(value):
+  """ Files are compared by name, other values as they are """
+  if isinstance(value, FieldFile):
+    return value.name
+  return value
+
+class ChangeTrackingMixin(object):
+  """ Model mixin that snapshots field values when an instance is loaded
+  from the db, so saves can tell what changed.
+
+  List it before models.Model. Instances loaded by a queryset save only
+  changed_fields (via update_fields), and skip the write if nothing changed.
+  New instances, or ones saved with explicit arguments, save normally.
+
+  A field counts as changed once it is assigned, even to the value it was
+  loaded with - the row may have changed since, and the assignment has to
+  reach it. If the row was deleted since loading, save re-inserts it like
+  Model.save would.
+  """
+
+  _loaded_values = None
+
+  def __init__(self, *args, **kwargs):
+    super(ChangeTrackingMixin, self).__init__(*args, **kwargs)
+    # querysets pass values positionally (or as kwargs on deferred models)
+    if self.pk is not None and (args or self._deferred):
+      self._snapshot_fields()
+    else:
+      self._loaded_values = None
+
+  def __setattr__(self, name, value):
+    assigned = self.__dict__.get('_assigned_fields')
+    if assigned is not None:
+      assigned.add(name)
+    super(ChangeTrackingMixin, self).__setattr__(name, value)
+
+  def _snapshot_fields(self):
+    self._loaded_values = dict((f.attname, _tracked_value(self.__dict__[f.attname]))
+                               for f in self._meta.fields if f.attname in self.__dict__)
+    self.__dict__['_assigned_fields'] = set()
+
+  def loaded_value(self, attname, default=None):
+    """ Value the field had when loaded, or default if unknown """
+    if self._loaded_values is None:
+      return default
+    return self._loaded_values.get(attname, default)
+
+  @property
+  def changed_fields(self):
+    """ Names of fields assigned or changed since loading (all fields if not
+        loaded) """
+    if self._loaded_values is None:
+      return [f.name for f in self._meta.fields]
+    missing = object()
+    assigned = self.__dict__['_assigned_fields']
+    return [f.name for f in self._meta.fields if f.attname in self.__dict__ and
+            (f.attname in assigned or
+             self._loaded_values.get(f.attname, missing) !=
+             _tracked_value(self.__dict__[f.attname]))]
+
+  def save(self, *args, **kwargs):
+    tracked = (self._loaded_values is not None and not args and
+               not kwargs.get('force_insert') and 'update_fields' not in kwargs)
+    if tracked:
+      changed = self.changed_fields
+      if self._meta.pk.name not in changed:
+        if changed: # auto_now values are set during save
+          changed += [f.name for f in self._meta.fields
+                      if getattr(f, 'auto_now', False) and f.name not in changed]
+        kwargs['update_fields'] = changed
+    try:
+      super(ChangeTrackingMixin, self).save(*args, **kwargs)
+    except DatabaseError as err:
+      # raised by Model.save when the update matched no row
+      if not tracked or 'did not affect any rows' not in str(err):
+        raise
+      logger.info('%s %s was deleted since loading; saving all fields',
+                  type(self).__name__, self.pk)
+      kwargs.pop('update_fields')
+      super(ChangeTrackingMixin, self).save(*args, **kwargs)
+    self._snapshot_fields()
+
+class VersionedCache(object):
+  """ Cache entries stored per object id under a version number
+
+  Invalidating bumps the version rather than deleting, so a fill that raced
+  an invalidation is written under a stale key and never read. Old versions
+  are left to expire. Also keeps per-object hit/miss counters.
+  """
+
+  VERSION_TIMEOUT = 60 * 60 * 24 * 30 # versions & counters
+
+  def __init__(self, prefix, timeout):
+    self.prefix = prefix
+    self.timeout = timeout
+
+  def _version_key(self, obj_id):
+    return '%s-v-%d' % (self.prefix, obj_id)
+
+  def _counter_key(self, obj_id, kind):
+    return '%s-%s-%d' % (self.prefix, kind, obj_id)
+
+  def version(self, obj_id):
+    key = self._version_key(obj_id)
+    version = cache.get(key)
+    if version is None:
+      # start from the clock so an evicted version never repeats an old one
+      version = int(time.time())
+      if not cache.add(key, version, self.VERSION_TIMEOUT):
+        version = cache.get(key, version)
+    return version
+
+  def get(self, obj_id):
+    """ Returns (version, value); value is None if not cached. Pass the
+        version back to set() when filling. """
+    version = self.version(obj_id)
+    return version, cache.get('%s-%d-%d' % (self.prefix, obj_id, version))
+
+  def set(self, obj_id, version, value):
+    cache.set('%s-%d-%d' % (self.prefix, obj_id, version), value, self.timeout)
+
+  def invalidate(self, *obj_ids):
+    for obj_id in set(obj_ids):
+      if obj_id is None:
+        continue
+      key = self._version_key(obj_id)
+      try:
+        cache.incr(key)
+      except ValueError: # nothing cached under a known version
+        cache.set(key, int(time.time()), self.VERSION_TIMEOUT)
+
+  def count(self, obj_id, kind):
+    key = self._counter_key(obj_id, kind)
+    try:
+      cache.incr(key)
+    except ValueError: # not set yet
+      if not cache.add(key, 1, self.VERSION_TIMEOUT):
+        cache.incr(key)
+
+  def stats(self, obj_id):
+    """ Hits and misses counted for the object """
+    keys = [self._counter_key(obj_id, 'hits'), self._counter_key(obj_id, 'misses')]
+    values = cache.get_many(keys)
+    return {'hits': values.get(keys[0], 0), 'misses': values.get(keys[1], 0)}
+
+class _CompressedJSONDescriptor(object):
+  """ Holds the db value as loaded and decompresses it on first access """
+
+  def __init__(self, field):
+    self.field = field
+
+  def __get__(self, instance, owner):
+    if instance is None:
+      return self
+    value = instance.__dict__[self.field.attname]
+    if self.field.is_compressed(value):
+      value = self.field.decompress(value)
+      instance.__dict__[self.field.attname] = value
+    return value
+
+  def __set__(self, instance, value):
+    instance.__dict__[self.field.attname] = value
+
+def _get_json_dict(instance, field):
+  text = getattr(instance, field.attname)
+  cache_name = '_%s_parsed' % field.attname
+  cached = instance.__dict__.get(cache_name)
+  if cached is None or cached[0] is not text:
+    cached = (text, json.loads(text))
+    instance.__dict__[cache_name] = cached
+  return cached[1]
+
+class CompressedJSONField(models.TextField):
+  """ JSON text stored zlib compressed
+
+  The attribute is the JSON text, as with a TextField. Values from the db are
+  only decompressed when read, and get_<name>_dict() returns the parsed value,
+  cached on the instance until the text is reassigned - don't modify it,
+  assign new text instead. Rows saved before compression (plain JSON) are
+  read as they are, and small values are stored plain.
+  """
+
+  MARKER = 'zlib:' # plain JSON starts with { or [
+  MIN_LENGTH = 200
+
+  def contribute_to_class(self, cls, name):
+    super(CompressedJSONField, self).contribute_to_class(cls, name)
+    setattr(cls, self.attname, _CompressedJSONDescriptor(self))
+    setattr(cls, 'get_%s_dict' % name, curry(_get_json_dict, field=self))
+
+  def is_compressed(self, value):
+    return isinstance(value, basestring) and value.startswith(self.MARKER)
+
+  def compress(self, text):
+    if isinstance(text, unicode):
+      text = text.encode('utf-8')
+    return self.MARKER + base64.b64encode(zlib.compress(text))
+
+  def decompress(self, value):
+    return zlib.decompress(base64.b64decode(str(value[len(self.MARKER):]))).decode('utf-8')
+
+  def pre_save(self, model_instance, add):
+    # as loaded - unread values are written back without a round trip
+    return model_instance.__dict__.get(self.attname)
+
+  def get_prep_value(self, value):
+    value = super(CompressedJSONField, self).get_prep_value(value)
+    if (isinstance(value, basestring) and not self.is_compressed(value) and
+        len(value) >= self.MIN_LENGTH):
+      return self.compress(value)
+    return value
+
+  def to_python(self, value):
+    if self.is_compressed(value):
+      return self.decompress(value)
+    return super(CompressedJSONField, self).to_python(value)
+
+  def value_to_string(self, obj):
+    return getattr(obj, self.attname)
@@ -1,3 +1,4 @@
+from django.core.handlers.wsgi import WSGIHandler
 from django.core.wsgi import get_wsgi_application
 from django.core.signals import got_request_exception
 import logging
@@ -25,3 +26,21 @@ got_request_exception.connect(log_exception)
 # define wsgi app
 application = get_wsgi_application()
 
+class NoMiddlewareHandler(WSGIHandler):
+  """ Handler that skips settings.MIDDLEWARE_CLASSES, for views that don't
+      need sessions or auth (they authenticate requests themselves) """
+
+  def __init__(self):
+    super(NoMiddlewareHandler, self).__init__()
+    self.load_middleware() # so get_response works before the first __call__
+
+  def load_middleware(self):
+    self._request_middleware = []
+    self._view_middleware = []
+    self._template_response_middleware = []
+    self._response_middleware = []
+    self._exception_middleware = []
+
+# draft autosaves - see sjfnw.grants.views.autosave_draft
+autosave_application = NoMiddlewareHandler()
+